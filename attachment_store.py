@@ -0,0 +1,120 @@
+"""Content-addressed storage for attachment payloads.
+
+Payloads are stored once per SHA-256 outside the database; SQLite only keeps the
+hash, metadata and a reference count (see db_utils attachments / attachment_blobs).
+
+A store is any object with the LocalFileStore methods. Writing is two-phase so the
+database stays the source of truth: `stage()` hashes the payload into a temp file
+without holding any lock, then `commit()` moves it into place inside the caller's
+write transaction. `delete()` is only called after the transaction dropping the
+last reference has committed, from a write run alone on the db_utils writer
+thread that checks the payload is still unreferenced, so a rolled-back delete
+never loses the file and a concurrent upload of the same file cannot race it.
+"""
+import hashlib
+import os
+import tempfile
+from dataclasses import dataclass
+
+ATTACHMENT_DIR = "attachments"   # created next to the database file
+CHUNK_SIZE = 1024 * 1024         # unit of every read and write, so memory per transfer stays bounded
+MAX_FILE_BYTES = 250 * 1024 * 1024
+
+
+class AttachmentTooLarge(ValueError):
+    pass
+
+
+@dataclass
+class StagedBlob:
+    sha256: str
+    size: int
+    temp_path: str
+
+
+class LocalFileStore:
+    """Payloads as files under `root`, sharded by hash: root/ab/cd/abcd…"""
+
+    def __init__(self, root):
+        self.root = root
+        self._tmp = os.path.join(root, "tmp")
+        os.makedirs(self._tmp, exist_ok=True)
+
+    def path(self, sha256):
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def stage(self, data, max_bytes=None):
+        """Copy bytes, a readable file object or an iterable of byte chunks to a temp file, hashing as it goes.
+
+        File objects are read CHUNK_SIZE bytes at a time. Raises AttachmentTooLarge
+        as soon as more than `max_bytes` have been read.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            chunks = [bytes(data)]
+        elif hasattr(data, "read"):
+            chunks = iter(lambda: data.read(CHUNK_SIZE), b"")
+        else:
+            chunks = data
+        digest, size = hashlib.sha256(), 0
+        fd, temp_path = tempfile.mkstemp(dir=self._tmp)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise AttachmentTooLarge(f"Attachment exceeds the {max_bytes / (1024 * 1024):g} MB limit")
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return StagedBlob(digest.hexdigest(), size, temp_path)
+
+    def commit(self, staged):
+        """Move a staged payload to its content address (a no-op if that content is already stored)."""
+        target = self.path(staged.sha256)
+        if os.path.exists(target):
+            os.unlink(staged.temp_path)
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(staged.temp_path, target)
+
+    def discard(self, staged):
+        if os.path.exists(staged.temp_path):
+            os.unlink(staged.temp_path)
+
+    def open(self, sha256):
+        return open(self.path(sha256), "rb")
+
+    def exists(self, sha256):
+        return os.path.exists(self.path(sha256))
+
+    def delete(self, sha256):
+        try:
+            os.unlink(self.path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def iter_hashes(self):
+        for dirpath, _, files in os.walk(self.root):
+            if os.path.abspath(dirpath) == os.path.abspath(self._tmp):
+                continue
+            for name in files:
+                yield name
+
+
+def local_store_for(db_path):
+    return LocalFileStore(os.path.join(os.path.dirname(os.path.abspath(db_path)), ATTACHMENT_DIR))
+
+
+# Factory used by db_utils and the migrations: db file path -> store.
+# Replace it (e.g. with an object-storage backend) before init_db() to plug in another store.
+store_factory = local_store_for
+_stores = {}
+
+
+def get_store(db_path):
+    key = os.path.abspath(db_path)
+    if key not in _stores:
+        _stores[key] = store_factory(db_path)
+    return _stores[key]
@@ -0,0 +1,390 @@
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+import db_utils
+
+SIZES = [1_000, 10_000, 100_000]
+SUITE_SIZES = [1_000, 10_000, 100_000]  # add 1_000_000 on the command line for the large run
+REGRESSION_TOLERANCE = 0.25  # fail when a case is this much slower than the baseline...
+REGRESSION_MIN_SECONDS = 0.005  # ...and slower by at least this much (timer noise on tiny cases)
+
+
+def _use_temp_db(tmpdir, name):
+    db_utils.DB_FILE = os.path.join(tmpdir, f"{name}.db")
+    db_utils.USERS_FILE = os.path.join(tmpdir, "no_users.xlsx")
+    db_utils.init_db()
+
+
+def _procurement_frame(n, variant=0):
+    return pd.DataFrame({
+        "StockCode": [f"SC{i:07d}" for i in range(n)],
+        "Description": [f"Part {i}" for i in range(n)],
+        "Current_Supplier": [f"Supplier {(i + variant) % 97}" for i in range(n)],
+        "AC_Coverage": [f"AC{i % 40}" for i in range(n)],
+        "Next_Shortage_Date": [f"2025-{(i % 12) + 1:02d}-{(i % 28) + 1:02d}" for i in range(n)],
+    })
+
+
+def bench_save_table(sizes=SIZES):
+    """Rows/second for a first import and for a re-upload where every 10th supplier changes."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in sizes:
+            _use_temp_db(tmpdir, f"save_{n}")
+            pid = db_utils.add_project(f"Bench {n}")
+            for label, df in [("insert", _procurement_frame(n)),
+                              ("update", _procurement_frame(n).assign(
+                                  Current_Supplier=lambda d: d["Current_Supplier"].where(d.index % 10 != 0, "Changed")))]:
+                start = time.perf_counter()
+                db_utils.save_table(df, pid, "procurement", changed_by="bench")
+                elapsed = time.perf_counter() - start
+                results.append({"bench": "save_table", "case": label, "rows": n,
+                                "seconds": elapsed, "rows_per_sec": n / elapsed})
+        db_utils.close_connections()
+    return results
+
+
+def _date_series(n, seed=0):
+    """Mostly ISO strings, with the other shapes uploads contain: other formats, datetimes, blanks, junk."""
+    rnd = random.Random(seed)
+    values = []
+    for i in range(n):
+        day = datetime(2020, 1, 1) + timedelta(days=rnd.randrange(2000))
+        roll = rnd.random()
+        if roll < 0.85:
+            values.append(day.strftime("%Y-%m-%d"))
+        elif roll < 0.90:
+            values.append(day.strftime("%m/%d/%Y"))
+        elif roll < 0.95:
+            values.append(day)
+        elif roll < 0.98:
+            values.append(None)
+        else:
+            values.append("TBC")
+    return pd.Series(values, dtype=object)
+
+
+def bench_dates(n=100_000):
+    """Per-cell try_date vs the columnar normalize_dates on the same mixed column."""
+    values = _date_series(n)
+    start = time.perf_counter()
+    expected = values.apply(db_utils.try_date)
+    per_cell = time.perf_counter() - start
+    start = time.perf_counter()
+    actual, _ = db_utils.normalize_dates(values)
+    columnar = time.perf_counter() - start
+    if [None if pd.isna(v) else v for v in expected] != actual.tolist():
+        raise AssertionError("normalize_dates disagrees with try_date")
+    return [
+        {"bench": "dates", "case": "try_date", "rows": n, "seconds": per_cell, "rows_per_sec": n / per_cell},
+        {"bench": "dates", "case": "normalize", "rows": n, "seconds": columnar, "rows_per_sec": n / columnar},
+    ]
+
+
+_STARTUP_SCRIPT = """
+import os, sys, time
+start = time.perf_counter()
+import db_utils
+imported = time.perf_counter()
+db_utils.DB_FILE, db_utils.USERS_FILE = sys.argv[1], sys.argv[2]
+db_utils.init_db()
+cold = time.perf_counter()
+db_utils.init_db()
+warm = time.perf_counter()
+os.utime(db_utils.USERS_FILE)  # same content, new mtime: hashed but not re-imported
+db_utils.init_db()
+touched = time.perf_counter()
+print(imported - start, cold - imported, warm - cold, touched - warm)
+"""
+
+
+def bench_startup(users=20):
+    """Cold-start breakdown in a fresh interpreter: imports, first init_db, a rerun's init_db, and one after touching users.xlsx."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        users_file = os.path.join(tmpdir, "users.xlsx")
+        pd.DataFrame({"Email": [f"user{i}@example.com" for i in range(users)],
+                      "Role": ["procurement"] * users,
+                      "Password": [f"pw{i}" for i in range(users)]}).to_excel(users_file, index=False)
+        out = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT, os.path.join(tmpdir, "startup.db"), users_file],
+                             cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True)
+    timings = [float(t) for t in out.stdout.split()[-4:]]
+    return [{"bench": "startup", "case": case, "rows": users, "seconds": s, "rows_per_sec": users / s}
+            for case, s in zip(["imports", "init cold", "init rerun", "init touched"], timings)]
+
+
+# ---------- Synthetic data ----------
+
+SUPPLIERS = 97
+FAI_STATUSES = ["Not Submitted", "Under Review", "Rejected", "Approved"]
+FITCHECK_STATUSES = ["", "Scheduled", "Approved", "Rejected"]
+
+
+def _day(rnd):
+    return (datetime(2024, 1, 1) + timedelta(days=rnd.randrange(1000))).strftime("%Y-%m-%d")
+
+
+def synthetic_frames(n, seed=0):
+    """Deterministic stock list and procurement / industrialization / quality frames of `n` items."""
+    rnd = random.Random(seed)
+    codes = [f"SC{seed:02d}{i:07d}" for i in range(n)]
+    return {
+        "stock_list": pd.DataFrame({"StockCode": codes, "Description": [f"Part {i} rev {i % 7}" for i in range(n)]}),
+        "procurement": pd.DataFrame({
+            "StockCode": codes,
+            "Current_Supplier": [f"Supplier {rnd.randrange(SUPPLIERS)}" for _ in range(n)],
+            "AC_Coverage": [f"AC{rnd.randrange(40)}" for _ in range(n)],
+            "Next_Shortage_Date": [_day(rnd) for _ in range(n)],
+        }),
+        "industrialization": pd.DataFrame({
+            "StockCode": codes,
+            "New_Supplier": [f"Supplier {rnd.randrange(SUPPLIERS)}" for _ in range(n)],
+            "FAI_Delivery_Date": [_day(rnd) for _ in range(n)],
+            "First_PO_Delivery_Date": [_day(rnd) for _ in range(n)],
+        }),
+        "quality": pd.DataFrame({
+            "StockCode": codes,
+            "FAI_Status": [rnd.choice(FAI_STATUSES) for _ in range(n)],
+            "FAI_Number": [f"FAI-{i:07d}" for i in range(n)],
+            "Fitcheck_AC": [f"AC{rnd.randrange(40)}" for _ in range(n)],
+            "Fitcheck_Date": [_day(rnd) for _ in range(n)],
+            "Fitcheck_Status": [rnd.choice(FITCHECK_STATUSES) for _ in range(n)],
+        }),
+    }
+
+
+def _revision(df, round_no, share=0.1):
+    """`df` with the supplier of every 1/share-th item changed, a different slice each round."""
+    step = int(1 / share)
+    return df.assign(Current_Supplier=df["Current_Supplier"].where(df.index % step != round_no % step, f"Rev {round_no}"))
+
+
+def attachment_payload(i, size, seed=0):
+    return random.Random(seed * 1_000_003 + i).randbytes(size)
+
+
+def generate_dataset(n, projects=1, history=3, attachments=None, attachment_bytes=64 * 1024, seed=0):
+    """Fill the current DB_FILE with `projects` projects of `n` items each, every department table
+    populated, `history` audited procurement revisions and `attachments` attachments per project
+    (default one per 1,000 items). The same arguments always produce the same data. Returns the project ids.
+    """
+    attachments = max(1, n // 1000) if attachments is None else attachments
+    pids = []
+    for p in range(projects):
+        frames = synthetic_frames(n, seed + p)
+        pid = db_utils.add_project(f"Synthetic {seed + p} ({n:,})", frames["stock_list"])
+        for table_name in db_utils.TABLE_SCHEMAS:
+            db_utils.save_table(frames[table_name], pid, table_name, changed_by="generator")
+        for round_no in range(history):
+            db_utils.save_table(_revision(frames["procurement"], round_no), pid, "procurement", changed_by="generator")
+        codes = frames["stock_list"]["StockCode"]
+        for i in range(attachments):
+            db_utils.save_attachment(pid, codes[i * n // attachments], f"doc{i}.pdf",
+                                     attachment_payload(i, attachment_bytes, seed + p), "generator")
+        pids.append(pid)
+    return pids
+
+
+# ---------- Hot-path suite ----------
+
+def _timed(results, bench, case, rows, fn, *args, **kwargs):
+    start = time.perf_counter()
+    value = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    results.append({"bench": bench, "case": case, "rows": rows, "seconds": elapsed,
+                    "rows_per_sec": rows / elapsed if elapsed else float("inf")})
+    return value
+
+
+def bench_hot_paths(sizes=SUITE_SIZES, seed=0):
+    """Time the db_utils hot paths against a synthetic project of each size, in a temporary database."""
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in sizes:
+            _use_temp_db(tmpdir, f"suite_{n}")
+            frames = synthetic_frames(n, seed)
+            pid = _timed(results, "add_project", "create", n, db_utils.add_project, "Suite", frames["stock_list"])
+            _timed(results, "add_project", "re-upload", n, db_utils.add_project, "Suite", frames["stock_list"])
+            for table_name in db_utils.TABLE_SCHEMAS:
+                _timed(results, "save_table", f"insert {table_name}", n,
+                       db_utils.save_table, frames[table_name], pid, table_name, "bench")
+            _timed(results, "save_table", "update 10%", n,
+                   db_utils.save_table, _revision(frames["procurement"], 0), pid, "procurement", "bench")
+            _timed(results, "save_table", "unchanged", n,
+                   db_utils.save_table, _revision(frames["procurement"], 0), pid, "procurement", "bench")
+
+            page, _ = _timed(results, "get_project_page", "first page", n, db_utils.get_project_page, pid, "procurement")
+            _timed(results, "save_edits", "one cell", n, db_utils.save_edits,
+                   page, {"edited_rows": {0: {"current_supplier": "Edited"}}}, pid, "procurement", "bench")
+            db_utils.clear_project_cache()
+            _timed(results, "get_project_data", "cold", n, db_utils.get_project_data, pid)
+            _timed(results, "get_project_data", "cached", n, db_utils.get_project_data, pid)
+            _timed(results, "filter_box", "prefix", n, db_utils.search_stockcodes, pid, "supplier 1")
+            _timed(results, "filter_box", "scoped", n, db_utils.search_stockcodes, pid, "supplier:rev")
+            _, _, seq = db_utils.get_project_changes(pid, sys.maxsize)  # no rows, just the current sequence
+            _timed(results, "undo_last_save", "one cell", n, db_utils.undo_last_save, pid, "procurement")
+            _timed(results, "get_project_changes", "one cell", n, db_utils.get_project_changes, pid, seq)
+            _timed(results, "get_project_data", "patched", n, db_utils.get_project_data, pid)
+            _timed(results, "get_portfolio_summary", "all projects", n, db_utils.get_portfolio_summary)
+            _timed(results, "get_risk_items", "90 days", n, db_utils.get_risk_items, today="2025-01-01")
+            _timed(results, "undo_last_save", "update 10%", n, db_utils.undo_last_save, pid, "procurement")
+
+            codes = frames["stock_list"]["StockCode"]
+            payload = attachment_payload(0, 1024 * 1024, seed)
+            aid = _timed(results, "attachments", "save 1 MB", n,
+                         db_utils.save_attachment, pid, codes[n // 2], "bench.pdf", payload, "bench")
+            _timed(results, "attachments", "list", n, db_utils.get_attachments, pid, codes[n // 2])
+            _timed(results, "attachments", "read 1 MB", n, lambda: sum(map(len, db_utils.iter_attachment(aid))))
+            _timed(results, "attachments", "delete", n, db_utils.delete_attachment, aid)
+
+            # a second project with audit history and attachments already in place
+            history_pid, = generate_dataset(n, history=3, seed=seed + 1)
+            _timed(results, "audit", "first page", n, db_utils.get_audit_page, project_id=history_pid)
+            _timed(results, "undo_last_save", "after history", n, db_utils.undo_last_save, history_pid, "procurement")
+            # before the project existed: every audited change is reverted
+            _timed(results, "get_project_data_as_of", "whole history", n,
+                   db_utils.get_project_data_as_of, history_pid, datetime.utcnow() - timedelta(days=1))
+        db_utils.close_connections()
+    return results
+
+
+def write_results(results, path):
+    """Write results as JSON, with enough environment detail to tell runs apart."""
+    doc = {
+        "created_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "pandas": pd.__version__,
+        "machine": platform.platform(),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(doc, f, indent=2)
+
+
+def compare(results, baseline_path, tolerance=REGRESSION_TOLERANCE, min_seconds=REGRESSION_MIN_SECONDS):
+    """Cases slower than in the baseline file by more than `tolerance` (and `min_seconds`).
+
+    Cases missing from either side are ignored. Returns a list of
+    (result, baseline seconds) pairs.
+    """
+    with open(baseline_path) as f:
+        baseline = {(r["bench"], r["case"], r["rows"]): r["seconds"] for r in json.load(f)["results"]}
+    regressions = []
+    for r in results:
+        before = baseline.get((r["bench"], r["case"], r["rows"]))
+        if before is None:
+            continue
+        if r["seconds"] > before * (1 + tolerance) and r["seconds"] - before > min_seconds:
+            regressions.append((r, before))
+    return regressions
+
+
+def check_plans():
+    """Fail (exit 1) if any db_utils hot path does a full table scan on a fresh schema."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _use_temp_db(tmpdir, "plans")
+        plans = db_utils.check_query_plans()
+        db_utils.close_connections()
+    scans = plans[plans["full_scan"]]
+    for _, r in scans.iterrows():
+        print(f"FULL SCAN: {r['plan']}\n    {r['sql'][:200]}")
+    print(f"{len(plans['sql'].unique())} statements explained, {len(scans)} full scans")
+    return scans.empty
+
+
+def check_writers(threads=50, rounds=4):
+    """Fail (exit 1) if concurrent saves from `threads` threads raise any error, e.g. "database is locked"."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        _use_temp_db(tmpdir, "writers")
+        frame = _procurement_frame(200)
+        project_id = db_utils.add_project("Writers", frame[["StockCode", "Description"]])
+
+        def worker(n):
+            errors = []
+            for r in range(rounds):
+                try:
+                    kind = (n + r) % 4
+                    if kind == 0:
+                        db_utils.save_table(_procurement_frame(200, variant=n * rounds + r), project_id, "procurement",
+                                            changed_by=f"user{n}")
+                    elif kind == 1:
+                        base, _ = db_utils.get_project_page(project_id, "procurement", limit=20)
+                        edits = {"edited_rows": {n % len(base): {"Current_Supplier": f"Edited {n}-{r}"}}}
+                        db_utils.save_edits(base, edits, project_id, "procurement", changed_by=f"user{n}")
+                    elif kind == 2:
+                        db_utils.set_user_password(f"user{n}@example.com", f"secret{r}")
+                    else:
+                        db_utils.add_project(f"Writers {n}", frame[["StockCode", "Description"]].head(20))
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+            return errors
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            errors = [e for errs in pool.map(worker, range(threads)) for e in errs]
+        seconds = time.perf_counter() - start
+        stats = db_utils.writer_stats()
+        db_utils.close_connections()
+    for e in sorted(set(errors)):
+        print(f"ERROR x{errors.count(e)}: {e}")
+    print(f"{threads * rounds} writes from {threads} threads in {seconds:.2f} s: {len(errors)} errors, "
+          f"{stats['batches']} commits, largest batch {stats['max_batch']}")
+    return not errors
+
+
+def print_results(results):
+    for r in results:
+        print(f"{r['bench']:<22} {r['case']:<24} {r['rows']:>9,} rows  "
+              f"{r['seconds']:8.3f} s  {r['rows_per_sec']:>12,.0f} rows/s")
+
+
+def _option(args, name):
+    """Value of `--name path` in args (removing both), or None."""
+    if name in args:
+        i = args.index(name)
+        value = args[i + 1]
+        del args[i:i + 2]
+        return value
+    return None
+
+
+if __name__ == "__main__":
+    # python benchmarks.py [save|dates|startup|plans|writers] [sizes...]
+    # python benchmarks.py suite [sizes...] [--out results.json] [--baseline baseline.json]
+    args = sys.argv[1:]
+    out_path, baseline_path = _option(args, "--out"), _option(args, "--baseline")
+    command = args[0] if args and not args[0].isdigit() else "save"
+    sizes = [int(s) for s in args if s.isdigit()]
+    if command == "plans":
+        sys.exit(0 if check_plans() else 1)
+    elif command == "writers":
+        sys.exit(0 if check_writers(*sizes[:1]) else 1)
+    elif command == "suite":
+        results = bench_hot_paths(sizes or SUITE_SIZES)
+        print_results(results)
+        if out_path:
+            write_results(results, out_path)
+        if baseline_path:
+            regressions = compare(results, baseline_path)
+            for r, before in regressions:
+                print(f"REGRESSION: {r['bench']} {r['case']} at {r['rows']:,} rows: "
+                      f"{before:.3f} s -> {r['seconds']:.3f} s")
+            sys.exit(1 if regressions else 0)
+    elif command == "dates":
+        print_results(bench_dates(*sizes[:1]))
+    elif command == "startup":
+        print_results(bench_startup(*sizes[:1]))
+    else:
+        print_results(bench_save_table(sizes or SIZES))
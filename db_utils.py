@@ -1,167 +1,439 @@
+import hashlib
+import json
 import re
+import numbers
 import sqlite3
+import zlib
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from datetime import date, datetime
 import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
 import bcrypt
 
+import attachment_store
+import migrations
+import profiling
+import search
+
 DB_FILE = "projects.db"
 USERS_FILE = "users.xlsx"  # Optional seed file: columns = Email, Role, Password
 
+TABLE_SCHEMAS = {
+    "procurement": ["stockcode", "description", "current_supplier", "ac_coverage", "next_shortage_date"],
+    "industrialization": ["stockcode", "description", "new_supplier", "fai_delivery_date", "first_po_delivery_date"],
+    "quality": ["stockcode", "description", "fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status"],
+}
+DATE_COLUMNS = ["next_shortage_date", "fai_delivery_date", "first_po_delivery_date", "fitcheck_date"]
+STAGING_TABLE = "temp._save_staging"
+
+# ---------- Connections ----------
+
+POOL_SIZE = 8          # max concurrently open connections per database file
+POOL_TIMEOUT = 30      # seconds to wait for a free connection
+BUSY_TIMEOUT = 10      # seconds SQLite waits on a locked database
+CACHED_STATEMENTS = 256
+PRAGMAS = {
+    "journal_mode": "WAL",         # readers no longer block behind writers
+    "synchronous": "NORMAL",       # safe with WAL, avoids an fsync per commit
+    "cache_size": -64000,          # negative = KiB, i.e. ~64 MB page cache
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",        # staging tables and sorts stay off disk
+}
+
+
+def get_connection(path=None, read_only=False):
+    """Open a new tuned connection. Prefer `connection()` for reads and `write()` for writes."""
+    conn = sqlite3.connect(
+        path or DB_FILE,
+        timeout=BUSY_TIMEOUT,
+        check_same_thread=False,
+        isolation_level=None,  # transactions are explicit, see _Writer
+        cached_statements=CACHED_STATEMENTS,
+        factory=profiling.ProfiledConnection,  # per-statement timings, see profiling.py
+    )
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma}={value}")
+    if read_only:
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+class _ConnectionPool:
+    """Small bounded pool of tuned read-only connections to one database file."""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+    def acquire(self, timeout=POOL_TIMEOUT):
+        if not self._slots.acquire(timeout=timeout):
+            raise sqlite3.OperationalError(f"No free database connection after {timeout}s")
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return get_connection(self.path, read_only=True)
+        except Exception:
+            self._slots.release()
+            raise
 
-def get_connection():
-    return sqlite3.connect(DB_FILE, check_same_thread=False)
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._closed:
+                conn.close()
+            else:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.path != DB_FILE:
+            if _pool is not None:
+                _pool.close()
+            _pool = _ConnectionPool(DB_FILE)
+        return _pool
+
+
+def close_connections():
+    """Stop the writer and close all idle pooled connections (e.g. before deleting or swapping DB_FILE)."""
+    global _pool, _writer
+    with _pool_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@contextmanager
+def connection():
+    """Borrow a pooled read-only connection for the current thread; nested calls share it.
+
+    Inside a write() operation this is the writer's connection, so reads see the
+    operation's own uncommitted changes.
+    """
+    held = getattr(_local, "conn", None)
+    if held is not None:
+        yield held
+        return
+    pool = _get_pool()
+    conn = pool.acquire()
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        pool.release(conn)
 
 
-def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
+# ---------- Writes ----------
 
-    # ---- projects ----
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS projects (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL
-        )
-    """)
-
-    # ---- stock list (master) ----
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS stock_list (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            project_id INTEGER NOT NULL,
-            stockcode TEXT,
-            description TEXT,
-            FOREIGN KEY(project_id) REFERENCES projects(id),
-            UNIQUE(project_id, stockcode)
-        )
-    """)
-
-    # ---- procurement ----
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS procurement (
-            project_id INTEGER NOT NULL,
-            stockcode TEXT,
-            description TEXT,
-            current_supplier TEXT,
-            ac_coverage TEXT,
-            next_shortage_date TEXT,
-            FOREIGN KEY(project_id) REFERENCES projects(id),
-            UNIQUE(project_id, stockcode)
-        )
-    """)
-    cur.execute("""CREATE TABLE IF NOT EXISTS procurement_undo AS SELECT * FROM procurement WHERE 0;""")
-
-    # ---- industrialization ----
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS industrialization (
-            project_id INTEGER NOT NULL,
-            stockcode TEXT,
-            description TEXT,
-            new_supplier TEXT,
-            fai_delivery_date TEXT,
-            first_po_delivery_date TEXT,
-            FOREIGN KEY(project_id) REFERENCES projects(id),
-            UNIQUE(project_id, stockcode)
-        )
-    """)
-    cur.execute("""CREATE TABLE IF NOT EXISTS industrialization_undo AS SELECT * FROM industrialization WHERE 0;""")
-
-    # ---- quality ----
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS quality (
-            project_id INTEGER NOT NULL,
-            stockcode TEXT,
-            description TEXT,
-            fai_status TEXT DEFAULT 'Not Submitted',
-            fai_number TEXT,
-            fitcheck_ac TEXT,
-            fitcheck_date TEXT,
-            fitcheck_status TEXT DEFAULT '',
-            FOREIGN KEY(project_id) REFERENCES projects(id),
-            UNIQUE(project_id, stockcode)
-        )
-    """)
-    cur.execute("""CREATE TABLE IF NOT EXISTS quality_undo AS SELECT * FROM quality WHERE 0;""")
-
-    # ---- audit log (row-level history) ----
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS audit_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            project_id INTEGER,
-            table_name TEXT,
-            stockcode TEXT,
-            column_name TEXT,
-            old_value TEXT,
-            new_value TEXT,
-            changed_by TEXT,
-            changed_at TEXT
-        )
-    """)
-
-    # ---- attachments (BLOB storage) ----
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS attachments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            project_id INTEGER NOT NULL,
-            stockcode TEXT NOT NULL,
-            file_name TEXT NOT NULL,
-            file_data BLOB NOT NULL,
-            uploaded_by TEXT,
-            uploaded_at TEXT
-        )
-    """)
-
-    # ---- users (auth) ----
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            email TEXT PRIMARY KEY,
-            role TEXT NOT NULL,
-            password_hash TEXT NOT NULL
-        )
-    """)
+WRITE_BATCH_MAX = 64  # operations per group commit
+
+
+class _WriteOp:
+    def __init__(self, fn, args, kwargs, transactional):
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+        self.transactional = transactional
+        self.future = Future()
+        self.profiling = profiling.current_context()  # the submitter's script run, charged for the op
+
+
+class _Writer:
+    """The one thread that writes to a database file.
+
+    Operations are queued from any thread and run in order on the writer's own
+    connection. Whatever is queued when the writer becomes free (up to
+    WRITE_BATCH_MAX operations) runs in a single BEGIN IMMEDIATE ... COMMIT, each
+    operation inside its own SAVEPOINT, so a failing operation is rolled back
+    alone and the rest of the batch still commits. Futures resolve after the
+    commit, so a result is only reported once it is durable.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue()
+        self._pending = None
+        self.ops = self.batches = self.max_batch = 0
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, args=(), kwargs=None, transactional=True):
+        op = _WriteOp(fn, args, kwargs or {}, transactional)
+        self._queue.put(op)
+        return op.future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def is_writer_thread(self):
+        return threading.current_thread() is self._thread
+
+    def _next_batch(self):
+        first = self._pending or self._queue.get()
+        self._pending = None
+        if first is None or not first.transactional:
+            return [first]
+        batch = [first]
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                op = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if op is None or not op.transactional:
+                self._pending = op
+                break
+            batch.append(op)
+        return batch
+
+    def _run(self):
+        conn = get_connection(self.path)
+        _local.conn = conn  # connection() / write() inside an operation reuse it
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch[0] is None:
+                    return
+                if batch[0].transactional:
+                    self._run_batch(conn, batch)
+                else:
+                    self._run_alone(conn, batch[0])
+                self.ops += len(batch)
+                self.batches += 1
+                self.max_batch = max(self.max_batch, len(batch))
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _call(op, conn):
+        with profiling.attributed_to(op.profiling):
+            return op.fn(conn, *op.args, **op.kwargs)
+
+    def _run_alone(self, conn, op):
+        if not op.future.set_running_or_notify_cancel():
+            return
+        try:
+            op.future.set_result(self._call(op, conn))
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.rollback()
+            op.future.set_exception(e)
+
+    def _run_batch(self, conn, batch):
+        done = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+        except BaseException as e:
+            for op in batch:
+                if op.future.set_running_or_notify_cancel():
+                    op.future.set_exception(e)
+            return
+        for op in batch:
+            if not op.future.set_running_or_notify_cancel():
+                continue
+            conn.execute("SAVEPOINT write_op")
+            try:
+                result = self._call(op, conn)
+                conn.execute("RELEASE write_op")
+                done.append((op, result))
+            except BaseException as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK TO write_op")
+                    conn.execute("RELEASE write_op")
+                else:  # the operation ended the whole transaction, taking the earlier ones with it
+                    for earlier, _ in done:
+                        earlier.future.set_exception(sqlite3.OperationalError("Rolled back with a failed write"))
+                    done = []
+                    conn.execute("BEGIN IMMEDIATE")
+                op.future.set_exception(e)
+        try:
+            conn.commit()
+        except BaseException as e:
+            conn.rollback()
+            for op, _ in done:
+                op.future.set_exception(e)
+            return
+        for op, result in done:
+            op.future.set_result(result)
+
+    def stats(self):
+        return {"ops": self.ops, "batches": self.batches, "max_batch": self.max_batch,
+                "queued": self._queue.qsize()}
+
+
+_writer = None
+
+
+def _get_writer():
+    global _writer
+    with _pool_lock:
+        if _writer is None or _writer.path != DB_FILE:
+            if _writer is not None:
+                _writer.close()
+            _writer = _Writer(DB_FILE)
+        return _writer
+
+
+def submit_write(fn, *args, transactional=True, **kwargs):
+    """Queue `fn(conn, *args, **kwargs)` on the writer thread; returns a Future of its result.
 
-    conn.commit()
-    conn.close()
+    With transactional=False the operation runs alone, outside any transaction
+    (for statements that manage their own, such as migrations).
+    """
+    return _get_writer().submit(fn, args, kwargs, transactional)
+
+
+def write(fn, *args, transactional=True, **kwargs):
+    """Run `fn(conn, *args, **kwargs)` as one write operation and return its result once committed.
+
+    Called from inside another write operation, `fn` runs inline as part of it.
+    """
+    writer = _get_writer()
+    if writer.is_writer_thread():
+        return fn(_local.conn, *args, **kwargs)
+    return writer.submit(fn, args, kwargs, transactional).result()
+
+
+def writer_stats():
+    return _get_writer().stats()
+
+
+_init_lock = threading.Lock()
+_initialized_dbs = set()
+_users_file_seen = {}  # (db file, users file) -> (mtime_ns, size) at the last sync
 
-    # Auto-load users from Excel if available (idempotent)
-    if os.path.exists(USERS_FILE):
+
+@profiling.timed
+def init_db():
+    """Bring the schema up to date (see migrations.py), then sync users from USERS_FILE.
+
+    Cheap enough to call on every Streamlit rerun: the schema version is checked
+    once per process and database, and USERS_FILE is only re-imported when its
+    mtime or size changed and its content hash differs from the last import.
+    """
+    with _init_lock:
+        if DB_FILE not in _initialized_dbs:
+            with connection() as conn:
+                outdated = migrations.schema_version(conn) < migrations.LATEST_VERSION
+            if outdated:
+                # migrations manage their own transactions
+                for version, name in write(migrations.apply_migrations, transactional=False):
+                    print(f"✅ Applied schema migration {version}: {name}")
+            _initialized_dbs.add(DB_FILE)
+        sync_users_file()
+
+
+def sync_users_file(force=False):
+    """Import USERS_FILE if it changed since the last import (or always, with `force`). Returns True if imported."""
+    if not os.path.exists(USERS_FILE):
+        return False
+    stat = os.stat(USERS_FILE)
+    key, stamp = (DB_FILE, os.path.abspath(USERS_FILE)), (stat.st_mtime_ns, stat.st_size)
+    if not force and _users_file_seen.get(key) == stamp:
+        return False
+    with open(USERS_FILE, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    imported = False
+    with connection() as conn:
+        row = conn.execute("SELECT value FROM app_meta WHERE key='users_file_sha256'").fetchone()
+    if force or row is None or row[0] != digest:
         try:
-            df_users = pd.read_excel(USERS_FILE)
-            load_users_from_excel(df_users)
-            print("✅ Users loaded from Excel into database.")
+            # hashing happens outside the write transaction; only the writes hold the lock
+            report = load_users_from_excel(pd.read_excel(BytesIO(data)))
+            write(lambda conn: conn.execute("""
+                INSERT INTO app_meta (key, value) VALUES ('users_file_sha256', ?)
+                ON CONFLICT(key) DO UPDATE SET value=excluded.value
+            """, (digest,)))
+            imported = True
+            counts = ", ".join(f"{n} {status}" for status, n in report["status"].value_counts().items())
+            print(f"✅ Users loaded from Excel into database ({counts}).")
         except Exception as e:
             print(f"⚠️ Could not load users.xlsx: {e}")
+    # a broken file is retried only once it changes again
+    _users_file_seen[key] = stamp
+    return imported
+
+
+_startup_reported = False
+
+
+def report_cold_start(import_s, init_s, render_s):
+    """Print the cold-start timing breakdown once per process (main.py calls this after every run)."""
+    global _startup_reported
+    if _startup_reported:
+        return
+    _startup_reported = True
+    print(f"⏱️ Cold start: imports {import_s:.3f} s, DB init {init_s:.3f} s, first render {render_s:.3f} s")
 
 
 def reset_tables():
-    """Drop and recreate all tables (useful if schema changed)."""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.executescript("""
+    """Drop all tables and rebuild the schema from scratch. Wipes all data; schema changes belong in migrations.py."""
+    write(lambda conn: conn.executescript("""
         DROP TABLE IF EXISTS stock_list;
         DROP TABLE IF EXISTS procurement;
         DROP TABLE IF EXISTS industrialization;
         DROP TABLE IF EXISTS quality;
-        DROP TABLE IF EXISTS procurement_undo;
-        DROP TABLE IF EXISTS industrialization_undo;
-        DROP TABLE IF EXISTS quality_undo;
-        DROP TABLE IF EXISTS audit_log;
+        DROP TABLE IF EXISTS saves;
+        DROP TABLE IF EXISTS save_rows;
+        DROP TABLE IF EXISTS audit_changesets;
+        DROP TABLE IF EXISTS audit_changes;
+        DROP TABLE IF EXISTS audit_rollups;
         DROP TABLE IF EXISTS attachments;
+        DROP TABLE IF EXISTS attachment_blobs;
         DROP TABLE IF EXISTS users;
-    """)
-    conn.commit()
-    conn.close()
+        DROP TABLE IF EXISTS search_index;
+        DROP TABLE IF EXISTS app_meta;
+        DROP TABLE IF EXISTS project_view;
+        DROP TABLE IF EXISTS project_view_deletes;
+        DROP TABLE IF EXISTS jobs;
+        DROP TABLE IF EXISTS project_checkpoints;
+        DROP TABLE IF EXISTS portfolio_counts;
+        PRAGMA user_version = 0;
+    """), transactional=False)
+    clear_project_cache()
+    with _init_lock:
+        _initialized_dbs.discard(DB_FILE)
+        _users_file_seen.clear()
     init_db()
 
 
+def normalize_column_name(col) -> str:
+    norm = re.sub(r'[^a-z0-9]', '_', str(col).lower())
+    return re.sub(r'_+', '_', norm).strip('_')
+
+
 def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
-    col_map = {}
-    for col in df.columns:
-        norm = re.sub(r'[^a-z0-9]', '_', str(col).lower())
-        norm = re.sub(r'_+', '_', norm).strip('_')
-        col_map[col] = norm
-    df = df.rename(columns=col_map)
+    df = df.rename(columns={col: normalize_column_name(col) for col in df.columns})
 
     # normalize stockcodes
     if "stockcode" in df.columns:
@@ -186,303 +458,1652 @@ def try_date(x):
         return None
 
 
-def add_project(name, stockcodes_df=None):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO projects (name) VALUES (?)", (name,))
-    conn.commit()
+UNPARSED_DATES_SHOWN = 5    # examples printed per column when a save drops values that are not dates
+EXCEL_EPOCH = "1899-12-30"   # day 0 of Excel's 1900 date system
+EXCEL_MAX_SERIAL = 2958465   # 9999-12-31
 
-    cur.execute("SELECT id FROM projects WHERE name = ?", (name,))
-    pid = cur.fetchone()[0]
 
-    if stockcodes_df is not None:
-        stockcodes_df = normalize_columns(stockcodes_df)
-        for _, row in stockcodes_df.iterrows():
-            cur.execute("""
-                INSERT INTO stock_list (project_id, stockcode, description)
-                VALUES (?, ?, ?)
-                ON CONFLICT(project_id, stockcode) DO UPDATE SET
-                    description=excluded.description
-            """, (pid, row.get("stockcode"), row.get("description")))
-    conn.commit()
-    conn.close()
-    return pid
-
-
-def get_projects():
-    conn = get_connection()
-    df = pd.read_sql_query("SELECT id, name FROM projects ORDER BY id DESC", conn)
-    conn.close()
-    return df
+def _iso_dates(parsed):
+    """datetime64 Series -> 'YYYY-MM-DD' strings (None for NaT), without a per-cell Python call."""
+    if parsed.dt.tz is not None:
+        parsed = parsed.dt.tz_localize(None)  # keep the wall-clock date, like Timestamp.date()
+    days = parsed.to_numpy().astype("datetime64[D]").astype(str)
+    return pd.Series(days, index=parsed.index, dtype=object).where(parsed.notna(), None)
 
 
-def _fetch_existing_row_dict(conn, table_name, project_id, stockcode):
-    q = f"SELECT * FROM {table_name} WHERE project_id=? AND stockcode=?"
-    cur = conn.cursor()
-    cur.execute(q, (project_id, stockcode))
-    row = cur.fetchone()
-    if row is None:
+def _strptime_iso(x):
+    try:
+        return datetime.strptime(x.strip(), "%Y-%m-%d").date().isoformat()
+    except ValueError:
         return None
-    cols = [d[0] for d in cur.description]
-    return dict(zip(cols, row))
 
 
-def log_audit_changes(conn, project_id, table_name, stockcode, old_row, new_row, changed_by):
-    """Write one audit row per changed column."""
-    cur = conn.cursor()
-    now = datetime.utcnow().isoformat(timespec="seconds") + "Z"
-    for col, new_val in new_row.items():
-        if col in ["project_id", "stockcode"]:
-            continue
-        old_val = None if not old_row else old_row.get(col)
-        # normalize both to strings for comparison
-        if pd.isna(new_val) if isinstance(new_val, (float, pd.Series)) else new_val is None:
-            new_s = None
-        else:
-            new_s = str(new_val)
-        old_s = None if old_val is None else str(old_val)
-        if old_s != new_s:
-            cur.execute("""
-                INSERT INTO audit_log (
-                    project_id, table_name, stockcode, column_name,
-                    old_value, new_value, changed_by, changed_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (project_id, table_name, stockcode, col, old_s, new_s, changed_by or "unknown", now))
+def normalize_dates(values):
+    """Columnar `try_date`: normalize a Series of dates to ISO 'YYYY-MM-DD' strings.
 
+    ISO strings are parsed in one vectorized pass; only the cells that fail are
+    retried as date/datetime objects, Excel serial numbers, and finally any other
+    format pandas can read. Returns (dates, unparsed), where `dates` is aligned
+    with `values` (None for blanks and failures) and `unparsed` is a list of
+    (index label, original value) for non-blank cells that are not dates.
+    """
+    values = pd.Series(values).astype(object)
+    index = values.index
+    values = values.reset_index(drop=True)  # positional labels; the caller's index may repeat
+    out = pd.Series(None, index=values.index, dtype=object)
+    pending = values.notna()
+
+    # classify cells by Python type once; a column only holds a handful of types
+    kinds = values.map(type)
+
+    def of_kind(classes, exclude=()):
+        matched = [t for t in kinds.unique() if issubclass(t, classes) and not issubclass(t, exclude)]
+        return kinds.isin(matched) & pending
+
+    def fill(mask, dates):
+        out[mask[mask].index] = dates
+
+    # 1) ISO strings, the common case
+    is_str = of_kind(str)
+    if is_str.any():
+        parsed = pd.to_datetime(values[is_str].str.strip(), format="%Y-%m-%d", errors="coerce")
+        ok = parsed.notna()
+        fill(ok, _iso_dates(parsed[ok]))
+        pending[ok[ok].index] = False
+
+    # 2) date / datetime / Timestamp objects (e.g. openpyxl date cells)
+    is_dt = of_kind((date, np.datetime64))
+    if is_dt.any():
+        try:
+            fill(is_dt, _iso_dates(pd.to_datetime(values[is_dt], errors="coerce")))
+        except (TypeError, ValueError):  # e.g. mixed time zones
+            pass
+        retry = is_dt & out.isna()
+        if retry.any():
+            fill(retry, values[retry].map(try_date))
+        pending &= ~is_dt
+
+    # 3) numbers are Excel serial dates
+    is_num = of_kind(numbers.Number, exclude=bool)
+    if is_num.any():
+        serials = pd.to_numeric(values[is_num], errors="coerce")
+        serials = serials.where((serials >= 1) & (serials <= EXCEL_MAX_SERIAL))
+        fill(is_num, _iso_dates(pd.to_datetime(serials, unit="D", origin=EXCEL_EPOCH, errors="coerce")))
+        pending &= ~is_num
+
+    # 4) any other string format pandas understands
+    rest = pending & is_str
+    if rest.any():
+        try:
+            fill(rest, _iso_dates(pd.to_datetime(values[rest].str.strip(), format="mixed", errors="coerce")))
+            # ISO dates outside pandas' Timestamp range still parse with strptime
+            retry = rest & out.isna()
+            if retry.any():
+                fill(retry, values[retry].map(_strptime_iso))
+        except (TypeError, ValueError):  # e.g. mixed time zones: fall back to cell by cell
+            fill(rest, values[rest].map(try_date))
+
+    blank = pd.Series(False, index=values.index)
+    if is_str.any():
+        blank[is_str] = values[is_str].str.strip() == ""
+    failed = values.notna() & ~blank & out.isna()
+    unparsed = [(index[i], v) for i, v in values[failed].items()]
+    out = out.where(out.notna(), None)
+    out.index = index
+    return out, unparsed
+
+
+@profiling.timed
+def add_project(name, stockcodes_df=None, changed_by=None):
+    """Create (or reuse) a project and upsert its stock list.
+
+    `stockcodes_df` may be a DataFrame or an iterable of DataFrame chunks. New
+    items and changed descriptions are audited under table_name 'stock_list'
+    (a new item's diff includes stockcode: [None, code]). Chunks are read and
+    normalized on the calling thread; only the SQL runs on the writer.
+    """
+    frames = []
+    if stockcodes_df is not None:
+        chunks = [stockcodes_df] if isinstance(stockcodes_df, pd.DataFrame) else stockcodes_df
+        for chunk in chunks:
+            chunk = normalize_columns(chunk)
+            for col in ("stockcode", "description"):
+                if col not in chunk.columns:
+                    chunk[col] = None
+            frames.append(chunk[["stockcode", "description"]])
+
+    def apply(conn):
+        cur = conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO projects (name) VALUES (?)", (name,))
+
+        cur.execute("SELECT id FROM projects WHERE name = ?", (name,))
+        pid = cur.fetchone()[0]
+
+        if stockcodes_df is not None:
+            changeset_id = _begin_changeset(conn, pid, "stock_list", changed_by)
+            for frame in frames:
+                _load_staging(conn, "stock_list", frame)
+                cur.execute(f"""
+                    INSERT INTO audit_changes (changeset_id, project_id, stockcode, diff)
+                    SELECT :cs, :pid, staging.stockcode,
+                           CASE WHEN live.id IS NULL
+                                THEN json_object('stockcode', json_array(NULL, staging.stockcode),
+                                                 'description', json_array(NULL, staging.description))
+                                ELSE json_object('description', json_array(live.description, staging.description))
+                           END
+                    FROM {STAGING_TABLE} staging
+                    LEFT JOIN stock_list live ON live.project_id = :pid AND live.stockcode = staging.stockcode
+                    WHERE staging.stockcode IS NOT NULL
+                      AND (live.id IS NULL OR live.description IS NOT staging.description)
+                    ORDER BY staging.rowid
+                """, {"cs": changeset_id, "pid": pid})
+                cur.execute(f"""
+                    INSERT INTO stock_list (project_id, stockcode, description)
+                    SELECT ?, staging.stockcode, staging.description
+                    FROM {STAGING_TABLE} staging
+                    ORDER BY staging.rowid
+                    ON CONFLICT(project_id, stockcode) DO UPDATE SET
+                        description=excluded.description
+                    WHERE description IS NOT excluded.description
+                """, (pid,))
+                cur.execute(f"DROP TABLE {STAGING_TABLE}")
+            # only the items this upload added or re-described
+            search.reindex(conn, pid, f"SELECT stockcode FROM audit_changes WHERE changeset_id = {int(changeset_id)}")
+            _end_changeset(conn, changeset_id)
+        _bump_data_version(conn, pid)
+        _maybe_checkpoint(conn, pid)
+        return pid
+
+    return write(apply)
+
+
+@profiling.timed
+def get_projects():
+    with connection() as conn:
+        return pd.read_sql_query("SELECT id, name FROM projects ORDER BY id DESC", conn)
 
-def save_table(df, project_id, table_name, changed_by=None):
-    """UPSERT rows, saving current table state into undo before overwriting, and log audit."""
+
+def _prepare_frame(df, table_name):
+    """Normalize an uploaded/edited frame to the column layout of `table_name`."""
     df = normalize_columns(df)
 
-    schema = {
-        "procurement": ["stockcode", "description", "current_supplier", "ac_coverage", "next_shortage_date"],
-        "industrialization": ["stockcode", "description", "new_supplier", "fai_delivery_date", "first_po_delivery_date"],
-        "quality": ["stockcode", "description", "fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status"],
-    }
-    if table_name not in schema:
+    if table_name not in TABLE_SCHEMAS:
         raise ValueError(f"Unknown table {table_name}")
 
     # ensure required columns exist
-    for col in schema[table_name]:
+    for col in TABLE_SCHEMAS[table_name]:
         if col not in df.columns:
             df[col] = None
-    df = df[schema[table_name]]
+    df = df[TABLE_SCHEMAS[table_name]]
     df = df.drop_duplicates(subset=["stockcode"], keep="last")
 
-    # normalize dates
-    for col in ["next_shortage_date", "fai_delivery_date", "first_po_delivery_date", "fitcheck_date"]:
+    # normalize dates; cells that are not dates are saved blank, so say which
+    for col in DATE_COLUMNS:
         if col in df.columns:
-            df[col] = df[col].apply(try_date)
+            df[col], unparsed = normalize_dates(df[col])
+            if unparsed:
+                examples = ", ".join(repr(value) for _, value in unparsed[:UNPARSED_DATES_SHOWN])
+                print(f"⚠️ {table_name}.{col}: {len(unparsed)} value(s) are not dates and were saved blank ({examples})")
 
     # defaults
     if table_name == "quality":
         df["fai_status"] = df["fai_status"].fillna("Not Submitted")
         df["fitcheck_status"] = df["fitcheck_status"].fillna("")
 
-    conn = get_connection()
+    return df
+
+
+def _load_staging(conn, table_name, df):
+    """Bulk-load `df` into a temp table that shares the live table's column affinities."""
+    cols = list(df.columns)
     cur = conn.cursor()
+    cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE}")
+    cur.execute(f"CREATE TEMP TABLE _save_staging AS SELECT {', '.join(cols)} FROM {table_name} WHERE 0")
+    records = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    cur.executemany(
+        f"INSERT INTO {STAGING_TABLE} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+        records,
+    )
 
-    # save undo snapshot
-    cur.execute(f"DELETE FROM {table_name}_undo WHERE project_id=?", (project_id,))
-    cur.execute(f"INSERT INTO {table_name}_undo SELECT * FROM {table_name} WHERE project_id=?", (project_id,))
-
-    # upsert + audit
-    for _, row in df.iterrows():
-        # prepare upsert
-        row_tuple = tuple(row[col] for col in df.columns)
-        columns = ["project_id"] + list(df.columns)
-        placeholders = ", ".join("?" * len(columns))
-        updates = ", ".join([f"{c}=excluded.{c}" for c in df.columns if c not in ["stockcode"]])
-        sql = f"""
-            INSERT INTO {table_name} ({", ".join(columns)})
-            VALUES ({placeholders})
-            ON CONFLICT(project_id, stockcode) DO UPDATE SET {updates}
+
+def log_audit_changes(conn, changeset_id, project_id, table_name, columns):
+    """Write one packed diff per changed item, diffing the staging table against the live table.
+
+    `diff` is a JSON object {column: [old, new]} of the columns that changed.
+    """
+    diffs = " UNION ALL ".join(
+        f"""
+        SELECT staging.rowid AS r, {i} AS k, staging.stockcode AS stockcode, '{col}' AS column_name,
+               live.{col} AS old_value, staging.{col} AS new_value
+        FROM {STAGING_TABLE} staging
+        LEFT JOIN {table_name} live ON live.project_id = :pid AND live.stockcode = staging.stockcode
+        WHERE staging.stockcode IS NOT NULL AND staging.{col} IS NOT live.{col}
         """
+        for i, col in enumerate(columns) if col != "stockcode"
+    )
+    conn.execute(f"""
+        INSERT INTO audit_changes (changeset_id, project_id, stockcode, diff)
+        SELECT :cs, :pid, stockcode, json_group_object(column_name, json_array(old_value, new_value))
+        FROM (SELECT * FROM ({diffs}) ORDER BY r, k)
+        GROUP BY r
+        ORDER BY r
+    """, {"cs": changeset_id, "pid": project_id})
+
+
+def _row_json(table_name, alias):
+    """SQL expression packing a row's data columns into a JSON object (a before image)."""
+    cols = [c for c in TABLE_SCHEMAS[table_name] if c != "stockcode"]
+    return "json_object(" + ", ".join(f"'{c}', {alias}.{c}" for c in cols) + ")"
+
+
+def _save_frame(conn, df, project_id, table_name, save):
+    """Stage one prepared frame, audit its changes, record before images and upsert. Runs inside the caller's transaction."""
+    save_id, changeset_id = save
+    cols = list(df.columns)
+    changed = " OR ".join(f"staging.{c} IS NOT live.{c}" for c in cols if c != "stockcode")
+    updates = ", ".join(f"{c}=excluded.{c}" for c in cols if c != "stockcode")
+
+    _load_staging(conn, table_name, df)
+
+    # audit first: it needs the pre-upsert values of the live table
+    log_audit_changes(conn, changeset_id, project_id, table_name, cols)
+
+    # before images of the rows this save touches (NULL = row did not exist);
+    # OR IGNORE keeps the oldest image when a later chunk touches the same row again
+    conn.execute(f"""
+        INSERT OR IGNORE INTO save_rows (save_id, stockcode, before)
+        SELECT ?, staging.stockcode,
+               CASE WHEN live.stockcode IS NULL THEN NULL ELSE {_row_json(table_name, "live")} END
+        FROM {STAGING_TABLE} staging
+        LEFT JOIN {table_name} live ON live.project_id = ? AND live.stockcode = staging.stockcode
+        WHERE staging.stockcode IS NOT NULL AND (live.stockcode IS NULL OR {changed})
+    """, (save_id, project_id))
+
+    # upsert only rows that are new or differ from the live table
+    conn.execute(f"""
+        INSERT INTO {table_name} (project_id, {", ".join(cols)})
+        SELECT ?, {", ".join(f"staging.{c}" for c in cols)}
+        FROM {STAGING_TABLE} staging
+        LEFT JOIN {table_name} live ON live.project_id = ? AND live.stockcode = staging.stockcode
+        WHERE live.stockcode IS NULL OR {changed}
+        ORDER BY staging.rowid
+        ON CONFLICT(project_id, stockcode) DO UPDATE SET {updates}
+    """, (project_id, project_id))
+
+    search.reindex(conn, project_id, _touched_sql(save_id))
+    conn.execute(f"DROP TABLE {STAGING_TABLE}")
+
+
+def _touched_sql(save_id):
+    """Subquery of the staged stockcodes this save has touched (recorded in save_rows), for search.reindex."""
+    return f"""
+        SELECT staging.stockcode FROM {STAGING_TABLE} staging
+        JOIN save_rows s ON s.save_id = {int(save_id)} AND s.stockcode = staging.stockcode
+    """
 
-        # fetch old row for audit
-        old_row = _fetch_existing_row_dict(conn, table_name, project_id, row["stockcode"])
 
-        # execute upsert
-        cur.execute(sql, (project_id,) + row_tuple)
+def _utc_now():
+    return datetime.utcnow().isoformat(timespec="seconds") + "Z"
 
-        # fetch new row for audit (as dict)
-        new_row = _fetch_existing_row_dict(conn, table_name, project_id, row["stockcode"]) or {}
 
-        # log differences
-        log_audit_changes(conn, project_id, table_name, row["stockcode"], old_row, new_row, changed_by)
+def _begin_changeset(conn, project_id, table_name, changed_by, at=None):
+    """Open an audit changeset; returns its id."""
+    return conn.execute("""
+        INSERT INTO audit_changesets (project_id, table_name, changed_by, changed_at) VALUES (?, ?, ?, ?)
+    """, (project_id, table_name, changed_by or "unknown", at or _utc_now())).lastrowid
 
-    conn.commit()
-    conn.close()
 
+def _end_changeset(conn, changeset_id):
+    """Fill in an audit changeset's counts, or drop it if it recorded no changes."""
+    rows, changes = conn.execute("""
+        SELECT count(*), (SELECT count(*) FROM audit_changes c, json_each(c.diff) WHERE c.changeset_id = :cs)
+        FROM audit_changes WHERE changeset_id = :cs
+    """, {"cs": changeset_id}).fetchone()
+    if rows:
+        conn.execute("UPDATE audit_changesets SET row_count=?, change_count=? WHERE id=?", (rows, changes, changeset_id))
+    else:
+        conn.execute("DELETE FROM audit_changesets WHERE id=?", (changeset_id,))
 
-def undo_last_save(project_id, table_name):
-    """Restore last saved version of a table from its undo copy."""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(f"DELETE FROM {table_name} WHERE project_id=?", (project_id,))
-    cur.execute(f"""
-        INSERT INTO {table_name}
-        SELECT * FROM {table_name}_undo WHERE project_id=?
+
+def _begin_save(conn, project_id, table_name, changed_by):
+    """Open the undo changeset and the audit changeset for one save; returns (save_id, changeset_id)."""
+    changed_by = changed_by or "unknown"
+    now = _utc_now()
+    save_id = conn.execute("""
+        INSERT INTO saves (project_id, table_name, changed_by, saved_at) VALUES (?, ?, ?, ?)
+    """, (project_id, table_name, changed_by, now)).lastrowid
+    return save_id, _begin_changeset(conn, project_id, table_name, changed_by, now)
+
+
+def _end_save(conn, project_id, save):
+    """Fill in the audit header counts and drop changesets of a save that changed nothing."""
+    save_id, changeset_id = save
+    if not conn.execute("SELECT 1 FROM save_rows WHERE save_id=? LIMIT 1", (save_id,)).fetchone():
+        conn.execute("DELETE FROM saves WHERE id=?", (save_id,))
+    _end_changeset(conn, changeset_id)
+    _bump_data_version(conn, project_id)
+    _maybe_checkpoint(conn, project_id)
+
+
+@profiling.timed
+def save_table(df, project_id, table_name, changed_by=None):
+    """UPSERT rows, recording the touched rows' before images for undo, and log audit.
+
+    Rows go through a temp staging table, so the diff, upsert and audit are
+    each a single set-based statement regardless of the number of rows.
+    """
+    df = _prepare_frame(df, table_name)
+
+    def apply(conn):
+        save = _begin_save(conn, project_id, table_name, changed_by)
+        _save_frame(conn, df, project_id, table_name, save)
+        _end_save(conn, project_id, save)
+
+    write(apply)
+
+
+IMPORT_BATCH_ROWS = 5_000  # prepared rows per write operation of save_table_chunks
+
+
+@profiling.timed
+def save_table_chunks(chunks, project_id, table_name, changed_by=None, progress=None,
+                      batch_rows=IMPORT_BATCH_ROWS):
+    """Like save_table, but for an iterable of frames (e.g. importer.iter_excel_chunks), as one undoable save.
+
+    Chunks are read and normalized on the calling thread. The writer gets the
+    prepared frames about `batch_rows` rows per write operation, so other writes
+    run between batches and memory is bounded by the batch size.
+
+    The save is therefore not atomic: each batch commits on its own, readers can
+    see a save part-way through, and other users may edit rows in between. If
+    anything fails, the rows saved so far are reverted, except rows changed
+    since this save wrote them, which are left as they are (see _abort_save).
+    `progress(rows)` is called after each batch commits. Returns the number of
+    rows saved.
+    """
+    save = write(_begin_save, project_id, table_name, changed_by)
+    rows = 0
+    try:
+        batch = []
+        for chunk in chunks:
+            batch.append(_prepare_frame(chunk, table_name))
+            if sum(map(len, batch)) >= batch_rows:
+                rows += write(_save_batch, batch, project_id, table_name, save)
+                batch = []
+                if progress:
+                    progress(rows)
+        rows += write(_save_batch, batch, project_id, table_name, save)
+        write(_end_save, project_id, save)
+    except BaseException:
+        write(_abort_save, project_id, table_name, save, changed_by)
+        raise
+    if progress:
+        progress(rows)
+    return rows
+
+
+def _save_batch(conn, frames, project_id, table_name, save):
+    """One write operation of save_table_chunks: save prepared frames into the open save."""
+    if not conn.execute("SELECT 1 FROM saves WHERE id=?", (save[0],)).fetchone():
+        raise RuntimeError("The save was undone while it was still being written")
+    for df in frames:
+        _save_frame(conn, df, project_id, table_name, save)
+    _bump_data_version(conn, project_id)
+    return sum(map(len, frames))
+
+
+def _abort_save(conn, project_id, table_name, save, changed_by):
+    """Revert the batches a failed save_table_chunks already committed.
+
+    Other writes ran between those batches, so a row is only restored while it
+    still holds what this save wrote (its before image with the save's audited
+    new values applied); rows edited or deleted since are left alone.
+    """
+    save_id, changeset_id = save
+    _end_changeset(conn, changeset_id)
+    if not conn.execute("SELECT 1 FROM saves WHERE id=?", (save_id,)).fetchone():
+        return
+    cols = [c for c in TABLE_SCHEMAS[table_name] if c != "stockcode"]
+    changed = " OR ".join(f"live.{c} IS NOT json_extract(e.row, '$.{c}')" for c in cols)
+    skipped = conn.execute(f"""
+        DELETE FROM save_rows WHERE save_id = :save AND stockcode IN (
+            WITH wrote AS (
+                SELECT a.stockcode, j.key, json_extract(j.value, '$[1]') AS value,
+                       row_number() OVER (PARTITION BY a.stockcode, j.key ORDER BY a.id DESC) AS n
+                FROM audit_changes a, json_each(a.diff) j
+                WHERE a.changeset_id = :cs
+            ), written AS MATERIALIZED (
+                SELECT stockcode, json_group_object(key, value) AS patch FROM wrote WHERE n = 1 GROUP BY stockcode
+            ), expected AS (
+                SELECT s.stockcode, json_patch(coalesce(s.before, '{{}}'), coalesce(w.patch, '{{}}')) AS row
+                FROM save_rows s LEFT JOIN written w ON w.stockcode = s.stockcode
+                WHERE s.save_id = :save
+            )
+            SELECT e.stockcode FROM expected e
+            LEFT JOIN {table_name} live ON live.project_id = :pid AND live.stockcode = e.stockcode
+            WHERE live.stockcode IS NULL OR {changed}
+        )
+    """, {"cs": changeset_id, "save": save_id, "pid": project_id}).rowcount
+    if skipped:
+        print(f"⚠️ {table_name}: {skipped} row(s) changed by others during the failed import were left as they are")
+    _revert_save(conn, project_id, table_name, save_id, changed_by)
+
+
+def _delete_frame(conn, stockcodes, project_id, table_name, save):
+    """Delete rows, auditing their cleared columns and recording before images. Runs inside the caller's transaction."""
+    save_id, changeset_id = save
+    _load_staging(conn, table_name, pd.DataFrame({"stockcode": list(stockcodes)}))
+    live_rows = f"""
+        FROM {STAGING_TABLE} staging
+        JOIN {table_name} live ON live.project_id = :pid AND live.stockcode = staging.stockcode
+    """
+    # audit: every column that held a value is cleared
+    conn.execute(f"""
+        INSERT INTO audit_changes (changeset_id, project_id, stockcode, diff)
+        SELECT :cs, :pid, stockcode, diff FROM (
+            SELECT staging.rowid AS r, live.stockcode AS stockcode,
+                   (SELECT json_group_object(key, json_array(value, NULL))
+                    FROM json_each({_row_json(table_name, "live")}) WHERE value IS NOT NULL) AS diff
+            {live_rows}
+        )
+        WHERE diff <> '{{}}'
+        ORDER BY r
+    """, {"cs": changeset_id, "pid": project_id})
+    conn.execute(f"""
+        INSERT OR IGNORE INTO save_rows (save_id, stockcode, before)
+        SELECT :save, live.stockcode, {_row_json(table_name, "live")}
+        {live_rows}
+    """, {"save": save_id, "pid": project_id})
+    conn.execute(f"""
+        DELETE FROM {table_name}
+        WHERE project_id = ? AND stockcode IN (SELECT staging.stockcode FROM {STAGING_TABLE} staging)
     """, (project_id,))
-    conn.commit()
-    conn.close()
+    search.reindex(conn, project_id, _touched_sql(save_id))
+    conn.execute(f"DROP TABLE {STAGING_TABLE}")
 
 
-def get_project_data(project_id):
-    conn = get_connection()
-    query = """
-        SELECT 
-            sl.stockcode,
-            sl.description,
-
-            pr.current_supplier,
-            pr.ac_coverage,
-            pr.next_shortage_date,
-
-            ind.new_supplier,
-            ind.fai_delivery_date,
-            ind.first_po_delivery_date,
-
-            q.fai_status,
-            q.fai_number,
-            q.fitcheck_ac,
-            q.fitcheck_date,
-            q.fitcheck_status
-
-        FROM stock_list sl
-        LEFT JOIN procurement pr 
-            ON sl.project_id = pr.project_id AND sl.stockcode = pr.stockcode
-        LEFT JOIN industrialization ind 
-            ON sl.project_id = ind.project_id AND sl.stockcode = ind.stockcode
-        LEFT JOIN quality q 
-            ON sl.project_id = q.project_id AND sl.stockcode = q.stockcode
-        WHERE sl.project_id = ?
-    """
-    df = pd.read_sql_query(query, conn, params=(project_id,))
-    conn.close()
+@profiling.timed
+def save_edits(base, edits, project_id, table_name, changed_by=None):
+    """Save a st.data_editor edit state against the frame `base` the editor was showing.
 
+    `edits` is the editor's state: {"edited_rows": {position: {column: value}},
+    "added_rows": [{column: value}], "deleted_rows": [position]}. `base` must be
+    the very frame the editor was given (not a fresh read), since positions are
+    resolved to the stockcodes of its rows; only those rows are staged, audited
+    and recorded for undo, in one transaction, so the cost follows the number of
+    edits rather than the table size. Deleted rows are removed from `table_name`;
+    the item stays on the stock list. Returns the number of rows touched.
+    """
+    code_col = next(c for c in base.columns if normalize_column_name(c) == "stockcode")
+    deleted = sorted({int(pos) for pos in edits.get("deleted_rows", [])})
+    # edited rows keyed by the stockcode `base` showed at that position
+    edited = {}
+    for pos, changes in edits.get("edited_rows", {}).items():
+        if int(pos) not in deleted:
+            row = base.iloc[int(pos)]
+            edited.setdefault(row[code_col], row.to_dict()).update(changes)
+    rows = list(edited.values()) + [dict(row) for row in edits.get("added_rows", [])]
+    frame = pd.DataFrame(rows, columns=base.columns)
+    # added rows left without a stockcode have nothing to save under
+    frame = frame[frame[code_col].notna() & (frame[code_col].astype(str).str.strip() != "")]
+    deleted_codes = base[code_col].iloc[deleted].dropna().astype(str).str.strip().str.upper().unique()
+    if frame.empty and not len(deleted_codes):
+        return 0
+
+    frame = _prepare_frame(frame, table_name)
+
+    def apply(conn):
+        save = _begin_save(conn, project_id, table_name, changed_by)
+        if len(deleted_codes):
+            _delete_frame(conn, deleted_codes, project_id, table_name, save)
+        if not frame.empty:
+            _save_frame(conn, frame, project_id, table_name, save)
+        _end_save(conn, project_id, save)
+
+    write(apply)
+    return len(frame) + len(deleted_codes)
+
+
+@profiling.timed
+def undo_last_save(project_id, table_name, changed_by=None):
+    """Revert the newest not-yet-undone save of a table; call repeatedly to go further back.
+
+    Only the rows that save touched are restored, and the reverted values are
+    audited as a changeset of `changed_by`. Returns the number of rows
+    restored, or None if there is nothing left to undo.
+    """
+    if table_name not in TABLE_SCHEMAS:
+        raise ValueError(f"Unknown table {table_name}")
+
+    def apply(conn):
+        row = conn.execute("""
+            SELECT id FROM saves WHERE project_id=? AND table_name=? ORDER BY id DESC LIMIT 1
+        """, (project_id, table_name)).fetchone()
+        if row is None:
+            return None
+        return _revert_save(conn, project_id, table_name, row[0], changed_by)
+
+    return write(apply)
+
+
+def _revert_save(conn, project_id, table_name, save_id, changed_by):
+    """Restore the before images of one save, audit the revert and drop the save; returns the rows restored."""
+    cols = [c for c in TABLE_SCHEMAS[table_name] if c != "stockcode"]
+    updates = ", ".join(f"{c}=excluded.{c}" for c in cols)
+
+    # audit the revert: each touched row goes from its live values back to its before image
+    changeset_id = _begin_changeset(conn, project_id, table_name, changed_by)
+    conn.execute(f"""
+        INSERT INTO audit_changes (changeset_id, project_id, stockcode, diff)
+        SELECT :cs, :pid, stockcode, diff FROM (
+            SELECT s.stockcode AS stockcode,
+                   (SELECT json_group_object(key, json_array(value, json_extract(s.before, '$.' || key)))
+                    FROM json_each({_row_json(table_name, "live")})
+                    WHERE value IS NOT json_extract(s.before, '$.' || key)) AS diff
+            FROM save_rows s
+            LEFT JOIN {table_name} live ON live.project_id = :pid AND live.stockcode = s.stockcode
+            WHERE s.save_id = :save
+        )
+        WHERE diff <> '{{}}'
+        ORDER BY stockcode
+    """, {"cs": changeset_id, "pid": project_id, "save": save_id})
+    _end_changeset(conn, changeset_id)
+
+    # rows the save created
+    deleted = conn.execute(f"""
+        DELETE FROM {table_name}
+        WHERE project_id=? AND stockcode IN (SELECT stockcode FROM save_rows WHERE save_id=? AND before IS NULL)
+    """, (project_id, save_id)).rowcount
+    # rows the save modified
+    restored = conn.execute(f"""
+        INSERT INTO {table_name} (project_id, stockcode, {", ".join(cols)})
+        SELECT ?, stockcode, {", ".join(f"json_extract(before, '$.{c}')" for c in cols)}
+        FROM save_rows WHERE save_id=? AND before IS NOT NULL
+        ON CONFLICT(project_id, stockcode) DO UPDATE SET {updates}
+    """, (project_id, save_id)).rowcount
+
+    search.reindex(conn, project_id, f"SELECT stockcode FROM save_rows WHERE save_id = {int(save_id)}")
+    conn.execute("DELETE FROM save_rows WHERE save_id=?", (save_id,))
+    conn.execute("DELETE FROM saves WHERE id=?", (save_id,))
+    _bump_data_version(conn, project_id)
+    _maybe_checkpoint(conn, project_id)
+    return deleted + restored
+
+
+PROJECT_DATA_COLUMNS = [
+    "stockcode", "description",
+    "current_supplier", "ac_coverage", "next_shortage_date",
+    "new_supplier", "fai_delivery_date", "first_po_delivery_date", "overlap_days",
+    "fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status"
+]
+
+# project_view is the stock list joined with the three department tables,
+# maintained by triggers (migrations._project_view), overlap_days included
+PROJECT_DATA_SQL = f"""
+    SELECT {", ".join(PROJECT_DATA_COLUMNS)}
+    FROM project_view
+    WHERE project_id = ?
+    ORDER BY stockcode
+"""
+
+EXPORT_BATCH_ROWS = 10_000
+
+
+def _project_frame(df):
+    """Give project_view rows the get_project_data dtypes (overlap_days numeric, NaN when unknown)."""
     if df.empty:
-        cols = [
-            "stockcode", "description",
-            "current_supplier", "ac_coverage", "next_shortage_date",
-            "new_supplier", "fai_delivery_date", "first_po_delivery_date", "overlap_days",
-            "fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status"
-        ]
-        return pd.DataFrame(columns=cols)
-
-    df["overlap_days"] = (
-        pd.to_datetime(df["next_shortage_date"], errors="coerce")
-        - pd.to_datetime(df["first_po_delivery_date"], errors="coerce")
-    ).dt.days
-
-    return df[
-        [
-            "stockcode", "description",
-            "current_supplier", "ac_coverage", "next_shortage_date",
-            "new_supplier", "fai_delivery_date", "first_po_delivery_date", "overlap_days",
-            "fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status"
-        ]
+        return pd.DataFrame(columns=PROJECT_DATA_COLUMNS)
+    df["overlap_days"] = pd.to_numeric(df["overlap_days"])
+    return df
+
+
+def _project_rows(conn, where, params):
+    """project_view rows matching `where`, ordered like get_project_data and indexed by stock list id."""
+    df = pd.read_sql_query(f"""
+        SELECT id, {", ".join(PROJECT_DATA_COLUMNS)}
+        FROM project_view
+        WHERE {where}
+        ORDER BY stockcode
+    """, conn, params=params, index_col="id")
+    df.index.name = None
+    return _project_frame(df)
+
+
+def _load_project_data(conn, project_id):
+    return _project_rows(conn, "project_id = ?", (project_id,))
+
+
+def _project_changes(conn, project_id, since_seq):
+    """(seq, changed rows indexed by id, [(id, stockcode)] of deleted items) after `since_seq`.
+
+    The sequence is read first, so rows committed in between are included
+    rather than missed; applying them twice is harmless.
+    """
+    row = conn.execute("SELECT data_version FROM projects WHERE id=?", (project_id,)).fetchone()
+    seq = row[0] if row else 0
+    changed = _project_rows(conn, "project_id = ? AND change_seq > ?", (project_id, since_seq))
+    deleted = conn.execute("""
+        SELECT id, stockcode FROM project_view_deletes WHERE project_id=? AND change_seq > ?
+    """, (project_id, since_seq)).fetchall()
+    return seq, changed, deleted
+
+
+def _patch_project_frame(df, changed, deleted_ids):
+    """Apply changed rows and deletions (all keyed by stock list id) to an id-indexed project frame.
+
+    The result has the dtypes a cold load of the same rows would have.
+    """
+    # few changed rows often read as object; give them df's dtypes (integers widen to float as on a reload)
+    changed = changed.astype({c: df[c].dtype for c in PROJECT_DATA_COLUMNS
+                              if changed[c].dtype != df[c].dtype and df[c].dtype.kind not in "iub"})
+    updated = changed.index.intersection(df.index)
+    if len(updated):
+        df.loc[updated, PROJECT_DATA_COLUMNS] = changed.loc[updated, PROJECT_DATA_COLUMNS]
+    gone = df.index.intersection(deleted_ids)
+    if len(gone):
+        df = df.drop(index=gone)
+    added = changed.index.difference(df.index)
+    if len(added):
+        df = pd.concat([df, changed.loc[added]]).sort_values("stockcode", kind="stable", na_position="first")
+    # a cold load reads a text column as str, but as object while it is all NULL
+    for c in PROJECT_DATA_COLUMNS:
+        if df[c].dtype == object and df[c].notna().any():
+            df[c] = df[c].infer_objects()
+        elif df[c].dtype == "str" and df[c].isna().all():
+            df[c] = df[c].astype(object)
+    return df
+
+
+def iter_project_data(project_id, batch_rows=EXPORT_BATCH_ROWS):
+    """Yield the get_project_data frame in batches of at most `batch_rows`, streamed from one SELECT.
+
+    Bypasses the project cache, so memory stays bounded by the batch size.
+    """
+    with connection() as conn:
+        cur = conn.execute(PROJECT_DATA_SQL, (project_id,))
+        names = [d[0] for d in cur.description]
+        while True:
+            rows = cur.fetchmany(batch_rows)
+            if not rows:
+                break
+            yield _project_frame(pd.DataFrame.from_records(rows, columns=names))
+
+
+@profiling.timed
+def get_project_data(project_id):
+    """Joined project frame. Served from the process-wide cache until the project's data_version changes.
+
+    A cached frame of an older version is brought up to date with the rows
+    changed since (see get_project_changes) rather than reloaded, unless more
+    than PATCH_MAX_FRACTION of it changed. Reads inside a write operation see its
+    uncommitted rows, which may yet be rolled back, so they bypass the cache.
+    """
+    key = (DB_FILE, project_id)
+    with connection() as conn:
+        row = conn.execute("SELECT data_version FROM projects WHERE id=?", (project_id,)).fetchone()
+        if row is None or conn.in_transaction:
+            df = _load_project_data(conn, project_id)
+        else:
+            df = _project_cache.get(key, row[0])
+            if df is None:
+                df = _project_cache.put(key, row[0], _refresh_project_data(conn, key, project_id))
+    df.index = pd.RangeIndex(len(df))
+    return df
+
+
+PATCH_MAX_FRACTION = 0.5
+
+
+def _refresh_project_data(conn, key, project_id):
+    stale = _project_cache.latest(key)
+    if stale is not None and len(stale[1]):
+        version, df = stale
+        _, changed, deleted = _project_changes(conn, project_id, version)
+        if len(changed) + len(deleted) <= len(df) * PATCH_MAX_FRACTION:
+            _project_cache.patches += 1
+            return _patch_project_frame(df, changed, [i for i, _ in deleted])
+    return _load_project_data(conn, project_id)
+
+
+@profiling.timed
+def get_project_changes(project_id, since_seq=0):
+    """Rows of get_project_data changed since `since_seq`, to patch a frame loaded earlier.
+
+    Returns (changed, deleted, seq): `changed` holds the current version of every
+    item added or modified after `since_seq`, `deleted` the stockcodes of items
+    removed from the stock list, and `seq` is what to pass as `since_seq` next
+    time. since_seq=0 returns every row. The cost follows the number of changes,
+    not the project size.
+    """
+    with connection() as conn:
+        seq, changed, deleted = _project_changes(conn, project_id, since_seq)
+    return changed.reset_index(drop=True), [code for _, code in deleted], seq
+
+
+PAGE_SIZE = 200
+
+
+def _keyset_condition(column, descending, key):
+    """WHERE clause continuing an ORDER BY `column`, id walk after `key` = (value, id).
+
+    SQLite sorts NULLs first ascending and last descending; row values skip NULLs,
+    so those are handled explicitly.
+    """
+    value, row_id = key
+    if not descending:
+        if value is None:
+            return f"(({column} IS NULL AND id > ?) OR {column} IS NOT NULL)", [row_id]
+        return f"({column}, id) > (?, ?)", [value, row_id]
+    if value is None:
+        return f"({column} IS NULL AND id < ?)", [row_id]
+    return f"(({column}, id) < (?, ?) OR {column} IS NULL)", [value, row_id]
+
+
+@profiling.timed
+def get_project_page(project_id, table=None, sort="stockcode", descending=False, filters=None,
+                     after_key=None, limit=PAGE_SIZE):
+    """One page of a project's rows from project_view, keyset-paginated.
+
+    `table` picks the columns: a TABLE_SCHEMAS name, or None for all of
+    PROJECT_DATA_COLUMNS. Rows are ordered by `sort` (any PROJECT_DATA_COLUMNS
+    name), then by stock list id. `filters` maps column -> value for equality,
+    column -> (low, high) for an inclusive range (either end may be None), and
+    "search" -> filter-box text (see search.parse_query).
+
+    Returns (frame, next_key); pass `next_key` as `after_key` for the next page.
+    It is None on the last page.
+    """
+    if table is not None and table not in TABLE_SCHEMAS:
+        raise ValueError(f"Unknown table {table}")
+    if sort not in PROJECT_DATA_COLUMNS:
+        raise ValueError(f"Unknown sort column {sort}")
+    columns = TABLE_SCHEMAS[table] if table else PROJECT_DATA_COLUMNS
+
+    where, params = ["project_id = ?"], [project_id]
+    for column, value in (filters or {}).items():
+        if column == "search":
+            match = search.match_expression(project_id, value or "")
+            if match:
+                where.append("id IN (SELECT rowid FROM search_index WHERE search_index MATCH ?)")
+                params.append(match)
+        elif column not in PROJECT_DATA_COLUMNS:
+            raise ValueError(f"Unknown filter column {column}")
+        elif isinstance(value, tuple):
+            low, high = value
+            if low is not None:
+                where.append(f"{column} >= ?")
+                params.append(low)
+            if high is not None:
+                where.append(f"{column} <= ?")
+                params.append(high)
+        else:
+            where.append(f"{column} IS ?")
+            params.append(value)
+    if after_key is not None:
+        condition, key_params = _keyset_condition(sort, descending, after_key)
+        where.append(condition)
+        params += key_params
+
+    direction = "DESC" if descending else "ASC"
+    sql = f"""
+        SELECT id, {", ".join(dict.fromkeys([*columns, sort]))}
+        FROM project_view
+        WHERE {" AND ".join(where)}
+        ORDER BY {sort} {direction}, id {direction}
+        LIMIT ?
+    """
+    with connection() as conn:
+        df = pd.read_sql_query(sql, conn, params=[*params, int(limit)])
+    next_key = None
+    if len(df) == int(limit):
+        last = df.iloc[-1]
+        value = last[sort]
+        next_key = (None if pd.isna(value) else value.item() if hasattr(value, "item") else value, int(last["id"]))
+    if "overlap_days" in df.columns:
+        df["overlap_days"] = pd.to_numeric(df["overlap_days"])
+    return df[columns].reset_index(drop=True), next_key
+
+
+@profiling.timed
+def search_stockcodes(project_id, text, limit=None):
+    """Stockcodes matching a filter-box query (prefix terms, `column:term` scoping); see search.parse_query."""
+    with connection() as conn:
+        return search.search(conn, project_id, text, limit)
+
+
+# ---------- Project data cache ----------
+
+PROJECT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+def _bump_data_version(conn, project_id):
+    """Invalidate cached frames of a project; call inside the write transaction."""
+    conn.execute("UPDATE projects SET data_version = data_version + 1 WHERE id=?", (project_id,))
+
+
+def _shared(df):
+    """A frame that shares the cached data but whose changes never reach the cache.
+
+    Relies on pandas copy-on-write (the default from pandas 3, which
+    requirements.txt pins): a shallow copy is enough, since writes copy first.
+    """
+    return df.copy(deep=False)
+
+
+class _ProjectCache:
+    """LRU of project frames keyed by (db file, project id), each valid for one data_version."""
+
+    def __init__(self, max_bytes=PROJECT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (data_version, frame, nbytes)
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.patches = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return _shared(entry[1])
+
+    def latest(self, key):
+        """(version, frame) of whatever version of `key` is cached, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else (entry[0], _shared(entry[1]))
+
+    def put(self, key, version, df):
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            if nbytes <= self.max_bytes:
+                self._entries[key] = (version, df, nbytes)
+                self.bytes += nbytes
+                while self.bytes > self.max_bytes:
+                    _, (_, _, size) = self._entries.popitem(last=False)
+                    self.bytes -= size
+                    self.evictions += 1
+        return _shared(df)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "patches": self.patches,
+            }
+
+
+_project_cache = _ProjectCache()
+
+
+def project_cache_stats():
+    return _project_cache.stats()
+
+
+def clear_project_cache():
+    _project_cache.clear()
+
+
+# ---------- Portfolio ----------
+
+PORTFOLIO_HORIZONS = (30, 60, 90)  # days ahead for the shortage columns of get_portfolio_summary
+PORTFOLIO_STATUS_METRICS = ("fai_status", "fitcheck_status")
+
+
+@profiling.timed
+def get_portfolio_summary(today=None, horizons=PORTFOLIO_HORIZONS):
+    """One row per project: item count, negative overlaps and shortages overdue or due within each horizon.
+
+    Reads only portfolio_counts (kept current by triggers on project_view), so
+    the cost depends on the number of projects and shortage dates, not items.
+    Shortages are counted by date, so the windows move with `today` (default: the current date).
+    """
+    today = pd.Timestamp(today if today is not None else date.today()).normalize()
+    columns = [
+        "sum(CASE WHEN metric = 'items' THEN n ELSE 0 END) AS items",
+        "sum(CASE WHEN metric = 'negative_overlap' THEN n ELSE 0 END) AS negative_overlap",
+        "sum(CASE WHEN metric = 'shortage_date' AND bucket < ? THEN n ELSE 0 END) AS shortage_overdue",
     ]
+    params = [today.date().isoformat()]
+    for days in horizons:
+        columns.append(f"sum(CASE WHEN metric = 'shortage_date' AND bucket >= ? AND bucket < ? THEN n ELSE 0 END) "
+                       f"AS shortage_due_{int(days)}d")
+        params += [today.date().isoformat(), (today + pd.Timedelta(days=int(days))).date().isoformat()]
+    with connection() as conn:
+        counts = pd.read_sql_query(f"""
+            SELECT project_id, {", ".join(columns)}
+            FROM portfolio_counts
+            WHERE metric IN ('items', 'negative_overlap', 'shortage_date')
+            GROUP BY project_id
+        """, conn, params=params)
+        projects = pd.read_sql_query("SELECT id AS project_id, name AS project FROM projects ORDER BY name", conn)
+    df = projects.merge(counts, on="project_id", how="left")
+    value_columns = df.columns[2:]
+    df[value_columns] = df[value_columns].fillna(0).astype("int64")
+    return df
+
+
+@profiling.timed
+def get_portfolio_status_counts(metric="fai_status"):
+    """Items per project (rows) and status (columns) for a quality status column; '' is no status."""
+    if metric not in PORTFOLIO_STATUS_METRICS:
+        raise ValueError(f"Unknown status metric {metric}")
+    with connection() as conn:
+        df = pd.read_sql_query("""
+            SELECT p.name AS project, c.bucket AS status, c.n
+            FROM portfolio_counts c JOIN projects p ON p.id = c.project_id
+            WHERE c.metric = ? AND c.n <> 0
+        """, conn, params=(metric,))
+    return df.pivot_table(index="project", columns="status", values="n", aggfunc="sum", fill_value=0)
+
+
+# ---------- Shortage risk ----------
+
+RISK_HORIZON_DAYS = 90
+RISK_LIMIT = 1000
+# dates get_risk_items can window on, each with an indexed day-ordinal mirror (see migrations._day_ordinals)
+RISK_DATE_COLUMNS = ("next_shortage_date", "first_po_delivery_date")
+
+
+@profiling.timed
+def get_risk_items(project_id=None, within_days=RISK_HORIZON_DAYS, today=None, overdue=False,
+                   before_first_po=True, supplier=None, date_column="next_shortage_date", limit=RISK_LIMIT):
+    """At-risk items of one project (or all projects), soonest first.
+
+    Items whose `date_column` falls within `within_days` days of `today` (None: no
+    upper bound; with `overdue`, earlier dates too) and, with `before_first_po`,
+    whose next shortage comes before the first production PO delivery.
+    `supplier` matches the current or the new supplier. The window is a range
+    scan of the date's day-ordinal index, so the cost follows the items in it,
+    not the size of the projects.
+    """
+    if date_column not in RISK_DATE_COLUMNS:
+        raise ValueError(f"Unknown risk date column {date_column}")
+    day = migrations.DAY_COLUMNS[date_column]
+    today = pd.Timestamp(today if today is not None else date.today()).date().toordinal()
+    low = date.min.toordinal() if overdue else today
+    high = date.max.toordinal() if within_days is None else today + int(within_days)
+    where = [f"v.{day} BETWEEN ? AND ?"]
+    params = [today, low, high]
+    if project_id is not None:
+        where.append("v.project_id = ?")
+        params.append(int(project_id))
+    if before_first_po:
+        where.append("v.shortage_day < v.first_po_day")
+    if supplier:
+        where.append("? IN (v.current_supplier, v.new_supplier)")
+        params.append(supplier)
+    params.append(-1 if limit is None else int(limit))
+    with connection() as conn:
+        return pd.read_sql_query(f"""
+            SELECT v.project_id, p.name AS project, v.stockcode, v.description, v.current_supplier,
+                   v.new_supplier, v.next_shortage_date, v.first_po_delivery_date, v.overlap_days,
+                   v.shortage_day - ? AS days_to_shortage
+            FROM project_view v JOIN projects p ON p.id = v.project_id
+            WHERE {" AND ".join(where)}
+            ORDER BY v.{day}, v.project_id, v.stockcode
+            LIMIT ?
+        """, conn, params=params)
+
+
+# ---------- Audit log ----------
+
+AUDIT_PAGE_SIZE = 200          # changed items per page
+AUDIT_RETENTION_DAYS = 2 * 365  # prune_audit_log rolls older history up into audit_rollups
+
+AUDIT_COLUMNS = [
+    "changeset_id", "project_id", "table_name", "stockcode", "column_name",
+    "old_value", "new_value", "changed_by", "changed_at",
+]
+
+
+def _audit_time(value):
+    if isinstance(value, datetime):
+        return value.isoformat(timespec="seconds")
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+@profiling.timed
+def get_audit_page(project_id=None, stockcode=None, changed_by=None, since=None, until=None,
+                   table_name=None, after=None, limit=AUDIT_PAGE_SIZE):
+    """One page of audit history, newest first, one row per changed column.
+
+    Filters are optional and combine with AND; `since`/`until` bound changed_at
+    (inclusive / exclusive). Pages hold up to `limit` changed items. Returns
+    (frame, cursor): pass `cursor` as `after` for the next page; it is None on
+    the last page.
+    """
+    where, params = [], {"limit": int(limit)}
+    for column, value in [("c.project_id", project_id), ("c.stockcode", stockcode),
+                          ("h.changed_by", changed_by), ("h.table_name", table_name)]:
+        if value is not None:
+            key = column.split(".")[1]
+            where.append(f"{column} = :{key}")
+            params[key] = value
+    if since is not None:
+        where.append("h.changed_at >= :since")
+        params["since"] = _audit_time(since)
+    if until is not None:
+        where.append("h.changed_at < :until")
+        params["until"] = _audit_time(until)
+    if after is not None:
+        where.append("(c.changeset_id < :cs OR (c.changeset_id = :cs AND c.id < :cid))")
+        params["cs"], params["cid"] = after
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+
+    with connection() as conn:
+        items = conn.execute(f"""
+            SELECT c.id, c.changeset_id
+            FROM audit_changes c
+            JOIN audit_changesets h ON h.id = c.changeset_id
+            {where_sql}
+            ORDER BY c.changeset_id DESC, c.id DESC
+            LIMIT :limit
+        """, params).fetchall()
+        if not items:
+            return pd.DataFrame(columns=AUDIT_COLUMNS), None
+        df = pd.read_sql_query(f"""
+            SELECT h.id AS changeset_id, h.project_id, h.table_name, c.stockcode, json_each.key AS column_name,
+                   json_extract(json_each.value, '$[0]') AS old_value, json_extract(json_each.value, '$[1]') AS new_value,
+                   h.changed_by, h.changed_at
+            FROM audit_changes c
+            JOIN audit_changesets h ON h.id = c.changeset_id
+            JOIN json_each(c.diff)
+            WHERE c.id IN (SELECT value FROM json_each(?))
+            ORDER BY c.changeset_id DESC, c.id DESC, json_each.id
+        """, conn, params=(json.dumps([item[0] for item in items]),))
+    cursor = (items[-1][1], items[-1][0]) if len(items) == int(limit) else None
+    return df, cursor
+
+
+@profiling.timed
+def prune_audit_log(retention_days=AUDIT_RETENTION_DAYS):
+    """Roll audit history older than `retention_days` up into monthly audit_rollups and delete its details.
+
+    Projects are checkpointed at the cutoff first; get_project_data_as_of refuses
+    earlier timestamps afterwards. Returns the number of changesets rolled up.
+    """
+    cutoff = (datetime.utcnow() - pd.Timedelta(days=retention_days)).isoformat(timespec="seconds") + "Z"
+
+    def apply(conn):
+        # checkpoint every affected project as it stood at the cutoff, so as-of queries
+        # from the cutoff on still work without the deleted deltas
+        last_id = conn.execute("SELECT max(id) FROM audit_changesets WHERE changed_at < ?", (cutoff,)).fetchone()[0]
+        projects = conn.execute("SELECT DISTINCT project_id FROM audit_changesets WHERE changed_at < ?", (cutoff,))
+        for (pid,) in projects.fetchall():
+            _store_checkpoint(conn, pid, cutoff, last_id, _tables_as_of(conn, pid, cutoff))
+        conn.execute("DELETE FROM project_checkpoints WHERE taken_at < ?", (cutoff,))
+        conn.execute("""
+            INSERT INTO app_meta (key, value) VALUES ('audit_pruned_before', ?)
+            ON CONFLICT(key) DO UPDATE SET value = max(value, excluded.value)
+        """, (cutoff,))
+        conn.execute("""
+            INSERT INTO audit_rollups (project_id, table_name, changed_by, month, changesets, row_count, change_count)
+            SELECT project_id, table_name, coalesce(changed_by, 'unknown'), substr(changed_at, 1, 7),
+                   count(*), sum(row_count), sum(change_count)
+            FROM audit_changesets
+            WHERE changed_at < ?
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT(project_id, table_name, changed_by, month) DO UPDATE SET
+                changesets = changesets + excluded.changesets,
+                row_count = row_count + excluded.row_count,
+                change_count = change_count + excluded.change_count
+        """, (cutoff,))
+        conn.execute("""
+            DELETE FROM audit_changes
+            WHERE changeset_id IN (SELECT id FROM audit_changesets WHERE changed_at < ?)
+        """, (cutoff,))
+        return conn.execute("DELETE FROM audit_changesets WHERE changed_at < ?", (cutoff,)).rowcount
+
+    return write(apply)
+
+
+@profiling.timed
+def get_audit_rollups(project_id=None):
+    """Monthly change counts for history older than the retention window."""
+    sql = "SELECT * FROM audit_rollups"
+    params = ()
+    if project_id is not None:
+        sql += " WHERE project_id=?"
+        params = (project_id,)
+    with connection() as conn:
+        return pd.read_sql_query(sql + " ORDER BY month DESC, project_id, table_name, changed_by", conn, params=params)
+
+
+# ---------- Point-in-time history ----------
+
+CHECKPOINT_CHANGES = 20_000  # audited item changes between automatic checkpoints (at least the project's size)
+CHECKPOINT_COMPRESSION = 1   # zlib level; checkpoints are written inside a save, so favour speed
+
+# audited columns that feed project_view, per source table
+HISTORY_COLUMNS = {"stock_list": ["description"], **migrations.VIEW_SOURCES}
+ISO_DATE = r"\d{4}-\d{2}-\d{2}"
+
+
+def _live_tables(conn, project_id):
+    """{table: frame of HISTORY_COLUMNS indexed by stockcode} for a project's current rows."""
+    return {
+        table: pd.read_sql_query(f"""
+            SELECT stockcode, {", ".join(cols)} FROM {table} WHERE project_id = ? AND stockcode IS NOT NULL
+        """, conn, params=(project_id,), index_col="stockcode")
+        for table, cols in HISTORY_COLUMNS.items()
+    }
+
+
+def _encode_checkpoint(frames):
+    """Column-oriented JSON {table: {column: [values]}} of the table frames, zlib-compressed."""
+    doc = {
+        table: {"stockcode": df.index.tolist(),
+                **{c: df[c].astype(object).where(df[c].notna(), None).tolist() for c in df.columns}}
+        for table, df in frames.items()
+    }
+    return zlib.compress(json.dumps(doc, separators=(",", ":")).encode("utf-8"), CHECKPOINT_COMPRESSION)
+
+
+def _encode_live_checkpoint(conn, project_id):
+    """_encode_checkpoint of the project's current tables, with the JSON built by SQLite."""
+    parts = []
+    for table, cols in HISTORY_COLUMNS.items():
+        arrays = ", ".join(f"'{c}', json_group_array({c})" for c in ["stockcode", *cols])
+        doc = conn.execute(f"""
+            SELECT json_object({arrays}) FROM {table} WHERE project_id = ? AND stockcode IS NOT NULL
+        """, (project_id,)).fetchone()[0]
+        parts.append(f"{json.dumps(table)}:{doc}")
+    return zlib.compress(("{" + ",".join(parts) + "}").encode("utf-8"), CHECKPOINT_COMPRESSION)
+
+
+def _decode_checkpoint(data):
+    return {table: pd.DataFrame(cols, dtype=object).set_index("stockcode")
+            for table, cols in json.loads(zlib.decompress(data)).items()}
+
+
+def _store_checkpoint(conn, project_id, taken_at, changeset_id, frames=None):
+    """Checkpoint `frames` ({table: frame}), or the live tables if None."""
+    if frames is None:
+        data = _encode_live_checkpoint(conn, project_id)
+        rows = conn.execute("SELECT count(*) FROM stock_list WHERE project_id=?", (project_id,)).fetchone()[0]
+    else:
+        data, rows = _encode_checkpoint(frames), len(frames["stock_list"])
+    conn.execute("""
+        INSERT INTO project_checkpoints (project_id, taken_at, changeset_id, row_count, data) VALUES (?, ?, ?, ?, ?)
+    """, (project_id, taken_at, changeset_id or 0, rows, data))
+
+
+def _maybe_checkpoint(conn, project_id):
+    """Checkpoint the project once more audited changes piled up since the last checkpoint than
+    CHECKPOINT_CHANGES or the project's size, whichever is larger, so checkpoints cost at most
+    about one row per change."""
+    last_id, rows = conn.execute("""
+        SELECT coalesce(max(changeset_id), 0), coalesce(max(row_count), 0) FROM project_checkpoints WHERE project_id=?
+    """, (project_id,)).fetchone()
+    due = max(CHECKPOINT_CHANGES, rows)
+    pending = conn.execute("""
+        SELECT count(*) FROM (
+            SELECT 1 FROM audit_changes WHERE project_id=? AND changeset_id > ? LIMIT ?
+        )
+    """, (project_id, last_id, due)).fetchone()[0]
+    if pending >= due:
+        newest = conn.execute("SELECT max(id) FROM audit_changesets").fetchone()[0]
+        _store_checkpoint(conn, project_id, _utc_now(), newest)
+
+
+def _history_deltas(conn, project_id, first_id, last_id, forward):
+    """Per (table, stockcode, column), the value after the last (forward) or before the first
+    (backward) audited change in changesets first_id..last_id."""
+    pick, side = ("max", 1) if forward else ("min", 0)
+    return pd.read_sql_query(f"""
+        SELECT h.table_name, c.stockcode, json_each.key AS column_name,
+               json_extract(json_each.value, '$[{side}]') AS value, {pick}(c.id) AS change_id
+        FROM audit_changes c
+        JOIN audit_changesets h ON h.id = c.changeset_id
+        JOIN json_each(c.diff)
+        WHERE c.project_id = ? AND c.changeset_id BETWEEN ? AND ? AND c.stockcode IS NOT NULL
+        GROUP BY h.table_name, c.stockcode, json_each.key
+    """, conn, params=(project_id, first_id, last_id))
+
+
+def _apply_history(frames, deltas, forward):
+    for table, group in deltas.groupby("table_name"):
+        if table not in frames:
+            continue
+        df = frames[table]
+        if table == "stock_list" and not forward:
+            # items whose creation is being undone
+            created = group[(group["column_name"] == "stockcode") & group["value"].isna()]["stockcode"]
+            df = df.drop(index=df.index.intersection(created))
+            group = group[~group["stockcode"].isin(created)]
+        df = df.reindex(df.index.union(pd.Index(group["stockcode"].unique())))
+        group = group[group["column_name"].isin(df.columns)]
+        for column, changes in group.groupby("column_name"):
+            df.loc[changes["stockcode"].values, column] = changes["value"].values
+        frames[table] = df
+    return frames
+
+
+def _tables_as_of(conn, project_id, at):
+    """The project's HISTORY_COLUMNS tables just before `at` (an audit changed_at string).
+
+    Starts from the newest checkpoint taken before `at` and replays the changes
+    after it, or else from the first checkpoint after `at` (or the live tables)
+    and reverts the changes made since `at`.
+    """
+    before = conn.execute("""
+        SELECT changeset_id, data FROM project_checkpoints WHERE project_id=? AND taken_at < ?
+        ORDER BY taken_at DESC LIMIT 1
+    """, (project_id, at)).fetchone()
+    if before is not None:
+        last_id = conn.execute("SELECT max(id) FROM audit_changesets WHERE changed_at < ?", (at,)).fetchone()[0]
+        deltas = _history_deltas(conn, project_id, before[0] + 1, last_id or 0, forward=True)
+        return _apply_history(_decode_checkpoint(before[1]), deltas, forward=True)
+
+    after = conn.execute("""
+        SELECT changeset_id, data FROM project_checkpoints WHERE project_id=? AND taken_at >= ?
+        ORDER BY taken_at LIMIT 1
+    """, (project_id, at)).fetchone()
+    if after is not None:
+        last_id, frames = after[0], _decode_checkpoint(after[1])
+    else:
+        last_id = conn.execute("SELECT max(id) FROM audit_changesets").fetchone()[0] or 0
+        frames = _live_tables(conn, project_id)
+    first_id = conn.execute("SELECT min(id) FROM audit_changesets WHERE changed_at >= ?", (at,)).fetchone()[0]
+    deltas = _history_deltas(conn, project_id, first_id or last_id + 1, last_id, forward=False)
+    return _apply_history(frames, deltas, forward=False)
+
+
+def _iso_days(values):
+    """Dates of valid ISO date strings, NaT otherwise (as migrations._julian_day treats them)."""
+    text = values.astype(object).where(values.notna(), "").astype(str).str.slice(0, 10)
+    return pd.to_datetime(text.where(text.str.fullmatch(ISO_DATE)), format="%Y-%m-%d", errors="coerce")
+
+
+def _view_from_tables(frames):
+    """get_project_data's frame from HISTORY_COLUMNS tables, joined and computed like project_view."""
+    df = frames["stock_list"][["description"]]
+    for table, cols in migrations.VIEW_SOURCES.items():
+        df = df.join(frames[table].reindex(columns=cols))
+    df = df.rename_axis("stockcode").reset_index().sort_values("stockcode", kind="stable")
+    df["overlap_days"] = (_iso_days(df["next_shortage_date"]) - _iso_days(df["first_po_delivery_date"])).dt.days
+    return _project_frame(df[PROJECT_DATA_COLUMNS].reset_index(drop=True))
+
+
+@contextmanager
+def _read_snapshot(conn):
+    """Run the enclosed reads against one snapshot of the database (inside a write they already are)."""
+    if conn.in_transaction:
+        yield
+        return
+    conn.execute("BEGIN")
+    try:
+        yield
+    finally:
+        conn.rollback()
+
+
+@profiling.timed
+def get_project_data_as_of(project_id, timestamp):
+    """The get_project_data frame as it was just before `timestamp` (UTC datetime, date or ISO string).
+
+    Rebuilt from the nearest checkpoint plus the audit deltas between it and
+    `timestamp`, so the cost follows the changes since the checkpoint rather
+    than the project's whole history. Items without a stockcode are left out.
+    Raises ValueError for timestamps before audit history that was pruned.
+    """
+    at = pd.Timestamp(timestamp)
+    if at.tzinfo is not None:
+        at = at.tz_convert("UTC").tz_localize(None)
+    at = at.isoformat(timespec="seconds") + "Z"
+    with connection() as conn, _read_snapshot(conn):
+        pruned = conn.execute("SELECT value FROM app_meta WHERE key = 'audit_pruned_before'").fetchone()
+        if pruned and at < pruned[0]:
+            raise ValueError(f"Audit history before {pruned[0]} has been pruned")
+        frames = _tables_as_of(conn, project_id, at)
+    return _view_from_tables(frames)
 
 
 # ---------- Attachments ----------
 
-def save_attachment(project_id: int, stockcode: str, filename: str, file_bytes: bytes, uploaded_by: str):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO attachments (project_id, stockcode, file_name, file_data, uploaded_by, uploaded_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (project_id, stockcode.upper().strip(), filename, sqlite3.Binary(file_bytes), uploaded_by or "unknown",
-          datetime.utcnow().isoformat(timespec="seconds") + "Z"))
-    conn.commit()
-    conn.close()
+def _attachment_store():
+    return attachment_store.get_store(DB_FILE)
+
 
+@profiling.timed
+def save_attachment(project_id: int, stockcode: str, filename: str, file_bytes, uploaded_by: str):
+    """Store the payload once per SHA-256 in the attachment store and reference it from `attachments`.
 
+    `file_bytes` may be bytes or a readable file object (e.g. a Streamlit upload), which
+    is streamed in attachment_store.CHUNK_SIZE pieces. Raises attachment_store.AttachmentTooLarge
+    (a ValueError) above attachment_store.MAX_FILE_BYTES.
+    """
+    store = _attachment_store()
+    staged = store.stage(file_bytes, max_bytes=attachment_store.MAX_FILE_BYTES)
+    try:
+        def apply(conn):
+            store.commit(staged)
+            conn.execute("""
+                INSERT INTO attachment_blobs (sha256, size, refcount) VALUES (?, ?, 1)
+                ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1
+            """, (staged.sha256, staged.size))
+            cur = conn.execute("""
+                INSERT INTO attachments (project_id, stockcode, file_name, sha256, size, uploaded_by, uploaded_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (project_id, stockcode.upper().strip(), filename, staged.sha256, staged.size, uploaded_by or "unknown",
+                  datetime.utcnow().isoformat(timespec="seconds") + "Z"))
+            return cur.lastrowid
+
+        return write(apply)
+    finally:
+        store.discard(staged)
+
+
+@profiling.timed
 def get_attachments(project_id: int, stockcode: str):
-    conn = get_connection()
-    df = pd.read_sql_query("""
-        SELECT id, file_name, uploaded_by, uploaded_at
-        FROM attachments
-        WHERE project_id=? AND stockcode=?
-        ORDER BY uploaded_at DESC
-    """, conn, params=(project_id, stockcode.upper().strip()))
-    conn.close()
-    return df
+    with connection() as conn:
+        return pd.read_sql_query("""
+            SELECT id, file_name, uploaded_by, uploaded_at
+            FROM attachments
+            WHERE project_id=? AND stockcode=?
+            ORDER BY uploaded_at DESC
+        """, conn, params=(project_id, stockcode.upper().strip()))
 
 
+@profiling.timed
 def get_attachment_blob(attach_id: int):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT file_name, file_data FROM attachments WHERE id=?", (attach_id,))
-    row = cur.fetchone()
-    conn.close()
+    """(file_name, bytes) of an attachment. Loads the whole payload; prefer open_attachment / iter_attachment."""
+    with open_attachment(attach_id) as (name, f):
+        return (name, f.read()) if f else (None, None)
+
+
+@contextmanager
+def open_attachment(attach_id: int):
+    """Yield (file_name, readable binary file) for an attachment, or (None, None) if it does not exist."""
+    with connection() as conn:
+        row = conn.execute("SELECT file_name, sha256 FROM attachments WHERE id=?", (attach_id,)).fetchone()
     if not row:
-        return None, None
-    return row[0], row[1]
+        yield None, None
+        return
+    with _attachment_store().open(row[1]) as f:
+        yield row[0], f
+
+
+def iter_attachment(attach_id: int, chunk_size: int = attachment_store.CHUNK_SIZE):
+    """Yield an attachment's payload in `chunk_size` pieces, so memory per download is bounded."""
+    with open_attachment(attach_id) as (_, f):
+        if f:
+            yield from iter(lambda: f.read(chunk_size), b"")
+
+
+@profiling.timed
+def delete_attachment(attach_id: int):
+    """Remove an attachment; its payload is deleted when no other attachment references it."""
+    store = _attachment_store()
+
+    def apply(conn):
+        row = conn.execute("SELECT sha256 FROM attachments WHERE id=?", (attach_id,)).fetchone()
+        if not row:
+            return
+        conn.execute("DELETE FROM attachments WHERE id=?", (attach_id,))
+        conn.execute("UPDATE attachment_blobs SET refcount = refcount - 1 WHERE sha256=?", (row[0],))
+        deleted = conn.execute("DELETE FROM attachment_blobs WHERE sha256=? AND refcount <= 0", (row[0],)).rowcount
+        return row[0] if deleted else None
+
+    sha256 = write(apply)
+    if sha256:
+        # the payload goes only once the delete has committed
+        write(_delete_unreferenced_files, store, [sha256], transactional=False)
+
+
+def _delete_unreferenced_files(conn, store, hashes):
+    """Unlink the payloads among `hashes` that no attachment_blobs row references; returns the count.
+
+    Runs as a non-transactional write, alone on the writer thread: it sees only
+    committed rows, and no upload of the same payload can run in between.
+    """
+    purged = 0
+    for sha256 in hashes:
+        if not conn.execute("SELECT 1 FROM attachment_blobs WHERE sha256=?", (sha256,)).fetchone():
+            store.delete(sha256)
+            purged += 1
+    return purged
+
+
+@profiling.timed
+def purge_orphan_attachment_files():
+    """Delete stored payloads no attachment references (e.g. left by a rolled-back upload). Returns the count."""
+    store = _attachment_store()
+    return write(_delete_unreferenced_files, store, list(store.iter_hashes()), transactional=False)
 
 
 # ---------- Users (Auth) ----------
 
-def load_users_from_excel(df):
-    """Insert or update users from an Excel DataFrame."""
-    conn = get_connection()
-    cur = conn.cursor()
+USER_IMPORT_SERIAL_MAX = 4  # below this many bcrypt jobs, starting a process pool costs more than it saves
+
+
+def _bcrypt_job(job):
+    """(password, stored_hash) -> (hash to store, error). The hash is None when
+    `stored_hash` already verifies the password. Runs in a pool worker."""
+    password, stored_hash = job
+    try:
+        password = password.encode("utf-8")
+        if stored_hash and bcrypt.checkpw(password, stored_hash.encode("utf-8")):
+            return None, None
+        return bcrypt.hashpw(password, bcrypt.gensalt()).decode("utf-8"), None
+    except Exception as e:
+        return None, str(e) or type(e).__name__
+
+
+def _run_bcrypt_jobs(jobs):
+    """Run bcrypt jobs in order, across a process pool sized to the cores when there are enough of them."""
+    if len(jobs) <= USER_IMPORT_SERIAL_MAX:
+        return [_bcrypt_job(job) for job in jobs]
+    workers = min(os.cpu_count() or 1, len(jobs))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_bcrypt_job, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
 
-    for _, row in df.iterrows():
-        email = str(row.get("Email", "")).strip().lower()
-        role = str(row.get("Role", "")).strip().lower()
-        password = str(row.get("Password", "")).strip()
 
+def _cell(row, column):
+    value = row.get(column, "")
+    return "" if pd.isna(value) else str(value).strip()
+
+
+@profiling.timed
+def load_users_from_excel(df):
+    """Insert or update users from an Excel DataFrame (columns Email, Role, Password).
+
+    Passwords that already verify against the stored hash are not re-hashed; the
+    rest are hashed in parallel, and all changes are written in one transaction.
+    Returns a per-row report: row (Excel row number), email, status (created,
+    updated, unchanged, skipped or failed) and error.
+    """
+    report, users = [], {}
+    for pos, (_, row) in enumerate(df.iterrows()):
+        email, role, password = _cell(row, "Email").lower(), _cell(row, "Role").lower(), _cell(row, "Password")
+        entry = {"row": pos + 2, "email": email, "status": None, "error": None}
+        report.append(entry)
         if not email or not password:
+            entry.update(status="skipped", error="missing email or password")
             continue
+        if email in users:
+            # the last row for an email wins
+            users[email][0].update(status="skipped", error=f"superseded by row {pos + 2}")
+        users[email] = (entry, role, password)
+
+    with connection() as conn:
+        existing = {
+            email: (role, password_hash)
+            for email, role, password_hash in conn.execute(
+                "SELECT email, role, password_hash FROM users WHERE email IN (SELECT value FROM json_each(?))",
+                (json.dumps(list(users)),),
+            )
+        }
+
+    emails = list(users)
+    results = _run_bcrypt_jobs([(users[e][2], existing.get(e, (None, None))[1]) for e in emails])
+
+    writes = []
+    for email, (hashed, error) in zip(emails, results):
+        entry, role, _ = users[email]
+        old_role, old_hash = existing.get(email, (None, None))
+        if error:
+            entry.update(status="failed", error=error)
+        elif hashed is None and role == old_role:
+            entry["status"] = "unchanged"
+        else:
+            writes.append((email, role, hashed or old_hash))
+            entry["status"] = "updated" if email in existing else "created"
 
-        hashed = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-
-        cur.execute("""
+    def apply(conn):
+        conn.executemany("""
             INSERT INTO users (email, role, password_hash)
             VALUES (?, ?, ?)
             ON CONFLICT(email) DO UPDATE SET
                 role=excluded.role,
                 password_hash=excluded.password_hash
-        """, (email, role, hashed))
+        """, writes)
 
-    conn.commit()
-    conn.close()
+    write(apply)
+    return pd.DataFrame(report, columns=["row", "email", "status", "error"])
 
 
 def reload_users_from_excel():
-    """Reload users.xlsx into the users table."""
-    if os.path.exists(USERS_FILE):
-        try:
-            df_users = pd.read_excel(USERS_FILE)
-            load_users_from_excel(df_users)
-            print("✅ Users reloaded from Excel.")
-        except Exception as e:
-            print(f"⚠️ Could not reload users.xlsx: {e}")
+    """Reload users.xlsx into the users table, even if it has not changed since the last import."""
+    return sync_users_file(force=True)
 
 
+@profiling.timed
 def get_user_credentials(email):
     """Fetch role and hashed password for login check."""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT role, password_hash FROM users WHERE email=?", (email.lower(),))
-    row = cur.fetchone()
-    conn.close()
+    with connection() as conn:
+        row = conn.execute("SELECT role, password_hash FROM users WHERE email=?", (email.lower(),)).fetchone()
     return row if row else None
 
 
+@profiling.timed
 def list_users():
-    conn = get_connection()
-    df = pd.read_sql_query("SELECT email, role FROM users ORDER BY role, email", conn)
-    conn.close()
-    return df
+    with connection() as conn:
+        return pd.read_sql_query("SELECT email, role FROM users ORDER BY role, email", conn)
 
 
+@profiling.timed
 def set_user_password(email: str, new_password: str):
-    conn = get_connection()
-    cur = conn.cursor()
     hashed = bcrypt.hashpw(new_password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
-    cur.execute("UPDATE users SET password_hash=? WHERE email=?", (hashed, email.lower()))
-    conn.commit()
-    conn.close()
+
+    def apply(conn):
+        conn.execute("UPDATE users SET password_hash=? WHERE email=?", (hashed, email.lower()))
+
+    write(apply)
+
+
+# ---------- Query plans ----------
+
+# Tables a hot path may legitimately read end to end, with or without a covering
+# index: the project picker lists every project, save_table has to read every
+# staged input row and list_users lists every user.
+FULL_SCAN_ALLOWED = {"projects", "staging", "users"}
+# table-valued functions walk one JSON value, not a table
+TABLE_FUNCTIONS = ("json_each", "json_tree")
+
+
+def _is_full_scan(detail):
+    # a SCAN reads the whole table or index, covering or not
+    if not detail.startswith("SCAN "):
+        return False
+    if detail.split()[1] in TABLE_FUNCTIONS:
+        return False
+    if "VIRTUAL TABLE INDEX" in detail:
+        # FTS5 reports "INDEX <n>:<constraints>"; an empty constraint list reads the whole table
+        return detail.rsplit(":", 1)[-1].strip() == ""
+    target = detail.split()[1]
+    return target not in FULL_SCAN_ALLOWED and not target.startswith(("(", "CONSTANT"))
+
+
+def _explain(conn, statements):
+    rows = []
+    for sql in dict.fromkeys(statements):
+        verb = sql.lstrip().split(None, 1)[0].upper()
+        if verb not in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH"):
+            continue
+        for _, _, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+            rows.append({"sql": " ".join(sql.split()), "plan": detail, "full_scan": _is_full_scan(detail)})
+    return rows
+
+
+class _Discard(Exception):
+    """Raised by a write operation to roll back its own changes."""
+
+
+def check_query_plans():
+    """EXPLAIN QUERY PLAN every statement issued by the db_utils hot paths.
+
+    The paths run against a scratch project inside one write operation that is
+    rolled back, so the database is left untouched. Returns one row per plan step with a
+    `full_scan` flag; a healthy schema has no flagged rows.
+    """
+    plans = []
+    statements = []
+
+    def apply(conn):
+        try:
+            pid = add_project("__query_plan_check__", pd.DataFrame({"stockcode": ["PLAN-1"], "description": ["x"]}))
+            # one audited save, so the audit page reads have rows to expand
+            save_table(pd.DataFrame({"stockcode": ["PLAN-1"], "description": ["y"]}), pid, "quality", "plan-check")
+            conn.set_trace_callback(statements.append)
+            get_projects()
+            get_project_data(pid)
+            get_project_changes(pid, 1)
+            get_project_data_as_of(pid, "2000-01-01")
+            get_portfolio_summary()
+            get_portfolio_status_counts()
+            get_risk_items()
+            get_risk_items(pid, within_days=None, overdue=True, supplier="plan")
+            get_risk_items(date_column="first_po_delivery_date", before_first_po=False)
+            get_attachments(pid, "PLAN-1")
+            get_attachment_blob(0)
+            delete_attachment(0)
+            search_stockcodes(pid, "supplier:plan x")
+            get_project_page(pid, "procurement", filters={"search": "plan"}, after_key=("PLAN-0", 0))
+            get_project_page(pid, sort="overlap_days", descending=True, after_key=(3, 0))
+            get_audit_page(project_id=pid)
+            get_audit_page(stockcode="PLAN-1", after=(1, 1))
+            _store_checkpoint(conn, pid, _utc_now(), 0)
+            get_project_data_as_of(pid, "2999-01-01")
+            get_audit_page(project_id=pid, changed_by="plan-check", since="2000-01-01")
+            get_user_credentials("plan@check")
+            list_users()
+            conn.set_trace_callback(None)
+            plans.extend(_explain(conn, statements))
+
+            for table_name, cols in TABLE_SCHEMAS.items():
+                statements.clear()
+                frame = pd.DataFrame([{c: None for c in cols} | {"stockcode": "PLAN-1"}])
+                conn.set_trace_callback(statements.append)
+                save_table(frame, pid, table_name, changed_by="plan-check")
+                save_edits(frame, {"added_rows": [{"stockcode": "PLAN-2"}], "deleted_rows": [0]},
+                           pid, table_name, changed_by="plan-check")
+                undo_last_save(pid, table_name)
+                undo_last_save(pid, table_name)
+                conn.set_trace_callback(None)
+                # save_table drops its staging table; recreate it so the plans can be explained
+                _load_staging(conn, table_name, frame[cols])
+                plans.extend(_explain(conn, statements))
+            raise _Discard()  # roll the scratch project back
+        finally:
+            conn.set_trace_callback(None)
+
+    try:
+        write(apply)
+    except _Discard:
+        pass
+    return pd.DataFrame(plans, columns=["sql", "plan", "full_scan"])
@@ -0,0 +1,144 @@
+"""Streaming export of project data to XLSX, CSV and Parquet, plus the cached upload templates.
+
+Rows are read from SQLite in batches (db_utils.iter_project_data) and written out
+batch by batch, so exporting a 100k+ stockcode program never builds the whole
+frame in memory. XLSX uses openpyxl write-only mode with the two-level
+(group, column) header of the Summary tab; CSV and Parquet get the flattened
+"group column" names.
+"""
+import csv
+import io
+import os
+import tempfile
+from functools import lru_cache
+
+import pandas as pd
+from openpyxl import Workbook
+
+import db_utils
+
+FORMATS = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# (group, column) header per db_utils.PROJECT_DATA_COLUMNS entry, as on the Summary tab
+SUMMARY_HEADERS = [
+    ("General", "[A] StockCode"),
+    ("General", "[B] Description"),
+    ("Procurement", "[C] Current Supplier"),
+    ("Procurement", "[D] AC Coverage"),
+    ("Procurement", "[E] Next Shortage Date"),
+    ("Industrialization", "[F] New Supplier"),
+    ("Industrialization", "[G] FAI Delivery Date"),
+    ("Industrialization", "[H] 1st Production PO Delivery Date"),
+    ("Industrialization", "[I] Overlap (Days)"),
+    ("Quality", "[J] FAI Status"),
+    ("Quality", "[K] FAI Number"),
+    ("Quality", "[L] Fitcheck AC"),
+    ("Quality", "[M] Fitcheck Date"),
+    ("Quality", "[N] Fitcheck Status"),
+]
+
+TEMPLATE_COLUMNS = {
+    "Procurement": ["StockCode", "Description", "Current_Supplier", "AC_Coverage", "Next_Shortage_Date"],
+    "Industrialization": ["StockCode", "Description", "New_Supplier", "FAI_Delivery_Date", "First_PO_Delivery_Date"],
+    "Quality": ["StockCode", "Description", "FAI_Status", "FAI_Number", "Fitcheck_AC", "Fitcheck_Date", "Fitcheck_Status"],
+}
+
+SPOOL_MAX_BYTES = 16 * 1024 * 1024  # export_file keeps smaller exports in memory, larger ones on disk
+
+
+def flat_headers():
+    return [f"{group} {column}" for group, column in SUMMARY_HEADERS]
+
+
+OVERLAP = db_utils.PROJECT_DATA_COLUMNS.index("overlap_days")
+
+
+def _rows(df):
+    """Batch rows as lists of plain Python values: None for missing, int for overlap days."""
+    rows = df.astype(object).where(df.notna(), None).values.tolist()
+    for row in rows:
+        if row[OVERLAP] is not None:
+            row[OVERLAP] = int(row[OVERLAP])
+    return rows
+
+
+def write_xlsx(batches, target):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Project Data")
+    groups, previous = [], None
+    for group, _ in SUMMARY_HEADERS:
+        groups.append(group if group != previous else None)
+        previous = group
+    ws.append(groups)
+    ws.append([column for _, column in SUMMARY_HEADERS])
+    for df in batches:
+        for row in _rows(df):
+            ws.append(row)
+    wb.save(target)
+
+
+def write_csv(batches, target):
+    text = io.TextIOWrapper(target, encoding="utf-8-sig", newline="")
+    try:
+        writer = csv.writer(text)
+        writer.writerow(flat_headers())
+        for df in batches:
+            writer.writerows(_rows(df))
+        text.flush()
+    finally:
+        # leave `target` open for the caller
+        text.detach()
+
+
+def write_parquet(batches, target):
+    # imported here so app start-up does not pay for pyarrow
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    names = flat_headers()
+    schema = pa.schema([
+        pa.field(name, pa.int64() if column == "overlap_days" else pa.string())
+        for name, column in zip(names, db_utils.PROJECT_DATA_COLUMNS)
+    ])
+    with pq.ParquetWriter(target, schema) as writer:
+        for df in batches:
+            columns = list(zip(*_rows(df))) or [()] * len(names)
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema))
+
+
+WRITERS = {"xlsx": write_xlsx, "csv": write_csv, "parquet": write_parquet}
+
+
+def export_project(project_id, fmt, target, batch_rows=db_utils.EXPORT_BATCH_ROWS):
+    """Write a project's data to `target` (a path or binary file object) as `fmt` (see FORMATS)."""
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown export format {fmt}")
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, "wb") as f:
+            return export_project(project_id, fmt, f, batch_rows)
+    WRITERS[fmt](db_utils.iter_project_data(project_id, batch_rows), target)
+
+
+def export_file(project_id, fmt, batch_rows=db_utils.EXPORT_BATCH_ROWS):
+    """Export into a temporary file, rewound and ready to hand to st.download_button."""
+    f = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        export_project(project_id, fmt, f, batch_rows)
+    except BaseException:
+        f.close()
+        raise
+    f.seek(0)
+    return f
+
+
+@lru_cache(maxsize=None)
+def template_bytes(name):
+    """Empty upload template for a TEMPLATE_COLUMNS entry, built once per process."""
+    buf = io.BytesIO()
+    pd.DataFrame(columns=TEMPLATE_COLUMNS[name]).to_excel(buf, index=False)
+    return buf.getvalue()
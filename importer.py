@@ -0,0 +1,71 @@
+"""Streaming Excel ingest: read workbooks in fixed-size row chunks instead of one big DataFrame."""
+import pandas as pd
+from openpyxl import load_workbook
+
+import db_utils
+
+CHUNK_ROWS = 5000
+
+
+def _headers(row):
+    """Header names the way pd.read_excel builds them: blanks become 'Unnamed: i', duplicates get '.n'."""
+    names, seen = [], {}
+    for i, value in enumerate(row):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def iter_excel_chunks(source, chunk_rows=CHUNK_ROWS, sheet_name=None):
+    """Yield DataFrames of at most `chunk_rows` rows from an .xlsx path or file-like object.
+
+    Uses openpyxl read-only mode, so memory stays flat regardless of sheet size.
+    The first row is the header; columns are normalized with db_utils.normalize_columns
+    and fully empty rows are skipped.
+    """
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet_name] if sheet_name else wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = _headers(header)
+        width = len(columns)
+
+        batch = []
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            row = tuple(row[:width]) + (None,) * (width - len(row))
+            batch.append(row)
+            if len(batch) >= chunk_rows:
+                yield db_utils.normalize_columns(pd.DataFrame(batch, columns=columns))
+                batch = []
+        if batch:
+            yield db_utils.normalize_columns(pd.DataFrame(batch, columns=columns))
+    finally:
+        wb.close()
+
+
+def excel_row_count(source, sheet_name=None):
+    """Data rows (excluding the header) as recorded in the workbook's dimensions, or None if it records none.
+
+    Cheap in read-only mode; blank rows are counted, so use it for progress only.
+    """
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet_name] if sheet_name else wb.worksheets[0]
+        return max(ws.max_row - 1, 0) if ws.max_row else None
+    finally:
+        wb.close()
+
+
+def import_excel(source, project_id, table_name, changed_by=None, chunk_rows=CHUNK_ROWS):
+    """Stream an uploaded workbook into `table_name` as one undoable save. Returns the number of rows saved."""
+    return db_utils.save_table_chunks(iter_excel_chunks(source, chunk_rows), project_id, table_name, changed_by)
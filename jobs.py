@@ -0,0 +1,203 @@
+"""In-process background jobs: Excel imports run on a worker thread instead of in the Streamlit script run.
+
+Every job is a row of `jobs` (status, row counts, error). Its key is the SHA-256 of
+the uploaded file plus the target project and table, so submitting the same upload
+again returns the existing job instead of importing it twice, unless a re-import
+of a finished job is asked for (find_import tells the two apart). The payload is
+spooled next to the database until the job succeeds, so failed jobs can be retried
+and jobs cut short by a restart are picked up again on first use.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+import db_utils
+import importer
+
+JOB_DIR = "import_jobs"  # created next to the database file
+JOB_WORKERS = 1          # imports run one at a time; each parses here and hands prepared batches to the writer
+JOB_LIST_LIMIT = 5
+ACTIVE_STATUSES = ("queued", "running")
+
+JOB_COLUMNS = [
+    "id", "file_name", "submitted_by", "status", "rows_total", "rows_done", "error",
+    "created_at", "started_at", "finished_at",
+]
+
+_executor = None
+_lock = threading.Lock()
+_started_dbs = set()
+_progress = {}  # job id -> rows saved so far by the running import
+
+
+def _now():
+    return datetime.utcnow().isoformat(timespec="seconds") + "Z"
+
+
+def job_key(data, project_id, table_name):
+    return f"{hashlib.sha256(data).hexdigest()}:{int(project_id)}:{table_name}"
+
+
+def _spool_path(key):
+    root = os.path.join(os.path.dirname(os.path.abspath(db_utils.DB_FILE)), JOB_DIR)
+    return os.path.join(root, hashlib.sha256(key.encode()).hexdigest() + ".xlsx")
+
+
+def _spool(key, data):
+    path = _spool_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def _get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="import-job")
+        if db_utils.DB_FILE not in _started_dbs:
+            _started_dbs.add(db_utils.DB_FILE)
+            # jobs a previous process left queued or running
+            def requeue(conn):
+                ids = [row[0] for row in conn.execute(
+                    "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY id")]
+                conn.execute("UPDATE jobs SET status='queued', started_at=NULL WHERE status='running'")
+                return ids
+
+            for job_id in db_utils.write(requeue):
+                _executor.submit(_run, job_id)
+        return _executor
+
+
+def find_import(data, project_id, table_name):
+    """(job id, status) of the job holding this file's key for the project's table, or None."""
+    _get_executor()
+    with db_utils.connection() as conn:
+        return conn.execute("SELECT id, status FROM jobs WHERE job_key=?",
+                            (job_key(data, project_id, table_name),)).fetchone()
+
+
+def submit_import(data, file_name, project_id, table_name, submitted_by=None, reimport=False):
+    """Queue an Excel import of `data` (bytes) into `table_name` and return its job id at once.
+
+    Resubmitting a file queued, running or failed for the same project and table
+    returns the existing job; so does a file already imported, unless `reimport`
+    is set (say after its save was undone), which retires the finished job's key
+    and queues a new job.
+    """
+    if table_name not in db_utils.TABLE_SCHEMAS:
+        raise ValueError(f"Unknown table {table_name}")
+    executor = _get_executor()
+    key = job_key(data, project_id, table_name)
+    with db_utils.connection() as conn:
+        row = conn.execute("SELECT id, status FROM jobs WHERE job_key=?", (key,)).fetchone()
+    if row and not (reimport and row[1] == "done"):
+        return row[0]
+    _spool(key, data)
+
+    def insert(conn):
+        row = conn.execute("SELECT id, status FROM jobs WHERE job_key=?", (key,)).fetchone()
+        if row and not (reimport and row[1] == "done"):
+            return row[0], False
+        if row:
+            # the finished job keeps its history under a key no upload can match
+            conn.execute("UPDATE jobs SET job_key = job_key || ':' || id WHERE id=?", (row[0],))
+        return conn.execute("""
+            INSERT INTO jobs (job_key, kind, project_id, table_name, file_name, submitted_by, status, created_at)
+            VALUES (?, 'import', ?, ?, ?, ?, 'queued', ?)
+        """, (key, project_id, table_name, file_name, submitted_by or "unknown", _now())).lastrowid, True
+
+    job_id, created = db_utils.write(insert)
+    if created:
+        executor.submit(_run, job_id)
+    return job_id
+
+
+def retry(job_id):
+    """Queue a failed job again. Returns False if it is not failed or its payload is gone."""
+    executor = _get_executor()
+
+    def requeue(conn):
+        row = conn.execute("SELECT job_key FROM jobs WHERE id=? AND status='failed'", (job_id,)).fetchone()
+        if row is None or not os.path.exists(_spool_path(row[0])):
+            return False
+        conn.execute("""
+            UPDATE jobs SET status='queued', error=NULL, rows_done=0, started_at=NULL, finished_at=NULL WHERE id=?
+        """, (job_id,))
+        return True
+
+    if not db_utils.write(requeue):
+        return False
+    executor.submit(_run, job_id)
+    return True
+
+
+def _update(job_id, **values):
+    """Set columns of one job row (in its own write)."""
+    assignments = ", ".join(f"{column}=?" for column in values)
+    db_utils.write(lambda conn: conn.execute(f"UPDATE jobs SET {assignments} WHERE id=?", (*values.values(), job_id)))
+
+
+def _run(job_id):
+    def start(conn):
+        row = conn.execute("""
+            SELECT job_key, project_id, table_name, submitted_by FROM jobs WHERE id=? AND status='queued'
+        """, (job_id,)).fetchone()
+        if row is not None:
+            conn.execute("UPDATE jobs SET status='running', started_at=? WHERE id=?", (_now(), job_id))
+        return row
+
+    row = db_utils.write(start)
+    if row is None:
+        return
+    key, project_id, table_name, submitted_by = row
+    path = _spool_path(key)
+    _progress[job_id] = 0
+
+    def saved(rows):
+        _progress[job_id] = rows
+
+    try:
+        _update(job_id, rows_total=importer.excel_row_count(path))
+        rows = db_utils.save_table_chunks(importer.iter_excel_chunks(path), project_id, table_name,
+                                          changed_by=submitted_by, progress=saved)
+        _update(job_id, status="done", rows_done=rows, finished_at=_now())
+        os.unlink(path)
+    except Exception as e:
+        _update(job_id, status="failed", rows_done=0, error=str(e) or type(e).__name__, finished_at=_now())
+    finally:
+        _progress.pop(job_id, None)
+
+
+def list_jobs(project_id, table_name, limit=JOB_LIST_LIMIT):
+    """The newest jobs of a project's table, with live row progress for running ones."""
+    _get_executor()
+    with db_utils.connection() as conn:
+        df = pd.read_sql_query(f"""
+            SELECT {", ".join(JOB_COLUMNS)} FROM jobs
+            WHERE project_id=? AND table_name=?
+            ORDER BY id DESC
+            LIMIT ?
+        """, conn, params=(project_id, table_name, int(limit)))
+    running = df["status"] == "running"
+    df.loc[running, "rows_done"] = df.loc[running, "id"].map(lambda i: _progress.get(i, 0))
+    return df
+
+
+def wait(job_id, timeout=None):
+    """Block until a job is neither queued nor running (or `timeout` seconds pass); returns its status."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        with db_utils.connection() as conn:
+            status = conn.execute("SELECT status FROM jobs WHERE id=?", (job_id,)).fetchone()[0]
+        if status not in ACTIVE_STATUSES or (deadline is not None and time.monotonic() >= deadline):
+            return status
+        time.sleep(0.1)
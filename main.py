@@ -1,15 +1,36 @@
+import time
+_run_start = time.perf_counter()
+
 import os
 import streamlit as st
 import pandas as pd
-from io import BytesIO
 import db_utils
+import export
+import importer
+import jobs
+import profiling
 import bcrypt
 
 # Optional: reduce watcher noise in some environments
 os.environ["STREAMLIT_WATCHER_TYPE"] = "none"
 
 st.set_page_config(page_title="📊 Industrialization Tracker", layout="wide")
+profiling.start_run(st.session_state.get("user"))
+_imported = time.perf_counter()
 db_utils.init_db()
+_initialized = time.perf_counter()
+
+
+def report_startup():
+    """Cold-start breakdown, printed once per process by the first run to finish rendering."""
+    db_utils.report_cold_start(_imported - _run_start, _initialized - _imported, time.perf_counter() - _initialized)
+
+
+def finish_run():
+    """Close this script run's profiling record; called wherever the script ends."""
+    profiling.end_run()
+    report_startup()
+
 
 st.title("📊 Industrialization Tracker")
 
@@ -26,7 +47,9 @@ with st.sidebar.expander("🔑 Login"):
         creds = db_utils.get_user_credentials(email)
         if creds:
             role, stored_hash = creds
-            if bcrypt.checkpw(password.encode(), stored_hash.encode()):
+            with profiling.span("bcrypt.checkpw", kind="bcrypt"):
+                valid = bcrypt.checkpw(password.encode(), stored_hash.encode())
+            if valid:
                 st.session_state["user"] = email
                 st.session_state["role"] = role
                 st.success(f"Logged in as {role.title()}")
@@ -37,6 +60,7 @@ with st.sidebar.expander("🔑 Login"):
 
 if not st.session_state["user"]:
     st.warning("Please log in to use the app.")
+    finish_run()
     st.stop()
 
 # Sidebar: Logout + admin reload users
@@ -47,52 +71,217 @@ if st.sidebar.button("🚪 Logout"):
 
 if st.session_state["role"] == "admin":
     if st.sidebar.button("🔄 Reload Users from Excel"):
-        db_utils.reload_users_from_excel()
-        st.success("User list reloaded from Excel")
+        if db_utils.reload_users_from_excel():
+            st.success("User list reloaded from Excel")
+        else:
+            st.error("Could not reload users.xlsx")
 
 role = st.session_state["role"]
 current_user = st.session_state["user"]
 
-# ---------------- Helper: Filter ----------------
-def filter_box(df: pd.DataFrame, label: str, key: str):
-    term = st.text_input(label, key=key, placeholder="Type to filter…")
-    if term:
-        mask = df.apply(lambda r: r.astype(str).str.contains(term, case=False, na=False).any(), axis=1)
-        return df[mask]
-    return df
+# ---------------- Helper: Paged tables ----------------
+# display labels of each tab's columns; save_table normalizes them back
+COLUMN_LABELS = {
+    "procurement": {
+        "stockcode": "StockCode",
+        "description": "Description",
+        "current_supplier": "Current_Supplier",
+        "ac_coverage": "AC_Coverage",
+        "next_shortage_date": "Next_Shortage_Date",
+    },
+    "industrialization": {
+        "stockcode": "StockCode",
+        "description": "Description",
+        "new_supplier": "New_Supplier",
+        "fai_delivery_date": "FAI_Delivery_Date",
+        "first_po_delivery_date": "First_PO_Delivery_Date",
+    },
+    "quality": {
+        "stockcode": "StockCode",
+        "description": "Description",
+        "fai_status": "FAI_Status",
+        "fai_number": "FAI_Number",
+        "fitcheck_ac": "Fitcheck_AC",
+        "fitcheck_date": "Fitcheck_Date",
+        "fitcheck_status": "Fitcheck_Status",
+    },
+}
+
+
+def project_page(project_id: int, table, key: str, label: str, labels: dict):
+    """Filter box and sort controls for one table; returns (visible page, next page key).
+
+    Only the current page is read from the database and sent to the browser.
+    """
+    colf, cols, cold = st.columns([3, 2, 1])
+    with colf:
+        term = st.text_input(label, key=f"filter_{key}", placeholder="Type to filter… (prefixes, e.g. acme or supplier:acme)")
+    with cols:
+        sort = st.selectbox("Sort by", list(labels), format_func=labels.get, key=f"sort_{key}")
+    with cold:
+        descending = st.checkbox("Descending", key=f"desc_{key}")
+    # keyset paging: a stack of page keys, reset whenever the view changes
+    view = (project_id, term, sort, descending)
+    if st.session_state.get(f"page_view_{key}") != view:
+        st.session_state[f"page_view_{key}"] = view
+        st.session_state[f"page_keys_{key}"] = [None]
+        reset_editor(key)
+    df, next_key = db_utils.get_project_page(project_id, table, sort=sort, descending=descending,
+                                             filters={"search": term}, after_key=st.session_state[f"page_keys_{key}"][-1])
+    return df.rename(columns=labels), next_key
+
+
+# ---------------- Helper: Background imports ----------------
+JOB_POLL_SECONDS = 2
+
+
+def submit_upload(upload, key: str, project_id: int, table_name: str):
+    """Queue an uploaded workbook for import; the script run returns at once.
+
+    Submitted once per session and file; jobs.submit_import also returns the
+    existing job for a file it has seen before, so an upload never runs twice.
+    A file imported before (and perhaps undone since) is only queued again
+    once the user asks for a re-import.
+    """
+    if st.session_state.get(f"upload_{key}") == (project_id, upload.file_id):
+        return
+    data = upload.getvalue()
+    job = jobs.find_import(data, project_id, table_name)
+    reimport = job is not None and job[1] == "done"
+    if reimport:
+        st.info(f"{upload.name} was already imported (job {job[0]}).")
+        if not st.button("Import again", key=f"reimport_{key}"):
+            return
+    jobs.submit_import(data, upload.name, project_id, table_name, current_user, reimport=reimport)
+    st.session_state[f"upload_{key}"] = (project_id, upload.file_id)
+
+
+def show_import_jobs(project_id: int, table_name: str, key: str):
+    """Recent imports of a table with their progress; polls while any is queued or running."""
+    def panel():
+        df_jobs = jobs.list_jobs(project_id, table_name)
+        active = set(df_jobs.loc[df_jobs["status"].isin(jobs.ACTIVE_STATUSES), "id"])
+        finished = st.session_state.get(f"jobs_active_{key}", set()) - active
+        st.session_state[f"jobs_active_{key}"] = active
+        if finished:
+            st.rerun()  # reload the table with the imported rows (and stop polling)
+        for job in df_jobs.itertuples():
+            label = f"{job.file_name} — {job.status}, {job.rows_done:,} rows"
+            if job.status == "running":
+                total = job.rows_total or 0
+                st.progress(min(job.rows_done / total, 1.0) if total else 0.0,
+                            text=f"{label} of {total:,}" if total else label)
+            elif job.status == "failed":
+                st.error(f"{label}: {job.error}")
+                if st.button("Retry import", key=f"retry_{key}_{job.id}") and jobs.retry(job.id):
+                    st.rerun()
+            else:
+                st.caption(label)
+
+    polling = jobs.list_jobs(project_id, table_name)["status"].isin(jobs.ACTIVE_STATUSES).any()
+    st.fragment(panel, run_every=JOB_POLL_SECONDS if polling else None)()
+
+
+def editor_key(key: str) -> str:
+    """Widget key of a table's st.data_editor; its state holds the pending edits of the visible page."""
+    return f"editor_{key}_{st.session_state.get(f'editor_gen_{key}', 0)}"
+
+
+def editor_base(key: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Frame a table's editor shows; held in session_state while it has pending edits.
+
+    The editor's state addresses rows by position, so Save must map them
+    through the frame the user edited, not through a fresh read of the page.
+    """
+    state = st.session_state.get(editor_key(key)) or {}
+    base_key = f"{editor_key(key)}_base"
+    if base_key not in st.session_state or not any(state.get(k) for k in ("edited_rows", "added_rows", "deleted_rows")):
+        st.session_state[base_key] = df
+    return st.session_state[base_key]
+
+
+def reset_editor(key: str):
+    """Start the table's editor afresh (new page, saved or undone edits)."""
+    st.session_state.pop(f"{editor_key(key)}_base", None)
+    st.session_state[f"editor_gen_{key}"] = st.session_state.get(f"editor_gen_{key}", 0) + 1
+
+
+def page_nav(key: str, next_key):
+    """Previous / Next buttons under a table shown with project_page."""
+    keys = st.session_state[f"page_keys_{key}"]
+    colp1, colp2, colp3 = st.columns([1, 1, 4])
+    with colp1:
+        if len(keys) > 1 and st.button("⬅️ Previous", key=f"prev_{key}"):
+            keys.pop()
+            reset_editor(key)
+            st.rerun()
+    with colp2:
+        if next_key is not None and st.button("Next ➡️", key=f"next_{key}"):
+            keys.append(next_key)
+            reset_editor(key)
+            st.rerun()
+    with colp3:
+        st.caption(f"Page {len(keys)} · {db_utils.PAGE_SIZE} rows per page")
 
 # ---------------- Project creation (Admin-only) ----------------
 if role == "admin":
     with st.expander("➕ Create New Project"):
-        templates = {
-            "Procurement": ["StockCode", "Description", "Current_Supplier", "AC_Coverage", "Next_Shortage_Date"],
-            "Industrialization": ["StockCode", "Description", "New_Supplier", "FAI_Delivery_Date", "First_PO_Delivery_Date"],
-            "Quality": ["StockCode", "Description", "FAI_Status", "FAI_Number", "Fitcheck_AC", "Fitcheck_Date", "Fitcheck_Status"],
-        }
-        for name, cols in templates.items():
-            buf = BytesIO()
-            pd.DataFrame(columns=cols).to_excel(buf, index=False)
-            st.download_button(f"📥 Download {name} Template", buf.getvalue(), file_name=f"{name.lower()}_template.xlsx")
+        for name in export.TEMPLATE_COLUMNS:
+            st.download_button(f"📥 Download {name} Template", export.template_bytes(name),
+                               file_name=f"{name.lower()}_template.xlsx")
 
         new_project_name = st.text_input("Project Name")
         uploaded_file = st.file_uploader("Upload Stock Codes & Descriptions", type=["xlsx"])
 
         if st.button("Create Project"):
             if new_project_name.strip():
-                stockcodes_df = None
+                stockcodes = None
                 if uploaded_file:
-                    stockcodes_df = pd.read_excel(uploaded_file)
-                db_utils.add_project(new_project_name.strip(), stockcodes_df)
+                    stockcodes = importer.iter_excel_chunks(uploaded_file)
+                db_utils.add_project(new_project_name.strip(), stockcodes, changed_by=current_user)
                 st.success(f"Project '{new_project_name}' created.")
             else:
                 st.error("Enter a project name.")
 
-# ---------------- Select project ----------------
+# ---------------- Projects ----------------
 projects = db_utils.get_projects()
 if projects.empty:
     st.info("No projects yet." if role == "admin" else "No projects yet. Ask an Admin to create one.")
+    finish_run()
     st.stop()
 
+# ---------------- Portfolio (all projects) ----------------
+with st.expander("📊 Portfolio Overview"):
+    portfolio = db_utils.get_portfolio_summary()
+    st.dataframe(portfolio.drop(columns="project_id").rename(columns={
+        "project": "Project", "items": "Items", "negative_overlap": "Negative Overlap",
+        "shortage_overdue": "Shortage Overdue",
+        **{f"shortage_due_{d}d": f"Shortage < {d} Days" for d in db_utils.PORTFOLIO_HORIZONS},
+    }), hide_index=True, width="stretch")
+    colp1, colp2 = st.columns(2)
+    for col, metric, label in [(colp1, "fai_status", "FAI Status"), (colp2, "fitcheck_status", "Fitcheck Status")]:
+        with col:
+            st.caption(f"Items by {label}")
+            st.dataframe(db_utils.get_portfolio_status_counts(metric).rename(columns={"": "(none)"}), width="stretch")
+
+    st.caption("Shortage risk")
+    colr1, colr2, colr3 = st.columns([1, 2, 2])
+    with colr1:
+        risk_days = st.number_input("Shortage within (days)", min_value=0, value=db_utils.RISK_HORIZON_DAYS, step=15)
+    with colr2:
+        risk_supplier = st.text_input("Supplier (current or new)", key="risk_supplier")
+    with colr3:
+        risk_before_po = st.checkbox("Only shortages before the 1st production PO delivery", value=True)
+    risk = db_utils.get_risk_items(within_days=risk_days, before_first_po=risk_before_po,
+                                   supplier=risk_supplier.strip() or None)
+    if risk.empty:
+        st.info("No items at risk.")
+    else:
+        st.dataframe(risk.drop(columns="project_id"), hide_index=True, width="stretch")
+        if len(risk) == db_utils.RISK_LIMIT:
+            st.caption(f"Showing the first {db_utils.RISK_LIMIT:,} items.")
+
+# ---------------- Select project ----------------
 project_map = {name: pid for pid, name in projects.values}
 selected_name = st.selectbox("Select Project", list(project_map.keys()))
 pid = project_map[selected_name]
@@ -107,48 +296,47 @@ tab_admin = rest[0] if rest else None
 # ---------------- Summary ----------------
 with tab1:
     st.subheader("📌 Project Summary")
-    if st.button("🔄 Refresh Summary"):
-        st.session_state["refresh_summary"] = True
-
-    if "refresh_summary" not in st.session_state or st.session_state["refresh_summary"]:
-        df_sum = db_utils.get_project_data(pid)
-        st.session_state["refresh_summary"] = False
-    else:
-        df_sum = db_utils.get_project_data(pid)
+    st.button("🔄 Refresh Summary")  # a rerun re-reads the current page
+
+    tuples = [
+        ("General", "[A] StockCode"),
+        ("General", "[B] Description"),
+        ("Procurement", "[C] Current Supplier"),
+        ("Procurement", "[D] AC Coverage"),
+        ("Procurement", "[E] Next Shortage Date"),
+        ("Industrialization", "[F] New Supplier"),
+        ("Industrialization", "[G] FAI Delivery Date"),
+        ("Industrialization", "[H] 1st Production PO Delivery Date"),
+        ("Industrialization", "[I] Overlap (Days)"),
+        ("Quality", "[J] FAI Status"),
+        ("Quality", "[K] FAI Number"),
+        ("Quality", "[L] Fitcheck AC"),
+        ("Quality", "[M] Fitcheck Date"),
+        ("Quality", "[N] Fitcheck Status"),
+    ]
+    summary_labels = dict(zip(db_utils.PROJECT_DATA_COLUMNS, (b for _, b in tuples)))
+    df_sum, next_sum = project_page(pid, None, "summary", "🔎 Filter Summary", summary_labels)
 
     if df_sum.empty:
-        st.info("No data yet.")
+        st.info("No matching rows." if st.session_state["filter_summary"] else "No data yet.")
     else:
-        tuples = [
-            ("General", "[A] StockCode"),
-            ("General", "[B] Description"),
-            ("Procurement", "[C] Current Supplier"),
-            ("Procurement", "[D] AC Coverage"),
-            ("Procurement", "[E] Next Shortage Date"),
-            ("Industrialization", "[F] New Supplier"),
-            ("Industrialization", "[G] FAI Delivery Date"),
-            ("Industrialization", "[H] 1st Production PO Delivery Date"),
-            ("Industrialization", "[I] Overlap (Days)"),
-            ("Quality", "[J] FAI Status"),
-            ("Quality", "[K] FAI Number"),
-            ("Quality", "[L] Fitcheck AC"),
-            ("Quality", "[M] Fitcheck Date"),
-            ("Quality", "[N] Fitcheck Status"),
-        ]
         df_display = df_sum.copy()
         df_display.columns = pd.MultiIndex.from_tuples(tuples)
-
-        # Filter box for summary
-        flat_for_filter = df_display.copy()
-        flat_for_filter.columns = [f"{a} {b}" for a, b in df_display.columns]
-        flat_for_filter = filter_box(flat_for_filter, "🔎 Filter Summary", key="filter_summary")
-        # Map back to MultiIndex for display
-        if len(flat_for_filter) != len(df_display):
-            # rebuild multiindex
-            multi_cols = pd.MultiIndex.from_tuples(tuples)
-            df_display = pd.DataFrame(flat_for_filter.values, columns=multi_cols, index=flat_for_filter.index)
-
         st.dataframe(df_display, width="stretch")
+    page_nav("summary", next_sum)
+
+    # Full export, streamed from the database (ignores the filter above)
+    colx1, colx2 = st.columns([1, 3])
+    with colx1:
+        export_fmt = st.selectbox("Export format", list(export.FORMATS), key="export_fmt")
+    with colx2:
+        if st.button("📤 Prepare Export"):
+            st.session_state["export_file"] = (pid, export_fmt, export.export_file(pid, export_fmt))
+    prepared = st.session_state.get("export_file")
+    if prepared and prepared[:2] == (pid, export_fmt):
+        prepared[2].seek(0)  # the button reads the file on every rerun
+        st.download_button(f"📥 Download {export_fmt.upper()}", data=prepared[2],
+                           file_name=f"{selected_name}.{export_fmt}", mime=export.FORMATS[export_fmt])
 
 # ---------------- Procurement ----------------
 with tab2:
@@ -156,43 +344,41 @@ with tab2:
     # Upload (everyone sees; only saved if role permitted)
     f = st.file_uploader("Upload Procurement Data", type=["xlsx"], key="proc")
     if f and role in ["admin", "procurement"]:
-        df_upload = pd.read_excel(f)
-        db_utils.save_table(df_upload, pid, "procurement", changed_by=current_user)
-        st.success("Procurement uploaded.")
+        submit_upload(f, "proc", pid, "procurement")
     elif f and role not in ["admin", "procurement"]:
         st.info("You can view but cannot save changes (insufficient permissions).")
+    show_import_jobs(pid, "procurement", "proc")
 
-    # Table for editing/viewing
-    base = db_utils.get_project_data(pid)
-    df_proc = base[["stockcode", "description", "current_supplier", "ac_coverage", "next_shortage_date"]] \
-        .rename(columns={
-            "stockcode": "StockCode",
-            "description": "Description",
-            "current_supplier": "Current_Supplier",
-            "ac_coverage": "AC_Coverage",
-            "next_shortage_date": "Next_Shortage_Date",
-        })
-
-    df_proc = filter_box(df_proc, "🔎 Filter Procurement", key="filter_proc")
+    # Table for editing/viewing: one page at a time
+    df_proc, next_proc = project_page(pid, "procurement", "proc", "🔎 Filter Procurement", COLUMN_LABELS["procurement"])
 
     if role in ["admin", "procurement"]:
-        edited = st.data_editor(df_proc, num_rows="dynamic", width="stretch")
+        base_proc = editor_base("proc", df_proc)
+        st.data_editor(base_proc, num_rows="dynamic", width="stretch", key=editor_key("proc"))
         if st.button("Save Procurement Changes"):
-            db_utils.save_table(edited, pid, "procurement", changed_by=current_user)
+            db_utils.save_edits(base_proc, st.session_state[editor_key("proc")], pid, "procurement", changed_by=current_user)
+            reset_editor("proc")
             st.success("Procurement changes saved.")
         if st.button("↩️ Undo Procurement Save"):
-            db_utils.undo_last_save(pid, "procurement")
-            st.warning("Procurement reverted to last save.")
+            if db_utils.undo_last_save(pid, "procurement", changed_by=current_user) is None:
+                st.info("Nothing to undo.")
+            else:
+                reset_editor("proc")
+                st.warning("Last procurement save undone.")
     else:
         st.dataframe(df_proc, width="stretch")
+    page_nav("proc", next_proc)
 
     # Attachments (per stockcode)
     st.markdown("**Attachments**")
     stock_for_attach = st.selectbox("Choose StockCode for attachment", df_proc["StockCode"].dropna().unique() if not df_proc.empty else [])
     attach = st.file_uploader("Upload attachment (PDF/Excel/Image/etc.)", key="attach_proc")
     if attach and stock_for_attach and role in ["admin", "procurement"]:
-        db_utils.save_attachment(pid, stock_for_attach, attach.name, attach.read(), current_user)
-        st.success("Attachment uploaded.")
+        try:
+            db_utils.save_attachment(pid, stock_for_attach, attach.name, attach, current_user)
+            st.success("Attachment uploaded.")
+        except ValueError as e:
+            st.error(str(e))
     if stock_for_attach:
         att_df = db_utils.get_attachments(pid, stock_for_attach)
         if att_df.empty:
@@ -202,51 +388,50 @@ with tab2:
                 fname = r["file_name"]; aid = int(r["id"])
                 # fetch blob when clicked (inline for simplicity)
                 if st.button(f"📎 Download: {fname}", key=f"dlp_{aid}"):
-                    name, blob = db_utils.get_attachment_blob(aid)
-                    if blob:
-                        st.download_button("Click to download", data=blob, file_name=name, key=f"dlpb_{aid}")
+                    with db_utils.open_attachment(aid) as (name, fh):
+                        if fh:
+                            st.download_button("Click to download", data=fh, file_name=name, key=f"dlpb_{aid}")
 
 # ---------------- Industrialization ----------------
 with tab3:
     st.subheader("🏭 Industrialization")
     f = st.file_uploader("Upload Industrialization Data", type=["xlsx"], key="ind")
     if f and role in ["admin", "industrialization"]:
-        df_upload = pd.read_excel(f)
-        db_utils.save_table(df_upload, pid, "industrialization", changed_by=current_user)
-        st.success("Industrialization uploaded.")
+        submit_upload(f, "ind", pid, "industrialization")
     elif f and role not in ["admin", "industrialization"]:
         st.info("You can view but cannot save changes (insufficient permissions).")
+    show_import_jobs(pid, "industrialization", "ind")
 
-    base = db_utils.get_project_data(pid)
-    df_ind = base[["stockcode", "description", "new_supplier", "fai_delivery_date", "first_po_delivery_date"]] \
-        .rename(columns={
-            "stockcode": "StockCode",
-            "description": "Description",
-            "new_supplier": "New_Supplier",
-            "fai_delivery_date": "FAI_Delivery_Date",
-            "first_po_delivery_date": "First_PO_Delivery_Date",
-        })
-
-    df_ind = filter_box(df_ind, "🔎 Filter Industrialization", key="filter_ind")
+    df_ind, next_ind = project_page(pid, "industrialization", "ind", "🔎 Filter Industrialization",
+                                    COLUMN_LABELS["industrialization"])
 
     if role in ["admin", "industrialization"]:
-        edited = st.data_editor(df_ind, num_rows="dynamic", width="stretch")
+        base_ind = editor_base("ind", df_ind)
+        st.data_editor(base_ind, num_rows="dynamic", width="stretch", key=editor_key("ind"))
         if st.button("Save Industrialization Changes"):
-            db_utils.save_table(edited, pid, "industrialization", changed_by=current_user)
+            db_utils.save_edits(base_ind, st.session_state[editor_key("ind")], pid, "industrialization", changed_by=current_user)
+            reset_editor("ind")
             st.success("Industrialization changes saved.")
         if st.button("↩️ Undo Industrialization Save"):
-            db_utils.undo_last_save(pid, "industrialization")
-            st.warning("Industrialization reverted to last save.")
+            if db_utils.undo_last_save(pid, "industrialization", changed_by=current_user) is None:
+                st.info("Nothing to undo.")
+            else:
+                reset_editor("ind")
+                st.warning("Last industrialization save undone.")
     else:
         st.dataframe(df_ind, width="stretch")
+    page_nav("ind", next_ind)
 
     # Attachments
     st.markdown("**Attachments**")
     stock_for_attach = st.selectbox("Choose StockCode for attachment", df_ind["StockCode"].dropna().unique() if not df_ind.empty else [], key="ind_att_sel")
     attach = st.file_uploader("Upload attachment (PDF/Excel/Image/etc.)", key="attach_ind")
     if attach and stock_for_attach and role in ["admin", "industrialization"]:
-        db_utils.save_attachment(pid, stock_for_attach, attach.name, attach.read(), current_user)
-        st.success("Attachment uploaded.")
+        try:
+            db_utils.save_attachment(pid, stock_for_attach, attach.name, attach, current_user)
+            st.success("Attachment uploaded.")
+        except ValueError as e:
+            st.error(str(e))
     if stock_for_attach:
         att_df = db_utils.get_attachments(pid, stock_for_attach)
         if att_df.empty:
@@ -255,40 +440,29 @@ with tab3:
             for _, r in att_df.iterrows():
                 fname = r["file_name"]; aid = int(r["id"])
                 if st.button(f"📎 Download: {fname}", key=f"dli_{aid}"):
-                    name, blob = db_utils.get_attachment_blob(aid)
-                    if blob:
-                        st.download_button("Click to download", data=blob, file_name=name, key=f"dlib_{aid}")
+                    with db_utils.open_attachment(aid) as (name, fh):
+                        if fh:
+                            st.download_button("Click to download", data=fh, file_name=name, key=f"dlib_{aid}")
 
 # ---------------- Quality ----------------
 with tab4:
     st.subheader("✅ Quality")
     f = st.file_uploader("Upload Quality Data", type=["xlsx"], key="qual")
     if f and role in ["admin", "quality"]:
-        df_upload = pd.read_excel(f)
-        db_utils.save_table(df_upload, pid, "quality", changed_by=current_user)
-        st.success("Quality uploaded.")
+        submit_upload(f, "qual", pid, "quality")
     elif f and role not in ["admin", "quality"]:
         st.info("You can view but cannot save changes (insufficient permissions).")
+    show_import_jobs(pid, "quality", "qual")
 
-    base = db_utils.get_project_data(pid)
-    df_qual = base[["stockcode", "description", "fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status"]] \
-        .rename(columns={
-            "stockcode": "StockCode",
-            "description": "Description",
-            "fai_status": "FAI_Status",
-            "fai_number": "FAI_Number",
-            "fitcheck_ac": "Fitcheck_AC",
-            "fitcheck_date": "Fitcheck_Date",
-            "fitcheck_status": "Fitcheck_Status",
-        })
-
-    df_qual = filter_box(df_qual, "🔎 Filter Quality", key="filter_qual")
+    df_qual, next_qual = project_page(pid, "quality", "qual", "🔎 Filter Quality", COLUMN_LABELS["quality"])
 
     if role in ["admin", "quality"]:
-        edited = st.data_editor(
-            df_qual,
+        base_qual = editor_base("qual", df_qual)
+        st.data_editor(
+            base_qual,
             num_rows="dynamic",
             width="stretch",
+            key=editor_key("qual"),
             column_config={
                 "FAI_Status": st.column_config.SelectboxColumn(
                     "FAI Status",
@@ -304,21 +478,29 @@ with tab4:
             }
         )
         if st.button("Save Quality Changes"):
-            db_utils.save_table(edited, pid, "quality", changed_by=current_user)
+            db_utils.save_edits(base_qual, st.session_state[editor_key("qual")], pid, "quality", changed_by=current_user)
+            reset_editor("qual")
             st.success("Quality changes saved.")
         if st.button("↩️ Undo Quality Save"):
-            db_utils.undo_last_save(pid, "quality")
-            st.warning("Quality reverted to last save.")
+            if db_utils.undo_last_save(pid, "quality", changed_by=current_user) is None:
+                st.info("Nothing to undo.")
+            else:
+                reset_editor("qual")
+                st.warning("Last quality save undone.")
     else:
         st.dataframe(df_qual, width="stretch")
+    page_nav("qual", next_qual)
 
     # Attachments
     st.markdown("**Attachments**")
     stock_for_attach = st.selectbox("Choose StockCode for attachment", df_qual["StockCode"].dropna().unique() if not df_qual.empty else [], key="qual_att_sel")
     attach = st.file_uploader("Upload attachment (PDF/Excel/Image/etc.)", key="attach_qual")
     if attach and stock_for_attach and role in ["admin", "quality"]:
-        db_utils.save_attachment(pid, stock_for_attach, attach.name, attach.read(), current_user)
-        st.success("Attachment uploaded.")
+        try:
+            db_utils.save_attachment(pid, stock_for_attach, attach.name, attach, current_user)
+            st.success("Attachment uploaded.")
+        except ValueError as e:
+            st.error(str(e))
     if stock_for_attach:
         att_df = db_utils.get_attachments(pid, stock_for_attach)
         if att_df.empty:
@@ -327,9 +509,9 @@ with tab4:
             for _, r in att_df.iterrows():
                 fname = r["file_name"]; aid = int(r["id"])
                 if st.button(f"📎 Download: {fname}", key=f"dlq_{aid}"):
-                    name, blob = db_utils.get_attachment_blob(aid)
-                    if blob:
-                        st.download_button("Click to download", data=blob, file_name=name, key=f"dlqb_{aid}")
+                    with db_utils.open_attachment(aid) as (name, fh):
+                        if fh:
+                            st.download_button("Click to download", data=fh, file_name=name, key=f"dlqb_{aid}")
 
 # ---------------- Admin tab (user management) ----------------
 if tab_admin is not None:
@@ -338,13 +520,22 @@ if tab_admin is not None:
 
         st.markdown("**Upload users.xlsx** (columns: Email, Role, Password)")
         fusers = st.file_uploader("Upload users.xlsx", type=["xlsx"], key="users_up")
-        if fusers:
+        # import each uploaded file once, not again on every rerun while it stays in the uploader
+        if fusers and st.session_state.get("users_upload_id") != fusers.file_id:
             try:
                 df_users = pd.read_excel(fusers)
-                db_utils.load_users_from_excel(df_users)
-                st.success("Users loaded.")
+                st.session_state["users_upload_report"] = db_utils.load_users_from_excel(df_users)
+                st.session_state["users_upload_id"] = fusers.file_id
             except Exception as e:
                 st.error(f"Failed to load users: {e}")
+        if fusers and st.session_state.get("users_upload_id") == fusers.file_id:
+            report = st.session_state["users_upload_report"]
+            failed = report[report["status"] == "failed"]
+            counts = report["status"].value_counts()
+            st.success("Users loaded: " + ", ".join(f"{n} {status}" for status, n in counts.items()))
+            if not failed.empty:
+                st.error(f"{len(failed)} row(s) failed:")
+                st.dataframe(failed, width="stretch")
 
         st.markdown("**Current Users**")
         users_df = db_utils.list_users()
@@ -362,3 +553,80 @@ if tab_admin is not None:
                     st.success("Password reset.")
                 else:
                     st.error("Select a user and enter a new password.")
+
+        # ---------------- Audit log ----------------
+        st.subheader("🧾 Audit Log")
+        cola1, cola2, cola3 = st.columns(3)
+        with cola1:
+            audit_stock = st.text_input("StockCode", key="audit_stock").strip().upper()
+        with cola2:
+            audit_user = st.text_input("Changed by", key="audit_user").strip()
+        with cola3:
+            audit_range = st.date_input("Date range", value=(), key="audit_range")
+        audit_filters = {
+            "project_id": pid,
+            "stockcode": audit_stock or None,
+            "changed_by": audit_user or None,
+            "since": audit_range[0] if len(audit_range) > 0 else None,
+            "until": audit_range[1] + pd.Timedelta(days=1) if len(audit_range) > 1 else None,
+        }
+        # keyset paging: a stack of cursors, reset whenever the filters change
+        if st.session_state.get("audit_filters") != audit_filters:
+            st.session_state["audit_filters"] = audit_filters
+            st.session_state["audit_cursors"] = [None]
+        cursors = st.session_state["audit_cursors"]
+        audit_df, next_cursor = db_utils.get_audit_page(after=cursors[-1], **audit_filters)
+        st.dataframe(audit_df, width="stretch")
+        colp1, colp2 = st.columns(2)
+        with colp1:
+            if len(cursors) > 1 and st.button("⬅️ Newer"):
+                cursors.pop()
+                st.rerun()
+        with colp2:
+            if next_cursor is not None and st.button("Older ➡️"):
+                cursors.append(next_cursor)
+                st.rerun()
+
+        with st.expander("Retention"):
+            keep_days = st.number_input("Keep detailed history for (days)", min_value=30,
+                                        value=db_utils.AUDIT_RETENTION_DAYS, step=30)
+            if st.button("Roll up older history"):
+                n = db_utils.prune_audit_log(int(keep_days))
+                st.success(f"Rolled up {n} saves.")
+            st.dataframe(db_utils.get_audit_rollups(pid), width="stretch")
+
+        with st.expander("Project as it was at a past moment"):
+            colh1, colh2 = st.columns(2)
+            with colh1:
+                as_of_day = st.date_input("Date", key="as_of_day")
+            with colh2:
+                as_of_time = st.time_input("Time (UTC)", key="as_of_time")
+            if st.button("Rebuild project view"):
+                try:
+                    as_of_df = db_utils.get_project_data_as_of(pid, pd.Timestamp.combine(as_of_day, as_of_time))
+                    st.dataframe(as_of_df, width="stretch")
+                except ValueError as e:
+                    st.error(str(e))
+
+        # ---------------- Performance ----------------
+        st.subheader("⏱️ Performance")
+        colf1, colf2, colf3 = st.columns(3)
+        with colf1:
+            profiling.enabled = st.checkbox("Record timings", value=profiling.enabled)
+        with colf2:
+            profiling.capture_plans = st.checkbox(
+                f"Capture query plans of statements over {profiling.SLOW_SQL_SECONDS * 1000:g} ms",
+                value=profiling.capture_plans)
+        with colf3:
+            if st.button("Clear timings"):
+                profiling.clear()
+        st.markdown("**Recent script runs** (other = pandas, Streamlit rendering and everything else)")
+        st.dataframe(profiling.runs(), width="stretch")
+        st.markdown("**db_utils functions**")
+        st.dataframe(profiling.function_stats(), width="stretch")
+        st.markdown("**SQL statements by total time**")
+        st.dataframe(profiling.sql_stats(), width="stretch")
+        st.markdown("**Slow statements**")
+        st.dataframe(profiling.slow_statements(), width="stretch")
+
+finish_run()
@@ -0,0 +1,724 @@
+"""Numbered schema migrations, applied in order at startup.
+
+The applied version is stored in the database header (``PRAGMA user_version``),
+so every migration runs exactly once per database. Append new migrations to
+MIGRATIONS with the next version number; never edit or renumber shipped ones.
+Each step is either a list of SQL statements or a callable taking the connection.
+"""
+import attachment_store
+import search
+
+BASE_SCHEMA = [
+    # ---- projects ----
+    """
+    CREATE TABLE IF NOT EXISTS projects (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL
+    )
+    """,
+
+    # ---- stock list (master) ----
+    """
+    CREATE TABLE IF NOT EXISTS stock_list (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        project_id INTEGER NOT NULL,
+        stockcode TEXT,
+        description TEXT,
+        FOREIGN KEY(project_id) REFERENCES projects(id),
+        UNIQUE(project_id, stockcode)
+    )
+    """,
+
+    # ---- procurement ----
+    """
+    CREATE TABLE IF NOT EXISTS procurement (
+        project_id INTEGER NOT NULL,
+        stockcode TEXT,
+        description TEXT,
+        current_supplier TEXT,
+        ac_coverage TEXT,
+        next_shortage_date TEXT,
+        FOREIGN KEY(project_id) REFERENCES projects(id),
+        UNIQUE(project_id, stockcode)
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS procurement_undo AS SELECT * FROM procurement WHERE 0",
+
+    # ---- industrialization ----
+    """
+    CREATE TABLE IF NOT EXISTS industrialization (
+        project_id INTEGER NOT NULL,
+        stockcode TEXT,
+        description TEXT,
+        new_supplier TEXT,
+        fai_delivery_date TEXT,
+        first_po_delivery_date TEXT,
+        FOREIGN KEY(project_id) REFERENCES projects(id),
+        UNIQUE(project_id, stockcode)
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS industrialization_undo AS SELECT * FROM industrialization WHERE 0",
+
+    # ---- quality ----
+    """
+    CREATE TABLE IF NOT EXISTS quality (
+        project_id INTEGER NOT NULL,
+        stockcode TEXT,
+        description TEXT,
+        fai_status TEXT DEFAULT 'Not Submitted',
+        fai_number TEXT,
+        fitcheck_ac TEXT,
+        fitcheck_date TEXT,
+        fitcheck_status TEXT DEFAULT '',
+        FOREIGN KEY(project_id) REFERENCES projects(id),
+        UNIQUE(project_id, stockcode)
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS quality_undo AS SELECT * FROM quality WHERE 0",
+
+    # ---- audit log (row-level history) ----
+    """
+    CREATE TABLE IF NOT EXISTS audit_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        project_id INTEGER,
+        table_name TEXT,
+        stockcode TEXT,
+        column_name TEXT,
+        old_value TEXT,
+        new_value TEXT,
+        changed_by TEXT,
+        changed_at TEXT
+    )
+    """,
+
+    # ---- attachments (BLOB storage) ----
+    """
+    CREATE TABLE IF NOT EXISTS attachments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        project_id INTEGER NOT NULL,
+        stockcode TEXT NOT NULL,
+        file_name TEXT NOT NULL,
+        file_data BLOB NOT NULL,
+        uploaded_by TEXT,
+        uploaded_at TEXT
+    )
+    """,
+
+    # ---- users (auth) ----
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        email TEXT PRIMARY KEY,
+        role TEXT NOT NULL,
+        password_hash TEXT NOT NULL
+    )
+    """,
+]
+
+COVERING_INDEXES = [
+    # get_project_data: range scan of one project's stock list without touching the table
+    "CREATE INDEX IF NOT EXISTS idx_stock_list_project ON stock_list(project_id, stockcode, description)",
+    # audit lookups by project / table / item, newest last
+    "CREATE INDEX IF NOT EXISTS idx_audit_log_item ON audit_log(project_id, table_name, stockcode, changed_at)",
+    # get_attachments: filter + ORDER BY uploaded_at DESC, answered from the index alone
+    """
+    CREATE INDEX IF NOT EXISTS idx_attachments_item
+    ON attachments(project_id, stockcode, uploaded_at DESC, file_name, uploaded_by)
+    """,
+    # undo snapshot delete/copy per project
+    "CREATE INDEX IF NOT EXISTS idx_procurement_undo_project ON procurement_undo(project_id)",
+    "CREATE INDEX IF NOT EXISTS idx_industrialization_undo_project ON industrialization_undo(project_id)",
+    "CREATE INDEX IF NOT EXISTS idx_quality_undo_project ON quality_undo(project_id)",
+    # list_users: ORDER BY role, email without a sort
+    "CREATE INDEX IF NOT EXISTS idx_users_role ON users(role, email)",
+]
+
+
+def add_column(conn, table, column, decl):
+    """ALTER TABLE ... ADD COLUMN, skipped if the column already exists."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_xinfo({table})")}  # xinfo includes generated columns
+    if column not in existing:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _project_data_version(conn):
+    # bumped by every write to a project; keys the get_project_data cache
+    add_column(conn, "projects", "data_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _search_index(conn):
+    conn.execute(search.CREATE_SQL)
+    search.reindex(conn)
+
+
+def _db_path(conn):
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def _read_blob(conn, attach_id):
+    """Yield an attachment BLOB in chunks (incremental I/O where sqlite3 supports it)."""
+    if hasattr(conn, "blobopen"):
+        with conn.blobopen("attachments", "file_data", attach_id, readonly=True) as blob:
+            yield from iter(lambda: blob.read(attachment_store.CHUNK_SIZE), b"")
+    else:
+        yield conn.execute("SELECT file_data FROM attachments WHERE id=?", (attach_id,)).fetchone()[0]
+
+
+def _attachment_store(conn):
+    """Move attachment BLOBs into the content-addressed store; keep only hash + metadata in SQLite.
+
+    Run VACUUM afterwards to give the freed pages back to the file system.
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS attachment_blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE attachments_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER NOT NULL,
+            stockcode TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            sha256 TEXT NOT NULL REFERENCES attachment_blobs(sha256),
+            size INTEGER NOT NULL,
+            uploaded_by TEXT,
+            uploaded_at TEXT
+        )
+    """)
+    store = attachment_store.get_store(_db_path(conn))
+    ids = [row[0] for row in conn.execute("SELECT id FROM attachments ORDER BY id")]
+    for attach_id in ids:
+        staged = store.stage(_read_blob(conn, attach_id))
+        store.commit(staged)
+        conn.execute("""
+            INSERT INTO attachment_blobs (sha256, size, refcount) VALUES (?, ?, 1)
+            ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1
+        """, (staged.sha256, staged.size))
+        conn.execute("""
+            INSERT INTO attachments_new (id, project_id, stockcode, file_name, sha256, size, uploaded_by, uploaded_at)
+            SELECT id, project_id, stockcode, file_name, ?, ?, uploaded_by, uploaded_at
+            FROM attachments WHERE id=?
+        """, (staged.sha256, staged.size, attach_id))
+    conn.execute("DROP TABLE attachments")
+    conn.execute("ALTER TABLE attachments_new RENAME TO attachments")
+    conn.execute("""
+        CREATE INDEX idx_attachments_item
+        ON attachments(project_id, stockcode, uploaded_at DESC, file_name, uploaded_by)
+    """)
+    conn.execute("CREATE INDEX idx_attachments_sha256 ON attachments(sha256)")
+
+
+UNDO_TABLES = {
+    "procurement": ["description", "current_supplier", "ac_coverage", "next_shortage_date"],
+    "industrialization": ["description", "new_supplier", "fai_delivery_date", "first_po_delivery_date"],
+    "quality": ["description", "fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status"],
+}
+
+
+def _save_changesets(conn):
+    """Replace the full-table `<table>_undo` snapshots with per-save changesets.
+
+    A save records only the rows it touched, each with its before image as JSON
+    (NULL if the save created the row). An existing snapshot becomes one save
+    holding the rows where it differs from the live table. A project with live
+    rows but an empty snapshot (its first save went into an empty table) gets a
+    save that deletes them all, as the snapshot restore did.
+    """
+    conn.execute("""
+        CREATE TABLE saves (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            changed_by TEXT,
+            saved_at TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX idx_saves_project ON saves(project_id, table_name, id)")
+    conn.execute("""
+        CREATE TABLE save_rows (
+            save_id INTEGER NOT NULL REFERENCES saves(id),
+            stockcode TEXT NOT NULL,
+            before TEXT,
+            PRIMARY KEY(save_id, stockcode)
+        ) WITHOUT ROWID
+    """)
+    for table, cols in UNDO_TABLES.items():
+        undo = f"{table}_undo"
+        before = "json_object(" + ", ".join(f"'{c}', u.{c}" for c in cols) + ")"
+        differs = " OR ".join(f"u.{c} IS NOT live.{c}" for c in cols)
+        projects = conn.execute(f"SELECT project_id FROM {undo} UNION SELECT project_id FROM {table}").fetchall()
+        for (project_id,) in projects:
+            save_id = conn.execute(
+                "INSERT INTO saves (project_id, table_name, changed_by) VALUES (?, ?, 'migration')",
+                (project_id, table)).lastrowid
+            # rows the snapshot has and the live table lacks or holds differently
+            conn.execute(f"""
+                INSERT OR IGNORE INTO save_rows (save_id, stockcode, before)
+                SELECT ?, u.stockcode, {before}
+                FROM {undo} u
+                LEFT JOIN {table} live ON live.project_id = u.project_id AND live.stockcode = u.stockcode
+                WHERE u.project_id = ? AND u.stockcode IS NOT NULL AND (live.stockcode IS NULL OR {differs})
+            """, (save_id, project_id))
+            # rows the last save created
+            conn.execute(f"""
+                INSERT OR IGNORE INTO save_rows (save_id, stockcode, before)
+                SELECT ?, live.stockcode, NULL
+                FROM {table} live
+                WHERE live.project_id = ? AND live.stockcode IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM {undo} u WHERE u.project_id = live.project_id AND u.stockcode = live.stockcode)
+            """, (save_id, project_id))
+        conn.execute(f"DROP TABLE {undo}")
+    conn.execute("DELETE FROM saves WHERE id NOT IN (SELECT save_id FROM save_rows)")
+
+
+def _audit_changesets(conn):
+    """Regroup the per-column audit_log into one header per save plus one packed diff per item.
+
+    `audit_changes.diff` is a JSON object {column: [old, new], ...} holding only the
+    columns that changed. Old audit rows are grouped by (project, table, user, time).
+    """
+    conn.execute("""
+        CREATE TABLE audit_changesets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            project_id INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            changed_by TEXT,
+            changed_at TEXT,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            change_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE audit_changes (
+            id INTEGER PRIMARY KEY,
+            changeset_id INTEGER NOT NULL REFERENCES audit_changesets(id),
+            project_id INTEGER NOT NULL,
+            stockcode TEXT,
+            diff TEXT NOT NULL
+        )
+    """)
+    # history older than the retention window, summarised per month
+    conn.execute("""
+        CREATE TABLE audit_rollups (
+            project_id INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            changed_by TEXT NOT NULL,
+            month TEXT NOT NULL,
+            changesets INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            change_count INTEGER NOT NULL,
+            PRIMARY KEY(project_id, table_name, changed_by, month)
+        ) WITHOUT ROWID
+    """)
+
+    conn.execute("""
+        INSERT INTO audit_changesets (project_id, table_name, changed_by, changed_at)
+        SELECT project_id, table_name, changed_by, changed_at
+        FROM audit_log
+        GROUP BY project_id, table_name, changed_by, changed_at
+        ORDER BY min(id)
+    """)
+    conn.execute("""
+        INSERT INTO audit_changes (changeset_id, project_id, stockcode, diff)
+        SELECT cs.id, cs.project_id, a.stockcode, json_group_object(a.column_name, json_array(a.old_value, a.new_value))
+        FROM (SELECT * FROM audit_log ORDER BY id) a
+        JOIN audit_changesets cs
+            ON cs.project_id = a.project_id AND cs.table_name = a.table_name
+           AND cs.changed_by IS a.changed_by AND cs.changed_at IS a.changed_at
+        GROUP BY cs.id, a.stockcode
+        ORDER BY cs.id, min(a.id)
+    """)
+    conn.execute("""
+        UPDATE audit_changesets SET
+            row_count = (SELECT count(*) FROM audit_changes c WHERE c.changeset_id = audit_changesets.id),
+            change_count = (SELECT count(*) FROM audit_changes c, json_each(c.diff)
+                            WHERE c.changeset_id = audit_changesets.id)
+    """)
+    conn.execute("DROP TABLE audit_log")
+
+    # get_audit_page walks these newest-first, so every filter is an index range scan
+    conn.execute("CREATE INDEX idx_audit_changes_changeset ON audit_changes(changeset_id)")
+    conn.execute("CREATE INDEX idx_audit_changes_project ON audit_changes(project_id, changeset_id)")
+    conn.execute("CREATE INDEX idx_audit_changes_stockcode ON audit_changes(stockcode, changeset_id)")
+    conn.execute("CREATE INDEX idx_audit_changesets_user ON audit_changesets(changed_by)")
+    # prune_audit_log: changesets older than the retention window
+    conn.execute("CREATE INDEX idx_audit_changesets_time ON audit_changesets(changed_at)")
+
+
+APP_META = [
+    # small key/value state, e.g. the hash of the last imported users.xlsx
+    "CREATE TABLE IF NOT EXISTS app_meta (key TEXT PRIMARY KEY, value TEXT)",
+]
+
+
+# project_view columns maintained by each source table's triggers
+VIEW_SOURCES = {
+    "procurement": ["current_supplier", "ac_coverage", "next_shortage_date"],
+    "industrialization": ["new_supplier", "fai_delivery_date", "first_po_delivery_date"],
+    "quality": ["fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status"],
+}
+
+
+def _julian_day(expr):
+    # julianday() of a valid ISO date (as written by db_utils.normalize_dates), else NULL
+    return f"CASE WHEN date(substr({expr}, 1, 10)) = substr({expr}, 1, 10) THEN julianday(substr({expr}, 1, 10)) END"
+
+
+def overlap_days_sql(next_shortage_date, first_po_delivery_date):
+    """SQL for overlap_days: whole days from the first production PO delivery to the next shortage."""
+    return f"CAST({_julian_day(next_shortage_date)} - {_julian_day(first_po_delivery_date)} AS INTEGER)"
+
+
+def change_seq_sql(row):
+    """SQL for the change_seq stamp of a row of `row`'s project: the data_version its write will bump to."""
+    return f"(SELECT data_version + 1 FROM projects WHERE id = {row}.project_id)"
+
+
+def _project_view_refresh_sql(where="", stamped=False):
+    """(Re)build the project_view rows of the stock list rows matching `where`.
+
+    With `stamped`, the rows also get a change_seq (see _change_feed).
+    """
+    source_cols = [c for cols in VIEW_SOURCES.values() for c in cols]
+    seq_col, seq_value = (", change_seq", f", {change_seq_sql('sl')}") if stamped else ("", "")
+    return f"""
+        INSERT OR REPLACE INTO project_view
+            (id, project_id, stockcode, description, {", ".join(source_cols)}, overlap_days{seq_col})
+        SELECT sl.id, sl.project_id, sl.stockcode, sl.description,
+               {", ".join(f"{alias}.{c}" for alias, cols in zip(["pr", "ind", "q"], VIEW_SOURCES.values()) for c in cols)},
+               {overlap_days_sql("pr.next_shortage_date", "ind.first_po_delivery_date")}{seq_value}
+        FROM stock_list sl
+        LEFT JOIN procurement pr ON sl.project_id = pr.project_id AND sl.stockcode = pr.stockcode
+        LEFT JOIN industrialization ind ON sl.project_id = ind.project_id AND sl.stockcode = ind.stockcode
+        LEFT JOIN quality q ON sl.project_id = q.project_id AND sl.stockcode = q.stockcode
+        {where}
+    """
+
+
+def _project_view_trigger_sql():
+    """Triggers keeping project_view in step with stock_list and the three department tables.
+
+    The stock_list triggers delete and insert instead of INSERT OR REPLACE: a
+    conflict policy inside a trigger is overridden by the outer statement's, so
+    the UPDATE trigger fired by add_project's upsert would abort on the existing
+    project_view row.
+    """
+    insert = _project_view_refresh_sql("WHERE sl.id = NEW.id").replace("INSERT OR REPLACE", "INSERT", 1)
+    sql = [
+        f"CREATE TRIGGER project_view_stock_insert AFTER INSERT ON stock_list BEGIN {insert}; END",
+        f"""
+        CREATE TRIGGER project_view_stock_update AFTER UPDATE ON stock_list BEGIN
+            DELETE FROM project_view WHERE id = OLD.id;
+            {insert};
+        END
+        """,
+        "CREATE TRIGGER project_view_stock_delete AFTER DELETE ON stock_list BEGIN "
+        "DELETE FROM project_view WHERE id = OLD.id; END",
+    ]
+    return sql + _department_view_trigger_sql()
+
+
+def _department_view_trigger_sql(stamped=False, clear_moved_only=False):
+    """Triggers copying the department tables' columns into project_view.
+
+    With `stamped` they also set change_seq; with `clear_moved_only` an UPDATE
+    only clears the old item's columns when the row moved to another item.
+    """
+    sql = []
+    for table, cols in VIEW_SOURCES.items():
+        def assign(row):
+            # SET list copying `row`'s columns (NEW.x, or NULL) and recomputing overlap_days
+            values = {c: (f"{row}.{c}" if row else "NULL") for c in cols}
+            overlap = overlap_days_sql(values.get("next_shortage_date", "next_shortage_date"),
+                                       values.get("first_po_delivery_date", "first_po_delivery_date"))
+            sets = [f"{c} = {v}" for c, v in values.items()] + [f"overlap_days = {overlap}"]
+            if stamped:
+                sets.append(f"change_seq = {change_seq_sql('OLD' if row is None else row)}")
+            return ", ".join(sets)
+
+        set_new = f"""
+            UPDATE project_view SET {assign("NEW")}
+            WHERE project_id = NEW.project_id AND stockcode = NEW.stockcode;
+        """
+        clear_old = f"""
+            UPDATE project_view SET {assign(None)}
+            WHERE project_id = OLD.project_id AND stockcode = OLD.stockcode;
+        """
+        clear_moved = clear_old.replace(
+            ";", " AND (OLD.project_id IS NOT NEW.project_id OR OLD.stockcode IS NOT NEW.stockcode);", 1)
+        sql += [
+            f"CREATE TRIGGER project_view_{table}_insert AFTER INSERT ON {table} BEGIN {set_new} END",
+            f"CREATE TRIGGER project_view_{table}_update AFTER UPDATE ON {table} BEGIN "
+            f"{clear_moved if clear_moved_only else clear_old} {set_new} END",
+            f"CREATE TRIGGER project_view_{table}_delete AFTER DELETE ON {table} BEGIN {clear_old} END",
+        ]
+    return sql
+
+
+def _project_view(conn):
+    """Materialize the stock list / department join into project_view, kept current by triggers."""
+    source_cols = [c for cols in VIEW_SOURCES.values() for c in cols]
+    conn.execute(f"""
+        CREATE TABLE project_view (
+            id INTEGER PRIMARY KEY,  -- stock_list.id
+            project_id INTEGER NOT NULL,
+            stockcode TEXT,
+            description TEXT,
+            {", ".join(f"{c} TEXT" for c in source_cols)},
+            overlap_days INTEGER
+        )
+    """)
+    conn.execute("CREATE INDEX idx_project_view_item ON project_view(project_id, stockcode)")
+    conn.execute("CREATE INDEX idx_project_view_overlap ON project_view(project_id, overlap_days)")
+    for sql in _project_view_trigger_sql():
+        conn.execute(sql)
+    conn.execute(_project_view_refresh_sql())
+
+
+def _change_feed(conn):
+    """Stamp project_view rows with the change sequence of their last change, for get_project_changes.
+
+    Every change to a stock list item or one of its department rows goes through
+    the project_view triggers, which now set `change_seq` to the data_version the
+    write is about to bump the project to. Removed stock list items leave a
+    tombstone in project_view_deletes. Existing rows are stamped with a fresh
+    version of their project.
+    """
+    add_column(conn, "project_view", "change_seq", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""
+        CREATE TABLE project_view_deletes (
+            id INTEGER PRIMARY KEY,  -- stock_list.id
+            project_id INTEGER NOT NULL,
+            stockcode TEXT,
+            change_seq INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX idx_project_view_changes ON project_view(project_id, change_seq)")
+    conn.execute("CREATE INDEX idx_project_view_deletes ON project_view_deletes(project_id, change_seq)")
+
+    triggers = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'project_view_%'")]
+    for name in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    insert = _project_view_refresh_sql("WHERE sl.id = NEW.id", stamped=True).replace("INSERT OR REPLACE", "INSERT", 1)
+    conn.execute(f"""
+        CREATE TRIGGER project_view_stock_insert AFTER INSERT ON stock_list BEGIN
+            DELETE FROM project_view_deletes WHERE id = NEW.id;
+            {insert};
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER project_view_stock_update AFTER UPDATE ON stock_list BEGIN
+            DELETE FROM project_view WHERE id = OLD.id;
+            {insert};
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER project_view_stock_delete AFTER DELETE ON stock_list BEGIN
+            DELETE FROM project_view WHERE id = OLD.id;
+            INSERT OR REPLACE INTO project_view_deletes (id, project_id, stockcode, change_seq)
+            VALUES (OLD.id, OLD.project_id, OLD.stockcode, {change_seq_sql("OLD")});
+        END
+    """)
+    for sql in _department_view_trigger_sql(stamped=True):
+        conn.execute(sql)
+
+    conn.execute("UPDATE projects SET data_version = data_version + 1")
+    conn.execute("""
+        UPDATE project_view SET change_seq = (SELECT data_version FROM projects WHERE id = project_view.project_id)
+    """)
+
+
+JOBS = [
+    # background imports (see jobs.py); job_key makes resubmitting the same upload a no-op
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_key TEXT UNIQUE NOT NULL,
+        kind TEXT NOT NULL,
+        project_id INTEGER NOT NULL,
+        table_name TEXT NOT NULL,
+        file_name TEXT,
+        submitted_by TEXT,
+        status TEXT NOT NULL,
+        rows_total INTEGER,
+        rows_done INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        created_at TEXT,
+        started_at TEXT,
+        finished_at TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_jobs_project ON jobs(project_id, table_name, id)",
+    "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)",
+]
+
+
+CHECKPOINTS = [
+    # periodic snapshots of a project's tables; get_project_data_as_of replays audit deltas from the nearest
+    """
+    CREATE TABLE IF NOT EXISTS project_checkpoints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        project_id INTEGER NOT NULL,
+        taken_at TEXT NOT NULL,
+        changeset_id INTEGER NOT NULL,  -- newest audit changeset reflected in `data`
+        row_count INTEGER NOT NULL,
+        data BLOB NOT NULL              -- zlib-compressed JSON, see db_utils._encode_checkpoint
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_project_checkpoints ON project_checkpoints(project_id, taken_at)",
+]
+
+
+# per-row contributions to portfolio_counts: metric -> SQL for the bucket of `{row}`, NULL = not counted
+PORTFOLIO_METRICS = {
+    "items": "''",
+    "fai_status": "coalesce({row}.fai_status, '')",
+    "fitcheck_status": "coalesce({row}.fitcheck_status, '')",
+    "negative_overlap": "CASE WHEN {row}.overlap_days < 0 THEN '' END",
+    # shortage counts per date; windows relative to today are summed at read time
+    "shortage_date": "CASE WHEN date(substr({row}.next_shortage_date, 1, 10)) = substr({row}.next_shortage_date, 1, 10) "
+                     "THEN substr({row}.next_shortage_date, 1, 10) END",
+}
+# project_view columns each metric depends on
+PORTFOLIO_SOURCES = {
+    "fai_status": "fai_status",
+    "fitcheck_status": "fitcheck_status",
+    "negative_overlap": "overlap_days",
+    "shortage_date": "next_shortage_date",
+}
+
+
+def _portfolio_count_sql(metric, row, sign):
+    bucket = PORTFOLIO_METRICS[metric].format(row=row)
+    return f"""
+        INSERT INTO portfolio_counts (project_id, metric, bucket, n)
+        SELECT {row}.project_id, '{metric}', {bucket}, {sign} WHERE {bucket} IS NOT NULL
+        ON CONFLICT(metric, bucket, project_id) DO UPDATE SET n = n + ({sign});
+    """
+
+
+def _portfolio_counts(conn):
+    """Per-project counts behind the portfolio dashboard, kept current by triggers on project_view.
+
+    Department updates no longer blank the item's project_view columns before
+    setting the new ones, which would count every change twice.
+    """
+    conn.execute("""
+        CREATE TABLE portfolio_counts (
+            project_id INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (metric, bucket, project_id)
+        ) WITHOUT ROWID
+    """)
+    for table in VIEW_SOURCES:
+        conn.execute(f"DROP TRIGGER project_view_{table}_update")
+    for sql in _department_view_trigger_sql(stamped=True, clear_moved_only=True):
+        if sql.startswith("CREATE TRIGGER project_view_") and "_update AFTER UPDATE" in sql:
+            conn.execute(sql)
+
+    add_all = "".join(_portfolio_count_sql(m, "NEW", 1) for m in PORTFOLIO_METRICS)
+    remove_all = "".join(_portfolio_count_sql(m, "OLD", -1) for m in PORTFOLIO_METRICS)
+    conn.execute(f"CREATE TRIGGER portfolio_view_insert AFTER INSERT ON project_view BEGIN {add_all} END")
+    conn.execute(f"CREATE TRIGGER portfolio_view_delete AFTER DELETE ON project_view BEGIN {remove_all} END")
+    for metric, column in PORTFOLIO_SOURCES.items():
+        conn.execute(f"""
+            CREATE TRIGGER portfolio_view_{metric} AFTER UPDATE OF {column} ON project_view
+            WHEN OLD.{column} IS NOT NEW.{column}
+            BEGIN {_portfolio_count_sql(metric, "OLD", -1)} {_portfolio_count_sql(metric, "NEW", 1)} END
+        """)
+
+    for metric in PORTFOLIO_METRICS:
+        bucket = PORTFOLIO_METRICS[metric].format(row="project_view")
+        conn.execute(f"""
+            INSERT INTO portfolio_counts (project_id, metric, bucket, n)
+            SELECT project_id, '{metric}', {bucket}, count(*) FROM project_view
+            WHERE {bucket} IS NOT NULL
+            GROUP BY project_id, {bucket}
+        """)
+
+
+# project_view date columns mirrored as integer day ordinals (Python's date.toordinal())
+DAY_COLUMNS = {
+    "next_shortage_date": "shortage_day",
+    "fai_delivery_date": "fai_delivery_day",
+    "first_po_delivery_date": "first_po_day",
+    "fitcheck_date": "fitcheck_day",
+}
+
+
+def day_ordinal_sql(expr):
+    """SQL for the date.toordinal() of a valid ISO date in `expr`, else NULL."""
+    return f"CAST({_julian_day(expr)} - 1721424.5 AS INTEGER)"
+
+
+def _day_ordinals(conn):
+    """Integer day-ordinal mirrors of project_view's dates, indexed for the shortage-risk range queries.
+
+    The mirrors are virtual generated columns, so the project_view triggers keep
+    them current unchanged and only the indexes take space.
+    """
+    for column, day in DAY_COLUMNS.items():
+        add_column(conn, "project_view", day, f"INTEGER GENERATED ALWAYS AS ({day_ordinal_sql(column)}) VIRTUAL")
+    # get_risk_items windows, across all projects and within one
+    for day in ("shortage_day", "first_po_day"):
+        conn.execute(f"CREATE INDEX idx_project_view_{day} ON project_view({day})")
+        conn.execute(f"CREATE INDEX idx_project_view_project_{day} ON project_view(project_id, {day})")
+
+
+MIGRATIONS = [
+    (1, "base schema", BASE_SCHEMA),
+    (2, "covering indexes for hot queries", COVERING_INDEXES),
+    (3, "per-project data version", _project_data_version),
+    (4, "full-text search index", _search_index),
+    (5, "content-addressed attachment store", _attachment_store),
+    (6, "per-save undo changesets", _save_changesets),
+    (7, "changeset-structured audit log", _audit_changesets),
+    (8, "app metadata", APP_META),
+    (9, "trigger-maintained project view", _project_view),
+    (10, "background import jobs", JOBS),
+    (11, "project view change feed", _change_feed),
+    (12, "project checkpoints", CHECKPOINTS),
+    (13, "portfolio counts", _portfolio_counts),
+    (14, "project view day ordinals", _day_ordinals),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn, migrations=MIGRATIONS):
+    """Apply every migration newer than the stored version, each in its own transaction.
+
+    `conn` must be in autocommit mode (isolation_level=None). Returns the list of
+    (version, name) pairs that were applied.
+    """
+    applied = []
+    for version, name, step in migrations:
+        if version <= schema_version(conn):
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # another process may have migrated while we waited for the lock
+            if version <= schema_version(conn):
+                conn.rollback()
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for sql in step:
+                    conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        applied.append((version, name))
+    return applied
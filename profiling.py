@@ -0,0 +1,279 @@
+"""Lightweight timing instrumentation for db_utils, shown in the Admin tab's Performance section.
+
+Three kinds of records go into one bounded ring buffer (the newest RING_SIZE are kept):
+
+* `span` / `@timed`: wall time of a named block, e.g. every public db_utils function;
+* SQL: every statement run through a ProfiledConnection (db_utils opens all of its
+  connections with it), with its duration and row count. Rows are counted as they
+  are fetched with fetchone/fetchmany/fetchall, and fetch time is added to the
+  statement. With `capture_plans`, statements slower than SLOW_SQL_SECONDS also get
+  their EXPLAIN QUERY PLAN;
+* runs: `start_run` / `end_run` bracket one Streamlit script run and keep a
+  breakdown of where its time went (db_utils, SQL, bcrypt, everything else).
+
+Records are tagged with the run active on the recording thread, so work done on
+background threads (e.g. import jobs) shows up in the totals but not in a run.
+Writes run on the db_utils writer thread under the run that submitted them.
+"""
+import functools
+import itertools
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import pandas as pd
+
+RING_SIZE = 20_000       # span and SQL records kept
+RUN_HISTORY = 50         # finished script runs kept
+SLOW_SQL_SECONDS = 0.1
+EXPLAIN_VERBS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+enabled = True
+capture_plans = False
+
+_records = deque(maxlen=RING_SIZE)
+_runs = deque(maxlen=RUN_HISTORY)
+_lock = threading.Lock()
+_local = threading.local()
+_run_ids = itertools.count(1)
+
+
+def _add(record):
+    run = getattr(_local, "run", None)
+    record["run"] = run["id"] if run else None
+    with _lock:
+        _records.append(record)
+    return record
+
+
+def _charge(kind, seconds, count=1):
+    """Add to the current run's totals for `kind`."""
+    run = getattr(_local, "run", None)
+    if run is not None:
+        calls, total = run["totals"].get(kind, (0, 0.0))
+        run["totals"][kind] = (calls + count, total + seconds)
+
+
+@contextmanager
+def span(name, kind="db_utils"):
+    """Time a block as `name`. Nested spans are recorded too; only outermost ones count toward a run."""
+    if not enabled:
+        yield
+        return
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _local.depth = depth
+        _add({"kind": kind, "name": name, "seconds": seconds, "rows": None, "depth": depth, "at": time.time()})
+        if depth == 0:
+            _charge(kind, seconds)
+
+
+def timed(fn):
+    """Decorator: record every call of `fn` as a span named after it."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with span(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+# ---------- SQL trace ----------
+
+def _plan(conn, sql, parameters):
+    if sql.lstrip().split(None, 1)[0].upper() not in EXPLAIN_VERBS:
+        return None
+    try:
+        rows = sqlite3.Connection.execute(conn, f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+    except sqlite3.Error:
+        return None
+    return "\n".join(row[3] for row in rows)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    """Cursor recording each statement's duration and row count."""
+
+    _record = None
+    _explain = None
+
+    def _traced(self, method, sql, parameters, explain=True):
+        if not enabled:
+            self._record = None
+            return method(sql, parameters) if parameters is not None else method(sql)
+        start = time.perf_counter()
+        result = method(sql, parameters) if parameters is not None else method(sql)
+        seconds = time.perf_counter() - start
+        self._record = _add({"kind": "sql", "name": sql, "seconds": seconds, "rows": max(self.rowcount, 0),
+                             "depth": getattr(_local, "depth", 0), "at": time.time()})
+        self._explain = (sql, parameters) if explain else None
+        _charge("sql", seconds)
+        self._check_slow()
+        return result
+
+    def _check_slow(self):
+        record = self._record
+        if capture_plans and self._explain and record["seconds"] >= SLOW_SQL_SECONDS and "plan" not in record:
+            record["plan"] = _plan(self.connection, *self._explain)
+
+    def _fetched(self, method, *args):
+        if self._record is None:
+            return method(*args)
+        start = time.perf_counter()
+        rows = method(*args)
+        seconds = time.perf_counter() - start
+        self._record["seconds"] += seconds
+        self._record["rows"] += len(rows) if isinstance(rows, list) else rows is not None
+        _charge("sql", seconds, count=0)
+        self._check_slow()
+        return rows
+
+    def execute(self, sql, parameters=()):
+        return self._traced(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._traced(super().executemany, sql, seq_of_parameters, explain=False)
+
+    def executescript(self, sql_script):
+        return self._traced(super().executescript, sql_script, None, explain=False)
+
+    def fetchone(self):
+        return self._fetched(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetched(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetched(super().fetchall)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    """sqlite3 connection whose cursors (including conn.execute shortcuts) are ProfiledCursors."""
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+# ---------- Script runs ----------
+
+def start_run(label=None):
+    """Start attributing this thread's records to a new script run."""
+    _local.run = {"id": next(_run_ids), "label": label, "started_at": time.time(),
+                  "start": time.perf_counter(), "totals": {}}
+    _local.depth = 0
+
+
+def end_run():
+    """Finish the current run and keep its breakdown; a no-op if no run is active."""
+    run = getattr(_local, "run", None)
+    if run is None:
+        return
+    _local.run = None
+    wall = time.perf_counter() - run["start"]
+    totals = run["totals"]
+    db_calls, db_s = totals.get("db_utils", (0, 0.0))
+    sql_calls, sql_s = totals.get("sql", (0, 0.0))
+    bcrypt_s = totals.get("bcrypt", (0, 0.0))[1]
+    with _lock:
+        _runs.append({
+            "run": run["id"], "label": run["label"],
+            "started_at": pd.Timestamp(run["started_at"], unit="s").floor("s"),
+            "wall_s": wall, "db_utils_s": db_s, "db_calls": db_calls, "sql_s": sql_s, "statements": sql_calls,
+            "bcrypt_s": bcrypt_s, "other_s": max(wall - db_s - bcrypt_s, 0.0),
+        })
+
+
+def current_context():
+    """This thread's run and span depth, to hand to `attributed_to` on another thread."""
+    return getattr(_local, "run", None), getattr(_local, "depth", 0)
+
+
+@contextmanager
+def attributed_to(context):
+    """Record this thread's work in the block as if it ran inside `context` (from current_context).
+
+    Used by the db_utils writer thread, so a write counts toward the script run
+    that submitted it, nested in the span that was waiting for it.
+    """
+    previous = getattr(_local, "run", None), getattr(_local, "depth", 0)
+    _local.run, _local.depth = context
+    try:
+        yield
+    finally:
+        _local.run, _local.depth = previous
+
+
+# ---------- Reports ----------
+
+def _snapshot():
+    with _lock:
+        return pd.DataFrame(list(_records), columns=["kind", "name", "seconds", "rows", "depth", "at", "run", "plan"])
+
+
+def _aggregate(df):
+    grouped = df.groupby("name")
+    out = pd.DataFrame({
+        "calls": grouped.size(),
+        "total_s": grouped["seconds"].sum(),
+        "mean_ms": grouped["seconds"].mean() * 1000,
+        "max_ms": grouped["seconds"].max() * 1000,
+    })
+    return out.sort_values("total_s", ascending=False).reset_index()
+
+
+def function_stats():
+    """Calls and time per timed function or span, over the records in the ring buffer."""
+    df = _snapshot()
+    return _aggregate(df[df["kind"] != "sql"])
+
+
+def sql_stats(limit=25):
+    """The `limit` statements with the most total time (whitespace-normalized), with rows per call."""
+    df = _snapshot()
+    df = df[df["kind"] == "sql"].assign(name=lambda d: d["name"].map(lambda s: " ".join(s.split())))
+    out = _aggregate(df)
+    rows = df.groupby("name")["rows"].sum()
+    out["rows_per_call"] = (out["name"].map(rows) / out["calls"]).round(1)
+    return out.head(limit)
+
+
+def slow_statements(threshold=SLOW_SQL_SECONDS):
+    """Individual statements slower than `threshold`, newest first, with plans where captured."""
+    df = _snapshot()
+    df = df[(df["kind"] == "sql") & (df["seconds"] >= threshold)].sort_values("at", ascending=False)
+    return pd.DataFrame({
+        "at": pd.to_datetime(df["at"], unit="s").dt.floor("s"),
+        "ms": df["seconds"] * 1000,
+        "rows": df["rows"],
+        "sql": df["name"].map(lambda s: " ".join(s.split())),
+        "plan": df["plan"],
+    }).reset_index(drop=True)
+
+
+def runs():
+    """Breakdown of recent script runs, newest first."""
+    with _lock:
+        return pd.DataFrame(list(_runs)[::-1], columns=[
+            "run", "label", "started_at", "wall_s", "db_utils_s", "db_calls", "sql_s", "statements",
+            "bcrypt_s", "other_s",
+        ])
+
+
+def clear():
+    with _lock:
+        _records.clear()
+        _runs.clear()
@@ -0,0 +1,114 @@
+"""FTS5 search over a project's joined stock list, used by the filter boxes in main.py.
+
+One `search_index` row per stock_list row (rowid = stock_list.id) holds the text
+of that item across stock_list, procurement, industrialization and quality.
+Writers call `reindex()` inside their transaction to keep it current.
+"""
+
+TEXT_COLUMNS = [
+    "stockcode", "description",
+    "current_supplier", "ac_coverage", "next_shortage_date",
+    "new_supplier", "fai_delivery_date", "first_po_delivery_date",
+    "fai_status", "fai_number", "fitcheck_ac", "fitcheck_date", "fitcheck_status",
+]
+
+# `alias:term` in a query searches these columns
+COLUMN_ALIASES = {
+    "code": ["stockcode"],
+    "desc": ["description"],
+    "supplier": ["current_supplier", "new_supplier"],
+    "coverage": ["ac_coverage"],
+    "shortage": ["next_shortage_date"],
+    "fai": ["fai_status", "fai_number", "fai_delivery_date"],
+    "po": ["first_po_delivery_date"],
+    "fitcheck": ["fitcheck_ac", "fitcheck_date", "fitcheck_status"],
+    "status": ["fai_status", "fitcheck_status"],
+}
+
+CREATE_SQL = f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        project_id, {", ".join(TEXT_COLUMNS)},
+        tokenize = "unicode61 tokenchars '-_./'",
+        prefix = '2 3'
+    )
+"""
+
+_SOURCE_SQL = f"""
+    SELECT sl.id, sl.project_id,
+           sl.stockcode, sl.description,
+           pr.current_supplier, pr.ac_coverage, pr.next_shortage_date,
+           ind.new_supplier, ind.fai_delivery_date, ind.first_po_delivery_date,
+           q.fai_status, q.fai_number, q.fitcheck_ac, q.fitcheck_date, q.fitcheck_status
+    FROM stock_list sl
+    LEFT JOIN procurement pr
+        ON sl.project_id = pr.project_id AND sl.stockcode = pr.stockcode
+    LEFT JOIN industrialization ind
+        ON sl.project_id = ind.project_id AND sl.stockcode = ind.stockcode
+    LEFT JOIN quality q
+        ON sl.project_id = q.project_id AND sl.stockcode = q.stockcode
+"""
+
+
+def reindex(conn, project_id=None, stockcodes_sql=None):
+    """Rebuild index rows for one project (or all, if None), optionally only for the
+    stockcodes returned by the subquery `stockcodes_sql`. Runs in the caller's transaction."""
+    where, params = [], []
+    if project_id is not None:
+        where.append("sl.project_id = ?")
+        params.append(project_id)
+    if stockcodes_sql:
+        where.append(f"sl.stockcode IN ({stockcodes_sql})")
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+
+    conn.execute(f"DELETE FROM search_index WHERE rowid IN (SELECT sl.id FROM stock_list sl {where_sql})", params)
+    conn.execute(f"""
+        INSERT INTO search_index (rowid, project_id, {", ".join(TEXT_COLUMNS)})
+        {_SOURCE_SQL}
+        {where_sql}
+    """, params)
+
+
+def _phrase(term):
+    return '"' + term.replace('"', '""') + '"*'
+
+
+def parse_query(text):
+    """Turn filter-box input into an FTS5 expression.
+
+    Whitespace-separated terms must all match, each as a prefix. `column:term`
+    (a column name or one of COLUMN_ALIASES) limits that term to those columns,
+    e.g. `supplier:acme 2025-03`.
+    """
+    parts = []
+    for token in text.split():
+        column, sep, term = token.partition(":")
+        columns = COLUMN_ALIASES.get(column.lower()) or ([column.lower()] if column.lower() in TEXT_COLUMNS else None)
+        if sep and term and columns:
+            parts.append(f"{{{' '.join(columns)}}} : {_phrase(term)}")
+        else:
+            parts.append(f"{{{' '.join(TEXT_COLUMNS)}}} : {_phrase(token)}")
+    return " AND ".join(parts)
+
+
+def match_expression(project_id, text):
+    """Full MATCH expression restricting the filter-box query `text` to `project_id`, or None if `text` is blank."""
+    expr = parse_query(text)
+    if not expr:
+        return None
+    return f'project_id : "{int(project_id)}" AND ({expr})'
+
+
+def search(conn, project_id, text, limit=None):
+    """Stockcodes of `project_id` matching the filter-box query `text`.
+
+    With `limit`, only the best-ranked `limit` matches are returned.
+    """
+    match = match_expression(project_id, text)
+    if match is None:
+        return []
+    sql = "SELECT stockcode FROM search_index WHERE search_index MATCH ?"
+    params = [match]
+    if limit:
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(int(limit))
+    return [row[0] for row in conn.execute(sql, params)]